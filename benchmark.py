@@ -0,0 +1,147 @@
+'''
+Benchmarks cit's commands against a FakeJenkins server with many jobs, recording the number of
+requests, the bytes transferred and the time taken by each command.
+
+Usage::
+
+    python benchmark.py [--job-counts 10,100,1000,10000] [--latency SECONDS]
+
+The number of requests made by each command is checked against REQUEST_LIMITS, and the benchmark
+fails if any command needs more requests than before (also checked by test_cit.py).
+'''
+from __future__ import with_statement
+from fake_jenkins import FakeJenkins
+import StringIO
+import cit
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+#===================================================================================================
+# REQUEST_LIMITS
+#===================================================================================================
+# Maximum number of requests made by each command for n configured jobs, in the order the
+# commands are run by `run_benchmark` (so the job index is empty when "add" runs).
+REQUEST_LIMITS = {
+    # doesn't talk to the server
+    'init' : lambda n: 0,
+    # for each job: source config, current config (the job index is empty) and creation
+    'add' : lambda n: 3 * n,
+    # state of all jobs, and one request to start each job
+    'start' : lambda n: 1 + n,
+    # job index refresh, and one request to remove each job (their configurations, kept in a 
+    # snapshot, are known from the one of "add")
+    'rm' : lambda n: 1 + n,
+}
+
+COMMANDS = ['init', 'add', 'start', 'rm']
+
+
+#===================================================================================================
+# run_benchmark
+#===================================================================================================
+def run_benchmark(jobs, latency=0.0, workers=None):
+    '''
+    Runs all COMMANDS for a repository configured with the given number of source jobs, against
+    a FakeJenkins with those jobs.
+
+    :param latency: seconds taken by the fake server to answer each request.
+    :param workers: number of jobs handled in parallel by cit (--jobs).
+    :return: list of dicts with the results of each command: "command", "jobs", "requests",
+        "bytes" and "seconds".
+    '''
+    fake_jenkins = FakeJenkins(latency)
+    config = file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_config.xml')).read()
+    for i in xrange(jobs):
+        fake_jenkins.add_job('source-job-%d' % i, config)
+
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        os.makedirs(os.path.join(tmp_dir, '.git'))
+        file(os.path.join(tmp_dir, '.git', 'config'), 'w').write(
+            '[user]\n\tname = Benchmark\n\temail = benchmark@somewhere.com\n')
+        global_config_file = os.path.join(tmp_dir, 'citconfig.yaml')
+        file(global_config_file, 'w').write(cit.dump_yaml({'jenkins' : {'url' : fake_jenkins.url}}))
+        os.chdir(tmp_dir)
+
+        init_input = ''.join('source-job-%d\nsource-job-%d-$name\n' % (i, i) for i in xrange(jobs)) + '\n'
+
+        with fake_jenkins:
+            for command in COMMANDS:
+                argv = ['cit', command]
+                if command != 'init':
+                    argv.append('feature')
+                if workers is not None:
+                    argv += ['--jobs', str(workers)]
+
+                fake_jenkins.reset_requests()
+                stdout = sys.stdout
+                sys.stdout = StringIO.StringIO()
+                start = time.time()
+                try:
+                    return_code = cit.main(argv, global_config_file, StringIO.StringIO(init_input))
+                finally:
+                    seconds = time.time() - start
+                    output = sys.stdout.getvalue()
+                    sys.stdout = stdout
+                if return_code != cit.RETURN_CODE_OK:
+                    raise RuntimeError('"%s" failed:\n%s' % (' '.join(argv), output))
+
+                results.append({
+                    'command' : command,
+                    'jobs' : jobs,
+                    'requests' : len(fake_jenkins.requests),
+                    'bytes' : fake_jenkins.bytes_received + fake_jenkins.bytes_sent,
+                    'seconds' : seconds,
+                })
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+#===================================================================================================
+# check_request_limits
+#===================================================================================================
+def check_request_limits(results):
+    '''
+    :return: list of messages about commands that made more requests than allowed by
+        REQUEST_LIMITS.
+    '''
+    messages = []
+    for result in results:
+        limit = REQUEST_LIMITS[result['command']](result['jobs'])
+        if result['requests'] > limit:
+            messages.append('%(command)s with %(jobs)d jobs: %(requests)d requests' % result +
+                            ' (expected at most %d)' % limit)
+    return messages
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv):
+    jobs = cit.pop_option(argv, '--job-counts') or '10,100,1000'
+    latency = float(cit.pop_option(argv, '--latency') or 0.0)
+
+    print '%-8s %8s %10s %12s %10s' % ('command', 'jobs', 'requests', 'bytes', 'seconds')
+    failures = []
+    for count in jobs.split(','):
+        results = run_benchmark(int(count), latency)
+        for result in results:
+            print '%(command)-8s %(jobs)8d %(requests)10d %(bytes)12d %(seconds)10.3f' % result
+        failures += check_request_limits(results)
+
+    for message in failures:
+        print >> sys.stderr, 'too many requests: %s' % message
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,411 +1,4347 @@
-from __future__ import with_statement
-
-#===================================================================================================
-# configure_submodules_path
-#===================================================================================================
-def configure_submodules_path():
-    '''
-    Configures sys.path to detect our submodule dependencies. Must be called before trying to do
-    any other imports.
-    '''
-    import sys, os
-    
-    directory = os.path.abspath(os.path.dirname(__file__))
-    sys.path.insert(0, os.path.join(directory, 'jenkinsapi'))
-    sys.path.insert(0, os.path.join(directory, 'pyyaml', 'lib'))
-    
-configure_submodules_path()
-
-#===================================================================================================
-# imports
-#===================================================================================================
-from jenkinsapi.exceptions import UnknownJob
-from jenkinsapi.jenkins import Jenkins
-import contextlib
-import subprocess
-import xml.etree.ElementTree as ET
-import yaml
-import os
-import sys
-import urllib2
-
-#===================================================================================================
-# cit commands
-# ------------
-#
-# Functions below handle the actual "meat" of cit's commands.
-#  
-#===================================================================================================
-
-#===================================================================================================
-# create_feature_branch_job
-#===================================================================================================
-def create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email):
-    try:
-        job = jenkins.get_job(new_job_name)
-    except UnknownJob:
-        status = 'CREATED'
-        job = jenkins.copy_job(job_name, new_job_name)
-    else:
-        status = 'UPDATED'
-        
-    print '%s => %s (%s)' % (job_name, new_job_name, status)
-    
-    original_job = jenkins.get_job(job_name)
-    tree = ET.fromstring(original_job.get_config())
-    
-    branch_elements = list(tree.findall('.//hudson.plugins.git.BranchSpec/name'))
-    if len(branch_elements) > 0:
-        branch_elements[0].text = branch
-    else:
-        print '  warning: Could not find any branch spec to replace!'
-    
-    # If displayName exists adds the feature branch name to it.
-    display_name_elem = tree.find('./displayName')
-    if display_name_elem is not None:
-        display_name_elem.text = '%s (%s)' % (display_name_elem.text, branch)
-    
-    recipient_elements = list(tree.findall('.//hudson.tasks.Mailer/recipients'))
-    if len(recipient_elements) == 1:
-        recipient_element = recipient_elements[0]
-        recipient_element.text = user_email
-        
-    # remove properties from the build so we can use "start" to start-up jobs
-    properties_elem = tree.find('./properties')
-    if properties_elem is not None:
-        for elem in properties_elem.findall('./hudson.model.ParametersDefinitionProperty'):
-            properties_elem.remove(elem)
-            
-    # add a scm poll trigger for the build with 5 min intervals
-    triggers_elem = tree.find('./triggers')
-    scm_trigger = ET.SubElement(triggers_elem, 'hudson.triggers.SCMTrigger')
-    ET.SubElement(scm_trigger, 'spec').text = 'H/5 * * * *'
-    ET.SubElement(scm_trigger, 'ignorePostCommitHooks').text = 'false'
-    
-    # remove build triggers after this job
-    publishers_elem = tree.find('./publishers')
-    if publishers_elem is not None:
-        for elem in publishers_elem.findall('./hudson.tasks.BuildTrigger'):
-            publishers_elem.remove(elem)
-             
-    job.update_config(ET.tostring(tree))
-    
-    return job
-        
-
-        
-#===================================================================================================
-# cit_add
-#===================================================================================================
-def cit_add(branch, global_config):
-    cit_file_name, job_config = load_cit_local_config(os.getcwd())
-    
-    if branch is None:
-        branch = get_git_branch(cit_file_name)
-    
-    jenkins_url = global_config['jenkins']['url']
-    jenkins = Jenkins(jenkins_url)
-    for job_name, new_job_name in get_configured_jobs(branch, job_config):
-        user_name, user_email = get_git_user(cit_file_name)
-        create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email)
-        
-        
-#===================================================================================================
-# cit_rm
-#===================================================================================================
-def cit_rm(branch, global_config):
-    cit_file_name, job_config = load_cit_local_config(os.getcwd())
-    
-    if branch is None:
-        branch = get_git_branch(cit_file_name)
-    
-    jenkins_url = global_config['jenkins']['url']
-    jenkins = Jenkins(jenkins_url)
-    for _, new_job_name in get_configured_jobs(branch, job_config):
-        if jenkins.has_job(new_job_name):
-            jenkins.delete_job(new_job_name)
-            print new_job_name, '(REMOVED)'
-        else:
-            print new_job_name, '(NOT FOUND)'
-        
-#===================================================================================================
-# cit_start
-#===================================================================================================
-def cit_start(branch, global_config):        
-    cit_file_name, job_config = load_cit_local_config(os.getcwd())
-    
-    if branch is None:
-        branch = get_git_branch(cit_file_name)
-    
-    jenkins_url = global_config['jenkins']['url']
-    jenkins = Jenkins(jenkins_url)
-    
-    for _, new_job_name in get_configured_jobs(branch, job_config):
-        if jenkins.has_job(new_job_name):
-            job = jenkins.get_job(new_job_name)
-            if not job.is_running():
-                job.invoke()
-                status = '(STARTED)'
-            else:
-                status = '(RUNNING)'
-        else:
-            status = '(NOT FOUND)'
-        print new_job_name, status
- 
-        
-#===================================================================================================
-# git helpers
-# -----------
-#
-# Git-related helper functions to extract user name, current branch, etc. 
-#  
-#===================================================================================================
-
-
-#===================================================================================================
-# get_git_user
-#===================================================================================================
-def get_git_user(cit_file_name):
-    with chdir(cit_file_name):
-        user_name = check_output('git config --get user.name', shell=True).strip()
-        user_email = check_output('git config --get user.email', shell=True).strip()
-        return user_name, user_email
-        
-        
-#===================================================================================================
-# get_git_branch
-#===================================================================================================
-def get_git_branch(cit_file_name):        
-    with chdir(cit_file_name):
-        return check_output('git rev-parse --abbrev-ref HEAD', shell=True).strip()
-
-
-#===================================================================================================
-# cit configuration
-# -----------------
-#
-# Functions and commands that deal with cit's configuration. 
-#  
-#===================================================================================================
-
-#===================================================================================================
-# cit_init
-#===================================================================================================
-def cit_init(global_config, stdin):
-    cit_file_name, config = load_cit_local_config(os.getcwd())
-    
-    print 'Configuring jobs for feature branches: %s' % cit_file_name
-    print 
-    
-    updated = 0
-    while True:
-        sys.stdout.write('Source job (empty to exit):      ')
-        source_job = stdin.readline().strip()
-        if not source_job:
-            break
-        
-        sys.stdout.write('Feature job (shh, use $name):    ')
-        fb_job = stdin.readline().strip()
-        if not fb_job:
-            break
-        
-        fb_data = {
-            'source-job' : source_job,
-            'feature-branch-job' : fb_job, 
-        }
-        config.setdefault('jobs', []).append(fb_data)
-        updated += 1
-        print 'Done! Next?'
-        print
-        
-    print 
-    if updated:
-        f = file(cit_file_name, 'w')
-        f.write(yaml.dump(config, default_flow_style=False))
-        f.close()
-        print 'Done! Configured %d job(s)!' % updated
-    else:
-        print 'Abort? Okaay.'
-    
-    
-#===================================================================================================
-# cit_install
-#===================================================================================================
-def cit_install(global_config_file, stdin):
-    print '=' * 60
-    print 'Configuration'
-    print '=' * 60
-    sys.stdout.write('- Enter Jenkins URL:   ')
-    jenkins_url = stdin.readline().strip()
-    if not jenkins_url.startswith('http'):
-        jenkins_url = 'http://' + jenkins_url
-        
-    print
-    print 'Checking Jenkins server...',
-    try:
-        Jenkins(jenkins_url)
-    except urllib2.URLError, e:
-        print 'ERROR (%s)' % e
-    else:
-        print 'OK'
-    
-    config = {
-    'jenkins' : {
-        'url' : jenkins_url,
-        }
-    }
-    
-    f = file(global_config_file, 'w')
-    f.write(yaml.dump(config, default_flow_style=False))
-    f.close()
-    
-
-#===================================================================================================
-# get_configured_jobs
-#===================================================================================================
-def get_configured_jobs(branch, job_config):  
-    for job_config in job_config['jobs']:
-        job_name = job_config['source-job'] 
-        new_job_name = job_config['feature-branch-job'].replace('$name', branch)
-        yield job_name, new_job_name
-        
-        
-#===================================================================================================
-# load_cit_local_config
-#===================================================================================================
-def load_cit_local_config(from_dir):
-    tries = 0
-    max_tries = 20
-    while True:
-        gitdir = os.path.join(from_dir, '.git')
-        if os.path.isdir(gitdir):
-            break
-        from_dir = os.path.dirname(from_dir)
-        
-        tries += 1    
-        if tries >= max_tries:
-            raise RuntimeError('could not find .git directory')
-        
-    cit_file_name = os.path.join(from_dir, '.cit.yaml')
-    
-    config = {}
-    if os.path.isfile(cit_file_name):
-        loaded_config = yaml.load(file(cit_file_name).read()) or {}
-        config.update(loaded_config)
-        
-    return cit_file_name, config
-
-
-#===================================================================================================
-# main
-#===================================================================================================
-def main(argv, global_config_file=None, stdin=None):
-    # default values
-    if global_config_file is None:
-        global_config_file = os.path.join(os.path.dirname(__file__), 'citconfig.yaml')
-        
-    if stdin is None:
-        stdin = sys.stdin
-        
-    # --install option: used to initialize configuration
-    if '--install' in argv:
-        cit_install(global_config_file, stdin)
-        return RETURN_CODE_OK
-    
-    # read global config
-    if not os.path.isfile(global_config_file):
-        print >> sys.stderr, 'could not find cit config file at: %s' % global_config_file
-        return RETURN_CODE_CONFIG_NOT_FOUND
-        
-    global_config = yaml.load(file(global_config_file).read()) 
-    
-    # command dispatch
-    if len(argv) <= 1:
-        print_help() 
-        return RETURN_CODE_OK
-    elif argv[1] == 'init':
-        cit_init(global_config, stdin)
-        return RETURN_CODE_OK
-    elif argv[1] in ('add', 'start', 'rm'):
-        if len(argv) > 2:
-            branch = argv[2]
-        else:
-            branch = None
-        if argv[1] == 'add':
-            cit_add(branch, global_config)
-        elif argv[1] == 'start':
-            cit_start(branch, global_config)
-        elif argv[1] == 'rm':
-            cit_rm(branch, global_config)
-        return RETURN_CODE_OK
-    else:
-        print 'Unknown command: "%s"' % argv[1]
-        print_help()
-        return RETURN_CODE_UNKNOWN_COMMAND
-
-    return RETURN_CODE_OK
-
-
-# Error Codes --------------------------------------------------------------------------------------
-
-RETURN_CODE_OK = 0 
-RETURN_CODE_UNKNOWN_COMMAND = 2
-RETURN_CODE_CONFIG_NOT_FOUND = 3 
-
-
-#===================================================================================================
-# print_help
-#===================================================================================================
-def print_help():
-    print 'Commands:'    
-    print     
-    print '    init                   configures jobs for feature branches for this git repo'
-    print '    add [BRANCH]           add a new feature branch job to Jenkins'
-    print '    start [BRANCH]         starts a new build for the given feature branch'
-    print '    rm [BRANCH]            removes job for feature branches given'
-    print    
-
-
-#===================================================================================================
-# general utilities
-# -----------------
-# 
-# General utilities that didn't fit in any other category. 
-#
-#===================================================================================================
-
-#===================================================================================================
-# chdir
-#===================================================================================================
-@contextlib.contextmanager        
-def chdir(cwd):
-    old_cwd = os.getcwd()
-    if os.path.isfile(cwd):
-        cwd = os.path.dirname(cwd)
-    os.chdir(cwd)
-    yield
-    os.chdir(old_cwd)
-    
-    
-#===================================================================================================
-# check_output
-#===================================================================================================
-def check_output(*args, **kwargs):
-    '''
-    Support subprocess.check_output for Python < 2.7
-    '''
-    try:
-        return subprocess.check_output(*args, **kwargs)
-    except AttributeError:
-        kwargs['stdout'] = subprocess.PIPE
-        popen = subprocess.Popen(*args, **kwargs)
-        stdout, stderr = popen.communicate()
-        if popen.returncode != 0:
-            raise subprocess.CalledProcessError
-        return stdout
-
-#===================================================================================================
-# main
-#===================================================================================================
-if __name__ == '__main__':
-    sys.exit(main(sys.argv)) 
+from __future__ import with_statement
+
+#===================================================================================================
+# configure_submodules_path
+#===================================================================================================
+def configure_submodules_path():
+    '''
+    Configures sys.path to detect our submodule dependencies. Must be called before trying to do
+    any other imports.
+    '''
+    import sys, os
+    
+    directory = os.path.abspath(os.path.dirname(__file__))
+    sys.path.insert(0, os.path.join(directory, 'jenkinsapi'))
+    sys.path.insert(0, os.path.join(directory, 'pyyaml', 'lib'))
+    
+configure_submodules_path()
+
+#===================================================================================================
+# imports
+#
+# Only cheap modules are imported here: the others (http client, yaml, xml, etc) are imported by 
+# the functions that need them, so commands that don't use them don't pay for their import time.
+#===================================================================================================
+import contextlib
+import re
+import os
+import sys
+
+#===================================================================================================
+# cit commands
+# ------------
+#
+# Functions below handle the actual "meat" of cit's commands.
+#  
+#===================================================================================================
+
+#===================================================================================================
+# create_feature_branch_job
+#===================================================================================================
+def create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email, rules=None,
+                              source_config=None, dry_run=False, keep_email=False):
+    '''
+    Creates (or updates) the feature job `new_job_name` based on the configuration of `job_name`.
+    
+    The source configuration is fetched once and transformed locally, and the new job is then
+    created (or updated) with its final configuration in a single request. Existing jobs are only
+    updated if their current configuration differs from the new one. Changes are recorded in the
+    client's SnapshotStore, if it has one.
+    
+    :param rules: FeatureBranchRules used to transform the source configuration.
+    :param source_config: configuration of `job_name`, if already known.
+    :param dry_run: only finds out what would be done, without changing the job.
+    :param keep_email: if the job exists, it keeps the email it was configured with (see 
+        `get_feature_job_email`), and `user_email` is only used if it has none.
+    :return: tuple (status, warnings): status is one of 'CREATED', 'UPDATED' or 'UNCHANGED', and 
+        warnings is a list of messages about problems found while configuring the new job.
+    '''
+    if source_config is None:
+        with trace('job', 'fetch source', job=job_name):
+            source_config = jenkins.get_source_config(job_name)
+    with trace('job', 'transform', job=new_job_name):
+        config, warnings = make_feature_branch_config(source_config, branch, user_email, rules, 
+                                                      jenkins.templates)
+    
+    if not jenkins.might_have_job(new_job_name, refresh=False):
+        if dry_run:
+            return 'CREATED', warnings
+        try:
+            with trace('job', 'create', job=new_job_name):
+                jenkins.create_job(new_job_name, config)
+            if jenkins.snapshots is not None:
+                jenkins.snapshots.record(new_job_name, branch, None, config, source_config, job_name)
+            return 'CREATED', warnings
+        except JenkinsError, e:
+            # job index is outdated: the job has been created meanwhile
+            if e.status != 400:
+                raise
+    
+    with trace('job', 'compare', job=new_job_name) as event:
+        try:
+            current_config = jenkins.get_job_config(new_job_name)
+        except UnknownJob:
+            status = 'CREATED'
+        else:
+            email = get_feature_job_email(current_config) if keep_email else None
+            if email is not None and email != user_email:
+                config, warnings = make_feature_branch_config(source_config, branch, email, rules, 
+                                                              jenkins.templates)
+            if normalize_config(current_config) == normalize_config(config):
+                status = 'UNCHANGED'
+            else:
+                status = 'UPDATED'
+        event['status'] = status
+        
+    if not dry_run and status != 'UNCHANGED':
+        with trace('job', 'create' if status == 'CREATED' else 'update', job=new_job_name):
+            if status == 'CREATED':
+                jenkins.create_job(new_job_name, config)
+                current_config = None
+            else:
+                jenkins.update_job_config(new_job_name, config)
+        if jenkins.snapshots is not None:
+            jenkins.snapshots.record(new_job_name, branch, current_config, config, source_config, job_name)
+    
+    return status, warnings
+        
+        
+#===================================================================================================
+# make_feature_branch_config
+#===================================================================================================
+def make_feature_branch_config(source_config, branch, user_email, rules=None, templates=None):
+    '''
+    Returns the configuration for a feature job of the given branch, based on the configuration
+    xml of its source job. Transforming an already transformed configuration does not change it.
+    
+    :param rules: FeatureBranchRules used to transform the configuration; defaults to the rules
+        in DEFAULT_RULES.
+    :param templates: TemplateCache: if given, the configuration is made from the cached template 
+        of the source configuration, only replacing the branch name and email in it.
+    :return: tuple (config, warnings), with warnings being a list of messages about problems found
+        while transforming the configuration.
+    '''
+    if rules is None:
+        rules = get_default_rules()
+    user_email = user_email or ''
+    
+    # the result of "set" rules with "$text" depends on the values found in the configuration, so 
+    # templates can't be used if they are already there; quotes are escaped differently in text 
+    # and attributes
+    use_template = templates is not None and not re.search(r'[$"\n]', branch + user_email) and \
+        branch not in source_config and (not user_email or user_email not in source_config)
+    if use_template:
+        template, warnings = templates.get_template(source_config, rules)
+        return fill_feature_branch_template(template, branch, user_email), warnings
+    
+    return _transform_config(source_config, {'name' : branch, 'email' : user_email}, rules)
+        
+
+def _transform_config(source_config, variables, rules):
+    ET = import_element_tree()
+    tree = ET.fromstring(source_config)
+    warnings = rules.apply(tree, variables)
+    return ET.tostring(tree), warnings
+        
+        
+
+        
+#===================================================================================================
+# make_feature_branch_template
+#===================================================================================================
+# placeholders for the variables in templates made by make_feature_branch_template 
+TEMPLATE_VARIABLES = {'name' : '@@cit-name@@', 'email' : '@@cit-email@@'}
+
+def make_feature_branch_template(source_config, rules):
+    '''
+    Transforms the configuration of a source job with placeholders in place of the branch name 
+    and email, so feature job configurations can be made from it by `fill_feature_branch_template`
+    without transforming the configuration again.
+    
+    :return: tuple (template, warnings).
+    '''
+    return _transform_config(source_config, TEMPLATE_VARIABLES, rules)
+
+
+#===================================================================================================
+# fill_feature_branch_template
+#===================================================================================================
+def fill_feature_branch_template(template, branch, user_email):
+    '''
+    Replaces the placeholders in a template made by `make_feature_branch_template` by the given 
+    branch name and email, escaped for xml (which must not contain quotes).
+    '''
+    from xml.sax.saxutils import escape
+    for name, value in [('name', branch), ('email', user_email)]:
+        placeholder = TEMPLATE_VARIABLES[name]
+        if not value:
+            # elements left empty are written as "<tag />"
+            template = re.sub(r'<([^<>/]+)>%s</[^<>]+>' % placeholder, r'<\1 />', template)
+        template = template.replace(placeholder, escape(value))
+    return template
+
+
+#===================================================================================================
+# get_feature_job_email
+#===================================================================================================
+def get_feature_job_email(config):
+    '''
+    Returns the email a feature job was configured with (its mail recipients, see DEFAULT_RULES),
+    or None if its configuration doesn't send mails.
+    '''
+    ET = import_element_tree()
+    recipients = ET.fromstring(config).find('.//hudson.tasks.Mailer/recipients')
+    if recipients is None:
+        return None
+    return recipients.text or ''
+
+
+#===================================================================================================
+# normalize_config
+#===================================================================================================
+def normalize_config(config):
+    '''
+    Returns a canonical form of the given configuration xml, so configurations can be compared
+    regardless of formatting differences (indentation, xml declaration, empty elements, etc).
+    '''
+    ET = import_element_tree()
+    tree = ET.fromstring(config)
+    for elem in tree.getiterator():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        elem.tail = None
+    return ET.tostring(tree)
+    
+    
+#===================================================================================================
+# cit_add
+#===================================================================================================
+def cit_add(branch, global_config):
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None:
+        branch = get_git_branch(cit_file_name)
+    
+    user_name, user_email = get_git_user(cit_file_name)
+    rules = get_feature_branch_rules(job_config)
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        
+        def add_job(names):
+            job_name, new_job_name = names
+            return create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email, rules)
+        
+        jobs = get_configured_jobs(branch, job_config)
+        if use_script_backend(global_config):
+            results = add_feature_jobs_with_script(jenkins, jobs, branch, user_email, rules, 
+                                                   get_workers(global_config))
+        else:
+            results = run_concurrently(add_job, jobs, get_workers(global_config))
+        failures = 0
+        for (job_name, new_job_name), result, error in results:
+            if error is not None:
+                print '%s => %s (%s)' % (job_name, new_job_name, format_error(error))
+                failures += 1
+                continue
+            status, warnings = result
+            print '%s => %s (%s)' % (job_name, new_job_name, status)
+            for warning in warnings:
+                print '  warning: %s' % warning
+        return failures
+        
+        
+#===================================================================================================
+# add_feature_jobs_with_script
+#===================================================================================================
+def add_feature_jobs_with_script(jenkins, jobs, branch, user_email, rules, workers):
+    '''
+    Creates or updates the feature jobs like `create_feature_branch_job`, but with a single script
+    for all jobs (see `run_with_script`).
+    
+    :return: iterator of ((job_name, new_job_name), (status, warnings), error).
+    '''
+    all_warnings = {}
+    
+    def add_operation(names):
+        job_name, new_job_name = names
+        operation, all_warnings[new_job_name] = make_add_operation(jenkins, job_name, new_job_name, 
+                                                                   branch, user_email, rules)
+        return operation
+    
+    for names, status, error in run_with_script(jenkins, jobs, add_operation, workers):
+        if error is None:
+            yield names, (status, all_warnings[names[1]]), None
+        else:
+            yield names, None, error
+        
+        
+#===================================================================================================
+# make_add_operation
+#===================================================================================================
+def make_add_operation(jenkins, job_name, new_job_name, branch, user_email, rules):
+    '''
+    Prepares the operation of the script backend (see `JenkinsClient.run_batch`) which creates or
+    updates a feature job like `create_feature_branch_job`.
+    
+    :return: tuple (operation, warnings).
+    '''
+    with trace('job', 'fetch source', job=job_name):
+        source_config = jenkins.get_source_config(job_name)
+    with trace('job', 'transform', job=new_job_name):
+        config, warnings = make_feature_branch_config(source_config, branch, user_email, rules, 
+                                                      jenkins.templates)
+    operation = {'action' : 'add', 'job' : new_job_name, 'config' : config, 
+                 'branch' : branch, 'source-job' : job_name, 'base' : source_config}
+    return operation, warnings
+        
+        
+#===================================================================================================
+# cit_rm
+#===================================================================================================
+def cit_rm(branch, global_config):
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None:
+        branch = get_git_branch(cit_file_name)
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        
+        def rm_operation(names):
+            (job_name, _), new_job_name = names
+            # the script finds out if the job exists itself, so the index is not refreshed for it
+            if not jenkins.might_have_job(new_job_name, refresh=False):
+                return 'NOT FOUND'
+            return {'action' : 'remove', 'job' : new_job_name, 'branch' : branch, 'source-job' : job_name}
+        
+        jobs = [((job_name, branch), new_job_name) 
+                for job_name, new_job_name in get_configured_jobs(branch, job_config)]
+        if use_script_backend(global_config) and '$name' not in get_folder_pattern(job_config):
+            results = run_with_script(jenkins, jobs, rm_operation, get_workers(global_config))
+        else:
+            results = remove_feature_jobs(jenkins, job_config, jobs, get_workers(global_config))
+        return print_job_statuses(results)
+        
+        
+#===================================================================================================
+# remove_feature_job
+#===================================================================================================
+def remove_feature_job(jenkins, new_job_name, branch=None, job_name=None, config=None):
+    '''
+    Removes the feature job, recording its configuration in the client's SnapshotStore (if it has
+    one) so it can be restored by `cit_rollback`.
+    
+    :param branch: the branch of the job, recorded with it.
+    :param job_name: the source job of the job, recorded with it.
+    :param config: the configuration cit last wrote for the job (see `SnapshotStore.get_configs`),
+        recorded instead of fetching the job's configuration from Jenkins.
+    :return: 'REMOVED', or 'NOT FOUND' if the job doesn't exist.
+    '''
+    if not jenkins.might_have_job(new_job_name):
+        return 'NOT FOUND'
+    try:
+        if jenkins.snapshots is not None and config is None:
+            config = jenkins.get_job_config(new_job_name)
+        jenkins.delete_job(new_job_name)
+    except UnknownJob:
+        return 'NOT FOUND'
+    if config is not None:
+        jenkins.snapshots.record(new_job_name, branch, config, None, source_job=job_name)
+    return 'REMOVED'
+        
+        
+#===================================================================================================
+# cit_prune
+#===================================================================================================
+def cit_prune(global_config, dry_run=False, remote=None):
+    '''
+    Removes the feature jobs of branches that don't exist anymore.
+    
+    The feature jobs of this repository are found by matching the names of all jobs in Jenkins
+    against the `feature-branch-job` patterns of .cit.yaml; their branches are compared with the
+    branches in the local git repository (local and remote-tracking branches), or with the 
+    branches in the given remote.
+    
+    :param dry_run: only lists the jobs that would be removed.
+    :param remote: if given, the name of the remote to ask for its branches (`git ls-remote`).
+    :return: the number of jobs that failed to be removed.
+    '''
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    branches = get_git_branches(cit_file_name, remote)
+    if not branches:
+        # don't take an empty list of branches as a reason to remove all feature jobs
+        print >> sys.stderr, 'could not find any branches in the git repository'
+        return 1
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        job_names = sorted(get_feature_job_infos(jenkins, job_config, 'name,color'))
+        feature_jobs = find_feature_branch_jobs(job_names, job_config, branches)
+        orphans = [((None, branch), new_job_name) for new_job_name, branch in sorted(feature_jobs.iteritems())
+                   if branch not in branches]
+        
+        if dry_run:
+            return print_job_statuses((job, 'TO REMOVE', None) for job in orphans)
+        
+        return print_job_statuses(remove_feature_jobs(jenkins, job_config, orphans, get_workers(global_config), 
+                                                      job_names))
+    
+    
+#===================================================================================================
+# cit_sync
+#===================================================================================================
+def cit_sync(global_config, plan_only=False, remote=None):
+    '''
+    Brings the feature jobs of all branches in Jenkins in line with .cit.yaml: feature jobs of 
+    existing branches are created or updated with their configuration from .cit.yaml, and feature 
+    jobs of branches that don't exist anymore are removed. Jobs already up to date are not touched.
+    
+    Branches are tracked once they have any feature job (see `cit_add`). Feature jobs are the jobs
+    cit recorded creating for the source jobs of .cit.yaml (in the client's SnapshotStore), with 
+    their branch, and the jobs found like in `cit_prune`; recorded jobs which are not named like 
+    the feature jobs of their branch anymore (after changing "feature-branch-job" or "folder") are 
+    removed too. Existing jobs keep the email they were configured with (so the jobs of other users
+    keep notifying them), and jobs created are configured for the current git user.
+    
+    :param plan_only: only prints the changes, without applying them.
+    :param remote: if given, the name of the remote to ask for its branches (`git ls-remote`).
+    :return: the number of jobs that failed to be synchronized.
+    '''
+    import itertools
+    
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    branches = get_git_branches(cit_file_name, remote)
+    if not branches:
+        # don't take an empty list of branches as a reason to remove all feature jobs
+        print >> sys.stderr, 'could not find any branches in the git repository'
+        return 1
+    
+    user_name, user_email = get_git_user(cit_file_name)
+    rules = get_feature_branch_rules(job_config)
+    workers = get_workers(global_config)
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        job_names = sorted(get_feature_job_infos(jenkins, job_config, 'name,color'))
+        # feature job name => (branch, source job name or None)
+        feature_jobs = dict((new_job_name, (branch, None)) for new_job_name, branch 
+                            in find_feature_branch_jobs(job_names, job_config, branches).iteritems())
+        if jenkins.snapshots is not None:
+            source_jobs = set(job['source-job'] for job in job_config['jobs'])
+            listed = set(job_names)
+            for new_job_name, (branch, job_name) in jenkins.snapshots.get_jobs().iteritems():
+                # jobs outside the folders just listed may not exist anymore
+                if job_name in source_jobs and (new_job_name in listed or jenkins.might_have_job(new_job_name)):
+                    feature_jobs[new_job_name] = (branch, job_name)
+        tracked_branches = sorted(set(branch for branch, _ in feature_jobs.itervalues()) & branches)
+        
+        # items are ((source job name, branch), new job name)
+        changes = []
+        for branch in tracked_branches:
+            for job_name, new_job_name in get_configured_jobs(branch, job_config):
+                changes.append(((job_name, branch), new_job_name))
+        configured = set(new_job_name for _, new_job_name in changes)
+        removals = []
+        for new_job_name, (branch, job_name) in sorted(feature_jobs.iteritems()):
+            if new_job_name not in configured:
+                if job_name is None:
+                    job_name = dict((new, source) for source, new in get_configured_jobs(branch, job_config)).get(new_job_name)
+                removals.append(((job_name, branch), new_job_name))
+        removal_names = set(new_job_name for _, new_job_name in removals)
+        if plan_only:
+            changes += removals
+                
+        # each source configuration is fetched only once, for all branches
+        source_job_names = sorted(set(job_name for (job_name, _), new_job_name in changes 
+                                      if new_job_name not in removal_names))
+        source_configs = {}
+        failures = 0
+        for job_name, config, error in run_concurrently(jenkins.get_source_config, source_job_names, workers):
+            if error is not None:
+                print '%s (%s)' % (job_name, format_error(error))
+                failures += 1
+            else:
+                source_configs[job_name] = config
+        
+        def sync_job(change):
+            (job_name, branch), new_job_name = change
+            if new_job_name in removal_names:
+                return 'REMOVED', []
+            if job_name not in source_configs:
+                raise JenkinsError('could not get the configuration of %s' % job_name)
+            return create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email, rules,
+                                             source_config=source_configs[job_name], dry_run=plan_only,
+                                             keep_email=True)
+            
+        counts = dict.fromkeys(['CREATED', 'UPDATED', 'REMOVED', 'UNCHANGED'], 0)
+        results = run_concurrently(sync_job, changes, workers)
+        if not plan_only:
+            # jobs already gone count as removed too
+            removed = ((item, ('REMOVED', []), error) 
+                       for item, _, error in remove_feature_jobs(jenkins, job_config, removals, workers, 
+                                                                 job_names))
+            results = itertools.chain(results, removed)
+        for (_, new_job_name), result, error in results:
+            if error is not None:
+                print '%s (%s)' % (new_job_name, format_error(error))
+                failures += 1
+                continue
+            status, warnings = result
+            counts[status] += 1
+            if status != 'UNCHANGED':
+                if plan_only:
+                    status = 'TO ' + status[:-1]
+                print '%s (%s)' % (new_job_name, status)
+                for warning in warnings:
+                    print '  warning: %s' % warning
+                    
+        if plan_only:
+            summary = '%(CREATED)d to create, %(UPDATED)d to update, %(REMOVED)d to remove, %(UNCHANGED)d unchanged'
+        else:
+            summary = '%(CREATED)d created, %(UPDATED)d updated, %(REMOVED)d removed, %(UNCHANGED)d unchanged'
+        print summary % counts
+        return failures
+    
+    
+#===================================================================================================
+# find_feature_branch_jobs
+#===================================================================================================
+def find_feature_branch_jobs(job_names, job_config, branches=None):
+    '''
+    Finds which of the given jobs are feature jobs, by matching their names against the 
+    `feature-branch-job` patterns (in the feature jobs folder) of the given .cit.yaml config.
+    
+    A job may match more than one pattern, with a different branch for each (with the patterns 
+    "proj-$name" and "proj-$name-linux", "proj-feat-linux" is the job of either "feat-linux" or 
+    "feat"). It is then given the branch which exists, if any, or else the one with most jobs.
+    
+    :param branches: the existing branches, if known.
+    :return: dict mapping the name of each feature job to its branch.
+    '''
+    source_jobs = set(job['source-job'] for job in job_config['jobs'])
+    folder = get_folder_pattern(job_config)
+    patterns = []
+    for job in job_config['jobs']:
+        feature_job = job['feature-branch-job']
+        if folder:
+            feature_job = folder + '/' + feature_job
+        parts = [re.escape(part) for part in feature_job.split('$name')]
+        if len(parts) > 1:
+            # branches can't have "/", and all occurrences of $name have the same branch
+            pattern = parts[0] + '(?P<name>[^/]+)' + '(?P=name)'.join(parts[1:])
+            patterns.append(re.compile('^%s$' % pattern))
+            
+    candidates = {}
+    counts = {}
+    for job_name in job_names:
+        if job_name in source_jobs:
+            continue
+        for pattern in patterns:
+            match = pattern.match(job_name)
+            if match is not None:
+                branch = match.group('name')
+                if branch not in candidates.setdefault(job_name, []):
+                    candidates[job_name].append(branch)
+                    counts[branch] = counts.get(branch, 0) + 1
+                    
+    result = {}
+    for job_name, job_branches in candidates.iteritems():
+        result[job_name] = max(job_branches, key=lambda branch: (
+            branches is not None and branch in branches, counts[branch], -job_branches.index(branch)))
+    return result
+
+
+#===================================================================================================
+# cit_rollback
+#===================================================================================================
+def cit_rollback(branch, global_config, snapshot_id=None, all_branches=False, list_only=False):
+    '''
+    Restores the feature jobs of the given branch (or all branches) to their configuration before 
+    the last change made by cit, or before the given snapshot (undoing it and all later changes).
+    Jobs created by those changes are removed, and jobs removed by them are created again; jobs 
+    removed without cit (which the snapshots don't know about) are not.
+    
+    :param list_only: only lists the snapshots of the branch.
+    :return: the number of jobs that failed to be restored.
+    '''
+    import time
+    
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None and not all_branches:
+        branch = get_git_branch(cit_file_name)
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        store = jenkins.snapshots
+        if store is None:
+            print >> sys.stderr, 'snapshots are disabled ("snapshot-dir" in the global config)'
+            return 1
+        
+        # the snapshots with jobs of the branch (or repository), with only those jobs: the jobs of
+        # its source jobs, and the jobs named like its feature jobs
+        source_jobs = set(job['source-job'] for job in job_config['jobs'])
+        if all_branches:
+            def select(jobs):
+                feature_jobs = find_feature_branch_jobs(jobs, job_config)
+                return dict((name, change) for name, change in jobs.iteritems() 
+                            if change[3] in source_jobs or name in feature_jobs)
+        else:
+            new_job_names = set(new_job_name for _, new_job_name in get_configured_jobs(branch, job_config))
+            def select(jobs):
+                return dict((name, change) for name, change in jobs.iteritems() 
+                            if (change[3] in source_jobs and change[0] == branch) or name in new_job_names)
+        snapshots = []
+        for current_id, snapshot in store.get_snapshots():
+            jobs = select(snapshot['jobs'])
+            if jobs:
+                snapshots.append((current_id, snapshot['time'], jobs))
+                
+        if list_only:
+            for current_id, timestamp, jobs in snapshots:
+                branches = sorted(set(change[0] for change in jobs.itervalues()))
+                print '%s  %s  %d jobs (%s)' % (current_id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), 
+                                                len(jobs), ', '.join(branches))
+            return 0
+        
+        ids = [current_id for current_id, _, _ in snapshots]
+        if snapshot_id is None and ids:
+            snapshot_id = ids[-1]
+        if snapshot_id not in ids:
+            print >> sys.stderr, 'snapshot not found: %s' % (snapshot_id or 'no snapshots')
+            return 1
+        
+        # each job goes back to its state before the first of the snapshots that changed it
+        targets = {}
+        latest = {}
+        for _, _, jobs in reversed(snapshots[ids.index(snapshot_id):]):
+            targets.update(jobs)
+            for name, change in jobs.iteritems():
+                latest.setdefault(name, change)
+            
+        def restore_job(item):
+            branch, new_job_name = item
+            _, before_sha, _, job_name = targets[new_job_name]
+            try:
+                current_config = jenkins.get_job_config(new_job_name)
+            except UnknownJob:
+                current_config = None
+            if before_sha is None:
+                if current_config is None:
+                    return 'UNCHANGED'
+                store.record(new_job_name, branch, current_config, None, source_job=job_name)
+                jenkins.delete_job(new_job_name)
+                return 'REMOVED'
+            if current_config is None and latest[new_job_name][2] is not None:
+                # removed without cit, probably on purpose
+                return 'NOT FOUND'
+            
+            config = store.get(before_sha)
+            if current_config is not None and normalize_config(current_config) == normalize_config(config):
+                return 'UNCHANGED'
+            store.record(new_job_name, branch, current_config, config, config, job_name)
+            if current_config is None:
+                jenkins.create_job(new_job_name, config)
+            else:
+                jenkins.update_job_config(new_job_name, config)
+            return 'RESTORED'
+        
+        jobs = [(change[0], new_job_name) for new_job_name, change in sorted(targets.iteritems())]
+        return print_job_statuses(run_concurrently(restore_job, jobs, get_workers(global_config)))
+    
+    
+#===================================================================================================
+# cit_start
+#===================================================================================================
+def cit_start(branches, global_config, all_branches=False):
+    '''
+    Starts builds of the feature jobs of the given branches (or the current branch, if none is 
+    given), skipping jobs which are already running or waiting in the build queue.
+    
+    The state of all jobs is read with a single request, so starting the jobs of many branches 
+    only needs one more request per job actually started.
+    
+    :param all_branches: starts the feature jobs of all branches which have any feature job.
+    :return: the number of jobs that failed to start.
+    '''
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if not branches and not all_branches:
+        branches = [get_git_branch(cit_file_name)]
+    
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        script_backend = use_script_backend(global_config)
+        if script_backend and not all_branches:
+            # the script finds out the state of the jobs itself
+            job_infos = {}
+        else:
+            job_infos = get_feature_job_infos(jenkins, job_config, 'name,color,inQueue', 
+                                              None if all_branches else branches)
+        
+        if all_branches:
+            feature_jobs = find_feature_branch_jobs(sorted(job_infos), job_config)
+            branches = sorted(set(feature_jobs.itervalues()))
+        
+        jobs = []
+        for branch in branches:
+            for names in get_configured_jobs(branch, job_config):
+                if names not in jobs:
+                    jobs.append(names)
+        
+        def start_job(names):
+            _, new_job_name = names
+            return start_feature_job(jenkins, new_job_name, job_infos)
+        
+        def start_operation(names):
+            _, new_job_name = names
+            return {'action' : 'start', 'job' : new_job_name}
+        
+        if script_backend:
+            results = run_with_script(jenkins, jobs, start_operation, get_workers(global_config))
+        else:
+            results = run_concurrently(start_job, jobs, get_workers(global_config))
+        return print_job_statuses(results)
+ 
+ 
+#===================================================================================================
+# start_feature_job
+#===================================================================================================
+def start_feature_job(jenkins, new_job_name, job_infos):
+    '''
+    Starts a build of the given job, unless it is already running or waiting in the queue.
+    
+    :param job_infos: dict with the "color" and "inQueue" fields of each job, by name.
+    :return: 'STARTED', 'RUNNING', 'QUEUED' or 'NOT FOUND'.
+    '''
+    job_info = job_infos.get(new_job_name)
+    if job_info is None:
+        return 'NOT FOUND'
+    elif is_running(job_info):
+        return 'RUNNING'
+    elif job_info.get('inQueue'):
+        return 'QUEUED'
+    else:
+        jenkins.build_job(new_job_name)
+        return 'STARTED'
+ 
+ 
+#===================================================================================================
+# cit_workspace
+#===================================================================================================
+WORKSPACE_COMMANDS = ('add', 'start', 'rm')
+
+def cit_workspace(command, root, branch, global_config):
+    '''
+    Runs "add", "start" or "rm" for all git repositories with a .cit.yaml file under `root` at 
+    once: the feature jobs of all repositories are handled by a single pool of workers, sharing one
+    client for each Jenkins server, and the results are reported for each repository. The jobs of
+    each repository are removed together, like `cit_rm` does (with the folder of their branch), and
+    the jobs of each server with the script backend are changed by a single script for all 
+    repositories.
+    
+    :param branch: the branch of the feature jobs, or None for the branch checked out in each 
+        repository.
+    :return: the number of jobs that failed (including the jobs of unknown servers).
+    '''
+    import itertools
+    
+    # one plan for all repositories, with items (repository, server, job name, new job name)
+    plan = []
+    for repo_dir in find_cit_repositories(root):
+        cit_file_name, job_config = load_cit_local_config(repo_dir, get_cache_dir(global_config))
+        repo = {
+            'name' : os.path.relpath(repo_dir, root),
+            'branch' : branch or get_git_branch(cit_file_name),
+        }
+        repo['folder'] = get_feature_folder(repo['branch'], job_config)
+        repo['config'] = job_config
+        if command == 'add':
+            repo['email'] = get_git_user(cit_file_name)[1]
+            repo['rules'] = get_feature_branch_rules(job_config)
+        jobs = job_config.get('jobs', [])
+        for job, (job_name, new_job_name) in zip(jobs, get_configured_jobs(repo['branch'], job_config)):
+            plan.append((repo, job.get('server'), job_name, new_job_name))
+            
+    clients = {}
+    job_infos = {}
+    listed_folders = set()
+    script_servers = set()
+    try:
+        for repo, server_name, _, _ in plan:
+            if server_name not in clients:
+                try:
+                    server_config = get_server_config(global_config, server_name)
+                except KeyError:
+                    # reported for each of its jobs, without stopping the other repositories
+                    clients[server_name] = None
+                    continue
+                clients[server_name] = create_jenkins_client(server_config)
+                job_infos[server_name] = {}
+                if use_script_backend(server_config):
+                    script_servers.add(server_name)
+            if clients[server_name] is None:
+                continue
+            # the jobs of each folder with feature jobs are fetched once (the script finds out the 
+            # state of the jobs itself)
+            if command == 'start' and server_name not in script_servers and \
+                    (server_name, repo['folder']) not in listed_folders:
+                listed_folders.add((server_name, repo['folder']))
+                for job in clients[server_name].get_jobs('name,color,inQueue', repo['folder']):
+                    job_infos[server_name][job['name']] = job
+        
+        workers = get_workers(global_config)
+        
+        def get_client(server_name):
+            if clients[server_name] is None:
+                raise JenkinsError('unknown server in .cit.yaml: %s' % server_name)
+            return clients[server_name]
+        
+        def run(item):
+            repo, server_name, job_name, new_job_name = item
+            jenkins = get_client(server_name)
+            if command == 'add':
+                return create_feature_branch_job(jenkins, job_name, new_job_name, repo['branch'], 
+                                                 repo['email'], repo['rules'])
+            else:
+                return start_feature_job(jenkins, new_job_name, job_infos[server_name]), []
+            
+        def rm_jobs(items):
+            # the jobs of a repository are removed together, so the folder of its branch is removed
+            # at once (see `remove_feature_jobs`)
+            repo, server_name, _, _ = items[0]
+            jobs = [((job_name, repo['branch']), new_job_name) for _, _, job_name, new_job_name in items]
+            return [(status, error) for _, status, error 
+                    in remove_feature_jobs(get_client(server_name), repo['config'], jobs, workers)]
+        
+        def rm_results(items):
+            # consecutive items of the same repository and server
+            groups = []
+            for item in items:
+                if groups and groups[-1][0][0] is item[0] and groups[-1][0][1] == item[1]:
+                    groups[-1].append(item)
+                else:
+                    groups.append([item])
+            for items, statuses, error in run_concurrently(rm_jobs, groups, workers):
+                if error is not None:
+                    statuses = [(None, error)] * len(items)
+                for item, (status, error) in zip(items, statuses):
+                    yield item, None if error is not None else (status, []), error
+        
+        # the jobs of each server with the script backend are changed by a single request, except
+        # for branch folders to remove (like `cit_rm` does)
+        script_items = [item for item in plan if item[1] in script_servers and 
+                        (command != 'rm' or '$name' not in get_folder_pattern(item[0]['config']))]
+        script_ids = set(id(item) for item in script_items)
+        other_items = [item for item in plan if id(item) not in script_ids]
+        all_warnings = {}
+        
+        def get_operation(item):
+            repo, server_name, job_name, new_job_name = item
+            jenkins = clients[server_name]
+            if command == 'add':
+                operation, all_warnings[id(item)] = make_add_operation(
+                    jenkins, job_name, new_job_name, repo['branch'], repo['email'], repo['rules'])
+                return operation
+            elif command == 'start':
+                return {'action' : 'start', 'job' : new_job_name}
+            # the script finds out if the job exists itself, so the index is not refreshed for it
+            if not jenkins.might_have_job(new_job_name, refresh=False):
+                return 'NOT FOUND'
+            return {'action' : 'remove', 'job' : new_job_name, 'branch' : repo['branch'], 
+                    'source-job' : job_name}
+        
+        def script_results():
+            for server_name in sorted(set(server_name for _, server_name, _, _ in script_items)):
+                items = [item for item in script_items if item[1] == server_name]
+                for item, status, error in run_with_script(clients[server_name], items, get_operation, workers):
+                    yield item, None if error is not None else (status, all_warnings.get(id(item), [])), error
+        
+        if command == 'rm':
+            results = rm_results(other_items)
+        else:
+            results = run_concurrently(run, other_items, workers)
+        if script_items:
+            # reported in the order of the plan, once all are done
+            done = dict((id(item), (result, error)) 
+                        for item, result, error in itertools.chain(script_results(), results))
+            results = ((item,) + done[id(item)] for item in plan)
+        
+        failures = 0
+        current_repo = None
+        for (repo, _, job_name, new_job_name), result, error in results:
+            if repo is not current_repo:
+                print '%s:' % repo['name']
+                current_repo = repo
+            if command == 'add':
+                description = '%s => %s' % (job_name, new_job_name)
+            else:
+                description = new_job_name
+            if error is not None:
+                print '%s (%s)' % (description, format_error(error))
+                failures += 1
+                continue
+            status, warnings = result
+            print '%s (%s)' % (description, status)
+            for warning in warnings:
+                print '  warning: %s' % warning
+        return failures
+    finally:
+        for jenkins in clients.itervalues():
+            if jenkins is not None:
+                jenkins.close()
+            
+            
+#===================================================================================================
+# find_cit_repositories
+#===================================================================================================
+def find_cit_repositories(root):
+    '''
+    Finds the git repositories with a .cit.yaml file under `root`, in a single walk through the
+    file system which doesn't enter git repositories or hidden directories.
+    
+    :return: sorted list of the repositories' directories.
+    '''
+    repos = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        if '.git' in dir_names or '.git' in file_names:
+            if '.cit.yaml' in file_names:
+                repos.append(dir_path)
+            dir_names[:] = []
+        else:
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+    return repos
+
+
+#===================================================================================================
+# cit_notify
+#===================================================================================================
+def cit_notify(branch, global_config):
+    '''
+    Notifies Jenkins that the given branch has been pushed, which starts builds right away instead 
+    of waiting for jobs to poll the repository.
+    
+    By default uses the git plugin's "notifyCommit" endpoint, which makes jobs building the 
+    repository's url poll it immediately; with "notify: build" in .cit.yaml the branch's feature 
+    jobs are started directly instead.
+    '''
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None:
+        branch = get_git_branch(cit_file_name)
+        
+    with contextlib.closing(create_jenkins_client(global_config)) as jenkins:
+        
+        if job_config.get('notify', 'commit') == 'build':
+            
+            def build_job(names):
+                _, new_job_name = names
+                if not jenkins.might_have_job(new_job_name):
+                    return 'NOT FOUND'
+                try:
+                    jenkins.build_job(new_job_name)
+                except UnknownJob:
+                    return 'NOT FOUND'
+                return 'STARTED'
+            
+            jobs = get_configured_jobs(branch, job_config)
+            return print_job_statuses(run_concurrently(build_job, jobs, get_workers(global_config)))
+        
+        else:
+            repository_url = job_config.get('repository-url') or get_git_remote_url(cit_file_name)
+            token = global_config['jenkins'].get('notify-token')
+            try:
+                messages = jenkins.notify_commit(repository_url, branch, token)
+            except JenkinsError, e:
+                print '%s (%s)' % (repository_url, format_error(e))
+                return 1
+            print '%s (NOTIFIED)' % repository_url
+            for message in messages:
+                print '  %s' % message
+            return 0
+        
+        
+#===================================================================================================
+# cit_watch
+#===================================================================================================
+WATCH_FIELDS = 'name,color,inQueue,lastBuild[number,building,result,timestamp,estimatedDuration]'
+WATCH_MIN_INTERVAL = 2.0
+WATCH_MAX_INTERVAL = 30.0
+
+def cit_watch(branch, global_config):
+    '''
+    Shows the status of the builds of the given branch's feature jobs as they change, until all of 
+    them are done.
+    
+    The status of all jobs is fetched with a single query on each refresh. Refreshes are made more
+    often while builds are changing (or about to finish), and less often while nothing changes.
+    
+    :return: the number of jobs that were not found or whose builds were not successful.
+    '''
+    import time
+    
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None:
+        branch = get_git_branch(cit_file_name)
+        
+    new_job_names = [new_job_name for _, new_job_name in get_configured_jobs(branch, job_config)]
+    
+    with contextlib.closing(create_jenkins_client(global_config, deadline=False)) as jenkins:
+        last_statuses = {}
+        interval = WATCH_MIN_INTERVAL
+        while True:
+            jobs = get_feature_job_infos(jenkins, job_config, WATCH_FIELDS, [branch])
+            now = time.time()
+            
+            changed = False
+            all_done = True
+            remaining_times = []
+            for new_job_name in new_job_names:
+                status, done, remaining_time = get_build_status(jobs.get(new_job_name), now)
+                if status != last_statuses.get(new_job_name):
+                    print new_job_name, '(%s)' % status
+                    last_statuses[new_job_name] = status
+                    changed = True
+                all_done = all_done and done
+                if remaining_time is not None:
+                    remaining_times.append(remaining_time)
+                    
+            if all_done:
+                break
+            
+            if changed:
+                interval = WATCH_MIN_INTERVAL
+            else:
+                interval = min(interval * 1.5, WATCH_MAX_INTERVAL)
+            # don't wait much longer than the next build is expected to take to finish  
+            if remaining_times:
+                interval = max(WATCH_MIN_INTERVAL, min(interval, min(remaining_times)))
+            sys.stdout.flush()
+            time.sleep(interval)
+            
+    return len([s for s in last_statuses.itervalues() if s not in ('SUCCESS', 'NOT BUILT')])
+
+
+#===================================================================================================
+# get_build_status
+#===================================================================================================
+def get_build_status(job_info, now):
+    '''
+    Returns the status of the last build of a job, given the job's data fetched with WATCH_FIELDS.
+    
+    :return: tuple (status, done, remaining time): status is "NOT FOUND", "NOT BUILT", "QUEUED", 
+        "BUILDING NN%" (progress according to the estimated duration) or the result of the last 
+        build; done is True if the job's build is finished, and remaining time is the estimated 
+        time (in seconds) for a build in progress to finish.
+    '''
+    if job_info is None:
+        return 'NOT FOUND', True, None
+    
+    if job_info.get('inQueue'):
+        return 'QUEUED', False, None
+    
+    last_build = job_info.get('lastBuild')
+    if last_build is None:
+        return 'NOT BUILT', True, None
+    
+    if last_build.get('building'):
+        elapsed = now - last_build.get('timestamp', 0) / 1000.0
+        estimated = last_build.get('estimatedDuration', -1) / 1000.0
+        if estimated <= 0:
+            return 'BUILDING', False, None
+        progress = int(max(0, min(99, elapsed * 100 / estimated)))
+        # report progress in steps of 10% so it doesn't change on every refresh 
+        return 'BUILDING %d%%' % (progress - progress % 10), False, max(0, estimated - elapsed)
+    
+    return last_build.get('result') or 'NOT BUILT', True, None
+
+
+#===================================================================================================
+# cit_log
+#===================================================================================================
+LOG_MIN_INTERVAL = 1.0
+LOG_MAX_INTERVAL = 10.0
+
+def cit_log(branch, global_config, job_pattern=None):
+    '''
+    Streams the console output of the last builds of the given branch's feature jobs, with each 
+    line prefixed by its job's name, until the builds finish.
+    
+    Output is fetched incrementally with Jenkins' progressive text API and written as it arrives,
+    so memory usage doesn't depend on the size of the logs.
+    
+    :param job_pattern: if given, only jobs matching this pattern (fnmatch-style) are streamed.
+    :return: the number of jobs whose output could not be streamed.
+    '''
+    import fnmatch
+    import time
+    
+    cit_file_name, job_config = load_job_config(global_config)
+    
+    if branch is None:
+        branch = get_git_branch(cit_file_name)
+        
+    new_job_names = [new_job_name for _, new_job_name in get_configured_jobs(branch, job_config)
+                     if job_pattern is None or fnmatch.fnmatch(new_job_name, job_pattern)]
+    
+    with contextlib.closing(create_jenkins_client(global_config, deadline=False)) as jenkins:
+        jobs = get_feature_job_infos(jenkins, job_config, 'name,lastBuild[number]', [branch]).values()
+        last_builds = dict((job['name'], (job.get('lastBuild') or {}).get('number')) for job in jobs)
+        
+        failures = 0
+        streams = []
+        for new_job_name in new_job_names:
+            if new_job_name not in last_builds:
+                print new_job_name, '(NOT FOUND)'
+                failures += 1
+            elif last_builds[new_job_name] is None:
+                print new_job_name, '(NOT BUILT)'
+            else:
+                streams.append(ConsoleStream(new_job_name, last_builds[new_job_name], sys.stdout))
+        
+        interval = LOG_MIN_INTERVAL
+        while streams:
+            received = False
+            for stream in list(streams):
+                try:
+                    received = stream.fetch(jenkins) or received
+                except JenkinsError, e:
+                    stream.close()
+                    print stream.job_name, '(%s)' % format_error(e)
+                    failures += 1
+                    streams.remove(stream)
+                    continue
+                if stream.done:
+                    stream.close()
+                    streams.remove(stream)
+            sys.stdout.flush()
+            
+            if streams:
+                if received:
+                    interval = LOG_MIN_INTERVAL
+                else:
+                    interval = min(interval * 2, LOG_MAX_INTERVAL)
+                time.sleep(interval)
+                
+    return failures
+
+
+#===================================================================================================
+# ConsoleStream
+#===================================================================================================
+class ConsoleStream(object):
+    '''
+    Console output of a build, fetched incrementally and written line by line to a stream, with
+    each line prefixed by the job's name.
+    '''
+    
+    # lines longer than this are written in pieces, so memory usage is bounded
+    MAX_LINE_LENGTH = 64 * 1024
+    
+    def __init__(self, job_name, build_number, output):
+        self.job_name = job_name
+        self.build_number = build_number
+        self.output = output
+        self.offset = 0
+        self.done = False
+        self._partial_line = ''
+        
+        
+    def fetch(self, jenkins):
+        '''
+        Fetches and writes the output produced since the last fetch.
+        
+        :return: True if any output was received.
+        '''
+        path = '%s/%d/logText/progressiveText?start=%d' % (job_path(self.job_name), self.build_number, self.offset)
+        self._received = False
+        headers = jenkins.stream('GET', path, self._write)
+        self.offset = int(headers.get('x-text-size', self.offset))
+        self.done = headers.get('x-more-data', '').lower() != 'true'
+        return self._received
+    
+    
+    def close(self):
+        if self._partial_line:
+            self._write_line(self._partial_line)
+            self._partial_line = ''
+            
+            
+    def _write(self, chunk):
+        self._received = True
+        lines = (self._partial_line + chunk).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._write_line(line)
+        while len(self._partial_line) > self.MAX_LINE_LENGTH:
+            self._write_line(self._partial_line[:self.MAX_LINE_LENGTH])
+            self._partial_line = self._partial_line[self.MAX_LINE_LENGTH:]
+            
+            
+    def _write_line(self, line):
+        self.output.write('[%s] %s\n' % (self.job_name, line.rstrip('\r')))
+        
+        
+#===================================================================================================
+# print_job_statuses
+#===================================================================================================
+def print_job_statuses(results):
+    '''
+    Prints "new_job_name (STATUS)" for each of the results yielded by `run_concurrently` over
+    configured jobs, reporting errors in their place.
+    
+    :return: the number of jobs that failed.
+    '''
+    failures = 0
+    for (_, new_job_name), status, error in results:
+        if error is not None:
+            status = format_error(error)
+            failures += 1
+        print new_job_name, '(%s)' % status
+    return failures
+        
+        
+#===================================================================================================
+# format_error
+#===================================================================================================
+def format_error(error):
+    '''
+    Returns the status reported for a job that failed with the given error: "TIMEOUT" when the 
+    server didn't answer in time, so those are easy to tell from other failures.
+    '''
+    if isinstance(error, JenkinsTimeout):
+        return 'TIMEOUT'
+    return 'ERROR: %s' % error
+        
+        
+#===================================================================================================
+# run_with_script
+#===================================================================================================
+def run_with_script(jenkins, items, get_operation, workers):
+    '''
+    Used instead of `run_concurrently` with the "script" backend: the operations for all items are
+    prepared concurrently and then applied together by a single request (see 
+    `JenkinsClient.run_batch`).
+    
+    :param get_operation: called with each item; returns the operation for the item, or its final
+        status if there's nothing to do in the server.
+    :return: iterator of (item, status, error) in the order of the items, like `run_concurrently`.
+    '''
+    prepared = list(run_concurrently(get_operation, items, workers))
+    operations = [operation for _, operation, error in prepared 
+                  if error is None and isinstance(operation, dict)]
+    results = iter(jenkins.run_batch(operations) if operations else [])
+    for item, operation, error in prepared:
+        if error is None and isinstance(operation, dict):
+            status, error = results.next()
+            yield item, status, error
+        else:
+            yield item, operation, error
+            
+            
+#===================================================================================================
+# use_script_backend
+#===================================================================================================
+def use_script_backend(global_config):
+    '''
+    :return: True if jobs should be changed by scripts in the script console instead of the REST 
+        api (with "backend: script" in the "jenkins" section).
+    '''
+    return global_config['jenkins'].get('backend', 'rest') == 'script'
+    
+    
+#===================================================================================================
+# feature job rules
+# -----------------
+#
+# Rules describing how the configuration of a source job is transformed into the configuration of
+# a feature job. 
+#  
+#===================================================================================================
+
+#===================================================================================================
+# DEFAULT_RULES
+#===================================================================================================
+POLL_TRIGGER_RULE = {
+    'path' : './triggers',
+    'create' : True,
+    'append' : '<hudson.triggers.SCMTrigger>'
+               '<spec>H/5 * * * *</spec>'
+               '<ignorePostCommitHooks>false</ignorePostCommitHooks>'
+               '</hudson.triggers.SCMTrigger>',
+}
+
+# Used instead of POLL_TRIGGER_RULE with "trigger: push": the job never polls by itself, but still
+# polls (and builds) when notified of commits by "cit notify" 
+PUSH_TRIGGER_RULE = {
+    'path' : './triggers',
+    'create' : True,
+    'append' : '<hudson.triggers.SCMTrigger>'
+               '<spec></spec>'
+               '<ignorePostCommitHooks>false</ignorePostCommitHooks>'
+               '</hudson.triggers.SCMTrigger>',
+}
+
+DEFAULT_RULES = [
+    # build the feature branch
+    {
+        'path' : './/hudson.plugins.git.BranchSpec/name',
+        'set' : '$name',
+        'match' : 'first',
+        'warn-if-missing' : 'Could not find any branch spec to replace!',
+    },
+    # If displayName exists adds the feature branch name to it.
+    {
+        'path' : './displayName',
+        'set' : '$text ($name)',
+    },
+    # send emails to the user that added the branch
+    {
+        'path' : './/hudson.tasks.Mailer/recipients',
+        'set' : '$email',
+        'match' : 'unique',
+    },
+    # remove properties from the build so we can use "start" to start-up jobs
+    {
+        'path' : './properties/hudson.model.ParametersDefinitionProperty',
+        'remove' : True,
+    },
+    # add a scm poll trigger for the build with 5 min intervals
+    POLL_TRIGGER_RULE,
+    # remove build triggers after this job
+    {
+        'path' : './publishers/hudson.tasks.BuildTrigger',
+        'remove' : True,
+    },
+]
+
+
+#===================================================================================================
+# FeatureBranchRules
+#===================================================================================================
+class FeatureBranchRules(object):
+    '''
+    Compiled set of rules to transform job configurations. 
+    
+    Each rule is a dict with a "path" to the elements it applies to, either anchored at the root 
+    element ("./a/b") or matching anywhere in the tree (".//a/b"), and one of these actions:
+    
+    - set: replaces the element's text; "$text" in the value is replaced by the current text. 
+    - remove: removes the element.
+    - append: xml of an element appended to the matched element, replacing its children with the
+        same tag.
+    - substitute: replaces variables in the element's text (if true), or replaces each key in the
+        given dict by its value.
+        
+    Values may refer to the variables "$name" (branch name) and "$email" (user's email).
+    
+    Optional keys:
+    
+    - match: "all" (default), "first" (only the first element found) or "unique" (only if exactly 
+        one element is found).
+    - create: creates the elements in an anchored path if they don't exist.
+    - warn-if-missing: warning message reported when no elements are found.
+    
+    All rules are applied in a single pass over the tree. Actions are written so applying them
+    again on an already transformed tree does not change it ("set" does not replace "$text" twice, 
+    "append" replaces previously appended elements), which holds for the default rules.
+    '''
+    
+    ACTIONS = ('set', 'remove', 'append', 'substitute')
+    MATCHES = ('all', 'first', 'unique')
+    
+    def __init__(self, rules):
+        self._source_rules = list(rules)
+        self.rules = []
+        self._rules_by_tag = {}
+        for index, rule in enumerate(rules):
+            compiled = self._compile(rule)
+            self.rules.append(compiled)
+            self._rules_by_tag.setdefault(compiled['tags'][-1], []).append(index)
+            
+            
+    def get_key(self):
+        '''
+        Returns a string identifying these rules: equal rules have the same key.
+        '''
+        def canonical(value):
+            if isinstance(value, dict):
+                return '{%s}' % ', '.join('%r: %s' % (k, canonical(v)) for k, v in sorted(value.iteritems()))
+            elif isinstance(value, (list, tuple)):
+                return '[%s]' % ', '.join(canonical(v) for v in value)
+            return repr(value)
+        return canonical(self._source_rules)
+    
+    
+    def _compile(self, rule):
+        path = rule.get('path', '')
+        if path.startswith('.//'):
+            anchored = False
+            tags = path[3:].split('/')
+        elif path.startswith('./'):
+            anchored = True
+            tags = path[2:].split('/')
+        else:
+            raise RuntimeError('invalid rule path (should start with "./" or ".//"): %r' % path)
+        if not all(tags) or any(c in path for c in '[]*@'):
+            raise RuntimeError('invalid rule path: %r' % path)
+        
+        actions = [action for action in self.ACTIONS if action in rule]
+        if len(actions) != 1:
+            raise RuntimeError('rule for %r should have exactly one of: %s' % (path, ', '.join(self.ACTIONS)))
+        action = actions[0]
+        value = rule[action]
+        if action == 'append':
+            ET = import_element_tree()
+            value = ET.tostring(ET.fromstring(value))
+        
+        match = rule.get('match', 'all')
+        if match not in self.MATCHES:
+            raise RuntimeError('invalid match for rule %r: %r' % (path, match))
+        if rule.get('create') and not anchored:
+            raise RuntimeError('only rules with anchored paths can create elements: %r' % path)
+        
+        return {
+            'path' : path,
+            'tags' : tuple(tags),
+            'anchored' : anchored,
+            'action' : action,
+            'value' : value,
+            'match' : match,
+            'create' : rule.get('create', False),
+            'warn-if-missing' : rule.get('warn-if-missing'),
+        }
+    
+    
+    def apply(self, tree, variables):
+        '''
+        Applies the rules to the given element tree (in place).
+        
+        :param variables: dict with the values for the variables that can be used in rules.
+        :return: list of warnings.
+        '''
+        matches = self._find_matches(tree)
+        
+        warnings = []
+        for rule, elements in zip(self.rules, matches):
+            if not elements and rule['create']:
+                elements = [self._create_path(tree, rule['tags'])]
+            if not elements:
+                if rule['warn-if-missing']:
+                    warnings.append(rule['warn-if-missing'])
+                continue
+            if rule['match'] == 'first':
+                elements = elements[:1]
+            elif rule['match'] == 'unique' and len(elements) != 1:
+                continue
+            for parent, elem in elements:
+                self._apply_action(rule, parent, elem, variables)
+        return warnings
+    
+    
+    def _find_matches(self, tree):
+        '''
+        Visits the tree once, collecting (parent, element) pairs matched by each rule.
+        '''
+        matches = [[] for _ in self.rules]
+        rules_by_tag = self._rules_by_tag
+        path = []
+        
+        def visit(parent):
+            for elem in parent:
+                path.append(elem.tag)
+                for index in rules_by_tag.get(elem.tag, ()):
+                    rule = self.rules[index]
+                    tags = rule['tags']
+                    if rule['anchored']:
+                        matched = len(path) == len(tags) and tuple(path) == tags
+                    else:
+                        matched = tuple(path[-len(tags):]) == tags
+                    if matched:
+                        matches[index].append((parent, elem))
+                if len(elem):
+                    visit(elem)
+                path.pop()
+                
+        visit(tree)
+        return matches
+    
+    
+    def _create_path(self, tree, tags):
+        ET = import_element_tree()
+        parent = None
+        elem = tree
+        for tag in tags:
+            parent = elem
+            elem = parent.find(tag)
+            if elem is None:
+                elem = ET.SubElement(parent, tag)
+        return parent, elem
+    
+    
+    def _apply_action(self, rule, parent, elem, variables):
+        import string
+        ET = import_element_tree()
+        action = rule['action']
+        value = rule['value']
+        if action == 'set':
+            text = elem.text or ''
+            # "$text" may only be replaced if it was not replaced already, so rules are idempotent  
+            template = string.Template(value).safe_substitute(variables)
+            if '$text' in template:
+                prefix, suffix = template.split('$text', 1)
+                if text.startswith(prefix) and text.endswith(suffix):
+                    return
+            elem.text = string.Template(template).safe_substitute(text=text)
+        elif action == 'remove':
+            if parent is not None:
+                parent.remove(elem)
+        elif action == 'append':
+            new_elem = ET.fromstring(string.Template(value).safe_substitute(variables))
+            for child in elem.findall(new_elem.tag):
+                elem.remove(child)
+            elem.append(new_elem)
+        elif action == 'substitute':
+            text = elem.text or ''
+            if isinstance(value, dict):
+                for old, new in sorted(value.iteritems()):
+                    text = text.replace(old, string.Template(new).safe_substitute(variables))
+            elif value:
+                text = string.Template(text).safe_substitute(variables)
+            elem.text = text
+        
+        
+#===================================================================================================
+# get_default_rules
+#===================================================================================================
+_default_rules = None
+
+def get_default_rules():
+    global _default_rules
+    if _default_rules is None:
+        _default_rules = FeatureBranchRules(DEFAULT_RULES)
+    return _default_rules
+
+
+#===================================================================================================
+# get_feature_branch_rules
+#===================================================================================================
+def get_feature_branch_rules(job_config):
+    '''
+    Returns the compiled FeatureBranchRules for the given local config (.cit.yaml): the rules listed
+    in its "rules" key are applied after the default ones, unless "default-rules" is false.
+    
+    With "trigger: push", the default rules don't make jobs poll the repository periodically.
+    '''
+    trigger = job_config.get('trigger', 'poll')
+    if trigger not in ('poll', 'push'):
+        raise RuntimeError('invalid trigger in .cit.yaml (should be "poll" or "push"): %r' % trigger)
+    
+    rules = []
+    if job_config.get('default-rules', True):
+        rules.extend(DEFAULT_RULES)
+        if trigger == 'push':
+            rules[rules.index(POLL_TRIGGER_RULE)] = PUSH_TRIGGER_RULE
+    rules.extend(job_config.get('rules', []))
+    return FeatureBranchRules(rules)
+
+
+#===================================================================================================
+# git helpers
+# -----------
+#
+# Git-related helper functions to extract user name, current branch, etc. 
+#  
+#===================================================================================================
+
+
+#===================================================================================================
+# get_git_user
+#===================================================================================================
+def get_git_user(cit_file_name):
+    '''
+    Returns (user name, user email) configured for the git repository containing `cit_file_name`,
+    reading git's configuration files directly.
+    '''
+    git_config = read_git_config(cit_file_name)
+    if git_config is not None:
+        user_name = git_config.get('user.name')
+        user_email = git_config.get('user.email')
+        if user_name is not None and user_email is not None:
+            return user_name, user_email
+        
+    # configuration might come from somewhere else (system config, included files, etc)
+    user_name = git_command(cit_file_name, 'config', '--get', 'user.name')
+    user_email = git_command(cit_file_name, 'config', '--get', 'user.email')
+    return user_name, user_email
+        
+        
+#===================================================================================================
+# get_git_branch
+#===================================================================================================
+def get_git_branch(cit_file_name):
+    '''
+    Returns the name of the branch checked out in the git repository containing `cit_file_name`,
+    or "HEAD" if no branch is checked out, reading git's HEAD file directly.
+    '''
+    git_dir, _ = get_git_dirs(cit_file_name)
+    if git_dir is not None:
+        head = read_git_file(os.path.join(git_dir, 'HEAD'))
+        if head is not None:
+            head = head.strip()
+            if head.startswith('ref: refs/heads/'):
+                return head[len('ref: refs/heads/'):]
+            elif re.match('^[0-9a-f]{40}$', head):
+                return 'HEAD'
+            
+    return git_command(cit_file_name, 'rev-parse', '--abbrev-ref', 'HEAD')
+
+
+#===================================================================================================
+# get_git_branches
+#===================================================================================================
+def get_git_branches(cit_file_name, remote=None):
+    '''
+    Returns the names of the branches of the git repository containing `cit_file_name`: its local
+    and remote-tracking branches, read from git's refs directly. If `remote` is given, returns the 
+    branches in that remote instead (using `git ls-remote`).
+    
+    :rtype: set(str)
+    '''
+    if remote is not None:
+        output = git_command(cit_file_name, 'ls-remote', '--heads', remote)
+        refs = [line.split('\t', 1)[1] for line in output.splitlines() if '\t' in line]
+    else:
+        refs = read_git_refs(cit_file_name, ('refs/heads/', 'refs/remotes/'))
+        if refs is None:
+            output = git_command(cit_file_name, 'for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/remotes')
+            refs = output.splitlines()
+            
+    branches = set()
+    for ref in refs:
+        if ref.startswith('refs/heads/'):
+            branches.add(ref[len('refs/heads/'):])
+        elif ref.startswith('refs/remotes/') and not ref.endswith('/HEAD'):
+            # refs/remotes/<remote>/<branch>
+            branches.add(ref[len('refs/remotes/'):].split('/', 1)[-1])
+    return branches
+
+
+#===================================================================================================
+# read_git_refs
+#===================================================================================================
+def read_git_refs(path, prefixes):
+    '''
+    Reads the names of the refs starting with any of the given prefixes from the loose ref files 
+    and the packed-refs file of the repository containing the given path.
+    
+    :return: set of ref names, or None if the git directory can't be found.
+    '''
+    _, common_dir = get_git_dirs(path)
+    if common_dir is None:
+        return None
+    
+    refs = set()
+    packed_refs = read_git_file(os.path.join(common_dir, 'packed-refs'))
+    for line in (packed_refs or '').splitlines():
+        fields = line.split()
+        if len(fields) == 2 and not line.startswith(('#', '^')) and fields[1].startswith(prefixes):
+            refs.add(fields[1])
+            
+    for prefix in prefixes:
+        refs_dir = os.path.join(common_dir, *prefix.rstrip('/').split('/'))
+        for dir_path, _, file_names in os.walk(refs_dir):
+            relative_dir = os.path.relpath(dir_path, common_dir).replace(os.sep, '/')
+            for file_name in file_names:
+                if not file_name.endswith('.lock'):
+                    refs.add('%s/%s' % (relative_dir, file_name))
+    return refs
+
+
+#===================================================================================================
+# get_git_remote_url
+#===================================================================================================
+def get_git_remote_url(cit_file_name, remote='origin'):
+    '''
+    Returns the url of the given remote of the git repository containing `cit_file_name`.
+    '''
+    git_config = read_git_config(cit_file_name)
+    if git_config is not None and 'remote.%s.url' % remote in git_config:
+        return git_config['remote.%s.url' % remote]
+    return git_command(cit_file_name, 'config', '--get', 'remote.%s.url' % remote)
+
+
+#===================================================================================================
+# get_git_dirs
+#===================================================================================================
+def get_git_dirs(path):
+    '''
+    Finds the git directory of the repository containing the given path, following "gitdir:" files
+    used by worktrees and submodules.
+    
+    :return: tuple (git dir, common dir), where common dir is the directory shared by all worktrees
+        of the repository (which holds its config and refs); (None, None) if the git directory
+        can't be found or is given by the environment (GIT_DIR).
+    '''
+    if 'GIT_DIR' in os.environ:
+        return None, None
+    
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+        
+    cache_key = ('dirs', path)
+    if cache_key in _git_cache:
+        return _git_cache[cache_key]
+    
+    git_dir = None
+    directory = path
+    while True:
+        dot_git = os.path.join(directory, '.git')
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        contents = read_git_file(dot_git)
+        if contents is not None and contents.startswith('gitdir:'):
+            git_dir = os.path.normpath(os.path.join(directory, contents[len('gitdir:'):].strip()))
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    
+    common_dir = git_dir
+    if git_dir is not None:
+        contents = read_git_file(os.path.join(git_dir, 'commondir'))
+        if contents is not None:
+            common_dir = os.path.normpath(os.path.join(git_dir, contents.strip()))
+            
+    _git_cache[cache_key] = git_dir, common_dir
+    return git_dir, common_dir
+
+
+#===================================================================================================
+# read_git_config
+#===================================================================================================
+def read_git_config(path):
+    '''
+    Reads the global and repository git configuration files that apply to the given path.
+    
+    :return: dict mapping keys ("section.key" or "section.subsection.key", with section and key 
+        in lower case) to their values, or None if the configuration can't be reliably determined
+        without running git (for example, if configuration files include other files).
+    '''
+    if any(name in os.environ for name in ('GIT_CONFIG', 'GIT_CONFIG_COUNT', 'GIT_CONFIG_PARAMETERS')):
+        return None
+    
+    git_dir, common_dir = get_git_dirs(path)
+    if git_dir is None:
+        return None
+    
+    cache_key = ('config', git_dir)
+    if cache_key in _git_cache:
+        return _git_cache[cache_key]
+    
+    if 'GIT_CONFIG_GLOBAL' in os.environ:
+        global_files = [os.environ['GIT_CONFIG_GLOBAL']]
+    else:
+        xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        global_files = [
+            os.path.join(xdg_config_home, 'git', 'config'),
+            os.path.join(os.path.expanduser('~'), '.gitconfig'),
+        ]
+    
+    config = {}
+    for filename in global_files + [os.path.join(common_dir, 'config')]:
+        contents = read_git_file(filename)
+        if contents is not None:
+            config.update(parse_git_config(contents))
+    if config.get('extensions.worktreeconfig', 'false').lower() in ('true', 'yes', 'on', '1'):
+        contents = read_git_file(os.path.join(git_dir, 'config.worktree'))
+        if contents is not None:
+            config.update(parse_git_config(contents))
+            
+    if any(key.startswith(('include.', 'includeif.')) for key in config):
+        config = None
+    _git_cache[cache_key] = config
+    return config
+
+
+#===================================================================================================
+# parse_git_config
+#===================================================================================================
+def parse_git_config(contents):
+    '''
+    Parses the contents of a git configuration file.
+    
+    :return: list of (key, value) in the order they appear, with keys as in `read_git_config`
+        ("include.path" is a key like any other). Keys without a value have value "true".
+    '''
+    result = []
+    section = None
+    lines = contents.splitlines()
+    index = 0
+    while index < len(lines):
+        line = lines[index].strip()
+        index += 1
+        
+        match = re.match(r'^\[\s*([-\w.]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\](.*)$', line)
+        if match is not None:
+            name, subsection, line = match.groups()
+            if subsection is not None:
+                section = '%s.%s' % (name.lower(), re.sub(r'\\(.)', r'\1', subsection))
+            elif '.' in name:
+                # deprecated [section.subsection] syntax
+                name, subsection = name.split('.', 1)
+                section = '%s.%s' % (name.lower(), subsection.lower())
+            else:
+                section = name.lower()
+            line = line.strip()
+            
+        if not line or line[0] in '#;' or section is None:
+            continue
+        
+        match = re.match(r'^([A-Za-z][-\w]*)\s*(=?)(.*)$', line)
+        if match is None:
+            continue
+        name, equals, raw_value = match.groups()
+        if not equals:
+            result.append(('%s.%s' % (section, name.lower()), 'true'))
+            continue
+        
+        # join continuation lines (ending with an unescaped backslash)
+        while re.search(r'(^|[^\\])(\\\\)*\\$', raw_value) and index < len(lines):
+            raw_value = raw_value[:-1] + lines[index]
+            index += 1
+        result.append(('%s.%s' % (section, name.lower()), _parse_git_config_value(raw_value)))
+    return result
+
+
+def _parse_git_config_value(raw_value):
+    escapes = {'n' : '\n', 't' : '\t', 'b' : '\b', '"' : '"', '\\' : '\\'}
+    value = []
+    pending_spaces = ''
+    quoted = False
+    chars = iter(raw_value.strip())
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            value.append(pending_spaces + escapes.get(char, char))
+            pending_spaces = ''
+        elif char == '"':
+            value.append(pending_spaces)
+            pending_spaces = ''
+            quoted = not quoted
+        elif char in '#;' and not quoted:
+            break
+        elif char.isspace() and not quoted:
+            pending_spaces += ' '
+        else:
+            value.append(pending_spaces + char)
+            pending_spaces = ''
+    return ''.join(value)
+
+
+#===================================================================================================
+# read_git_file
+#===================================================================================================
+def read_git_file(filename):
+    '''
+    Returns the contents of the given file, or None if it doesn't exist or can't be read.
+    '''
+    try:
+        with open(filename) as f:
+            return f.read()
+    except IOError:
+        return None
+    
+    
+#===================================================================================================
+# git_command
+#===================================================================================================
+def git_command(cit_file_name, *args):
+    '''
+    Runs git with the given arguments in the directory containing `cit_file_name`, returning its
+    output.
+    '''
+    directory = cit_file_name
+    if not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return check_output(('git',) + args, cwd=directory).strip()
+
+
+# Results of git helpers for the lifetime of the process
+_git_cache = {}
+
+
+#===================================================================================================
+# jenkins client
+# --------------
+#
+# Thin layer over Jenkins' remote access API, asking only for the data each command needs.
+#  
+#===================================================================================================
+
+#===================================================================================================
+# JenkinsError
+#===================================================================================================
+class JenkinsError(Exception):
+    
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+        
+        
+#===================================================================================================
+# UnknownJob
+#===================================================================================================
+class UnknownJob(JenkinsError):
+    pass
+
+
+#===================================================================================================
+# JenkinsTimeout
+#===================================================================================================
+class JenkinsTimeout(JenkinsError):
+    '''
+    Raised when a request didn't finish within its timeout or the command's deadline.
+    '''
+
+
+#===================================================================================================
+# JenkinsClient
+#===================================================================================================
+class JenkinsClient(object):
+    '''
+    Minimal client for Jenkins' remote access API.
+    
+    Queries use "tree" filters so only the requested fields are transferred, and HTTP connections
+    are kept alive and reused by subsequent requests: one connection is opened for each request
+    made concurrently (usually one per worker thread) and they all live until `close` is called.
+    
+    If a JobIndex is given, it is used to know which jobs exist without asking the server, and is
+    kept up to date with the jobs created and deleted by the client. If a TemplateCache is given, 
+    it is used for the configurations of source jobs (`get_source_config`). A SnapshotStore, if 
+    given, records the changes made to feature jobs in each command (until `close`).
+    
+    Each request is limited to `timeout` seconds, and no request is made after `deadline` (a time
+    as given by time.time(), set by `set_deadline`); both raise JenkinsTimeout. GET requests that
+    fail are retried up to `retries` times, and if `hedge_percentile` is set, GETs slower than 
+    that percentile of recent requests are hedged by a second request.
+    '''
+    
+    def __init__(self, url, index=None, templates=None, snapshots=None):
+        import base64
+        import threading
+        import urllib
+        import urlparse
+        
+        parsed = urlparse.urlsplit(url)
+        self.url = url.rstrip('/')
+        self.scheme = parsed.scheme or 'http'
+        self.netloc = parsed.hostname
+        if parsed.port:
+            self.netloc += ':%d' % parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.headers = {}
+        if parsed.username:
+            credentials = '%s:%s' % (urllib.unquote(parsed.username), urllib.unquote(parsed.password or ''))
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        self._idle_connections = []
+        self._lock = threading.Lock()
+        self.index = index
+        self.templates = templates
+        self.snapshots = snapshots
+        # if True, `close` keeps the connections open for later commands (see `cit_serve`)
+        self.persistent = False
+        self.timeout = DEFAULT_TIMEOUT
+        self.deadline = None
+        self.retries = DEFAULT_RETRIES
+        self.retry_backoff = 0.5
+        self.hedge_percentile = None
+        self._latencies = []
+        
+        
+    def set_deadline(self, seconds):
+        '''
+        Makes requests fail with JenkinsTimeout after the given number of seconds from now (or 
+        never, if None).
+        '''
+        import time
+        self.deadline = None if seconds is None else time.time() + seconds
+        
+        
+    def close(self):
+        if self.templates is not None:
+            self.templates.forget()
+        if self.snapshots is not None:
+            try:
+                self.snapshots.commit()
+            except (IOError, OSError), e:
+                print >> sys.stderr, 'could not write snapshot: %s' % e
+        if self.persistent:
+            if self.index is not None:
+                self.index.save()
+            return
+        with self._lock:
+            connections, self._idle_connections = self._idle_connections, []
+        for connection in connections:
+            connection.close()
+        if self.index is not None:
+            self.index.save()
+            
+            
+    def request(self, method, path, body=None, headers=None, accept_codes=()):
+        '''
+        Makes a request to the given path, relative to the server's url.
+        
+        :param accept_codes: HTTP status codes that should not be considered errors, besides 2xx 
+            and 3xx codes (redirects are not followed).
+            
+        :return: tuple (status, response body).
+        :raise JenkinsError: if the server could not be reached or returned an error; 
+            UnknownJob for 404 responses. 
+        '''
+        status, _, data = self._request(method, path, body, headers, accept_codes)
+        return status, data
+    
+    
+    def stream(self, method, path, write):
+        '''
+        Makes a request like `request`, but passing the response body to write(chunk) in pieces as 
+        they are received, instead of reading it all in memory.
+        
+        :return: dict with the response headers (names in lower case).
+        '''
+        _, response_headers, _ = self._request(method, path, None, None, (), write)
+        return response_headers
+    
+    
+    def _request(self, method, path, body, headers, accept_codes, write=None):
+        import random
+        import time
+        
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        
+        # sizes of the chunks given to `write`
+        written = []
+        if write is not None:
+            def write_chunk(chunk):
+                written.append(len(chunk))
+                write(chunk)
+        else:
+            write_chunk = None
+        
+        # GETs don't change anything, so they can be retried and hedged 
+        idempotent = method == 'GET'
+        attempt = 0
+        while True:
+            try:
+                if idempotent and write is None:
+                    status, response_headers, data = self._hedged_attempt(method, path, all_headers)
+                else:
+                    status, response_headers, data = self._attempt(method, path, body, all_headers, write_chunk)
+            except JenkinsError, e:
+                error = e
+            else:
+                if not idempotent or status not in RETRY_STATUSES:
+                    break
+                error = JenkinsError('%s %s: HTTP error %d' % (method, self.url + path, status), status)
+                
+            if not idempotent or written or attempt >= self.retries:
+                raise error
+            # exponential backoff with full jitter, so clients retrying together spread out 
+            delay = random.uniform(0, min(RETRY_MAX_BACKOFF, self.retry_backoff * 2 ** attempt))
+            if self.deadline is not None and time.time() + delay >= self.deadline:
+                raise JenkinsTimeout('%s %s: deadline exceeded' % (method, self.url + path))
+            time.sleep(delay)
+            attempt += 1
+        
+        if status >= 400 and status not in accept_codes:
+            if status == 404:
+                raise UnknownJob('%s %s: not found' % (method, self.url + path), status)
+            raise JenkinsError('%s %s: HTTP error %d' % (method, self.url + path, status), status)
+        return status, response_headers, data
+    
+    
+    def _attempt(self, method, path, body, headers, write=None):
+        '''
+        Makes a single request, limited by the request timeout and the deadline.
+        
+        :return: tuple (status, response headers, response body).
+        :raise JenkinsTimeout: if the request didn't finish in time.
+        :raise JenkinsError: if the server could not be reached.
+        '''
+        import httplib
+        import socket
+        import time
+        
+        url = self.base_path + path
+        with trace('http', method, url=self.url + path) as event:
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    event['error'] = 'deadline exceeded'
+                    raise JenkinsTimeout('%s %s: deadline exceeded' % (method, self.url + path))
+                timeout = remaining if timeout is None else min(timeout, remaining)
+                
+            start = time.time()
+            connection, reused = self._acquire_connection()
+            written = []
+            def write_chunk(chunk):
+                written.append(len(chunk))
+                write(chunk)
+            try:
+                try:
+                    status, response_headers, data = self._send(connection, method, url, body, headers, 
+                                                                 write and write_chunk, timeout)
+                except socket.timeout:
+                    raise
+                except (httplib.HTTPException, socket.error):
+                    if not reused or written:
+                        raise
+                    # the server has closed an idle connection: try again with a new one
+                    connection.close()
+                    connection = self._create_connection()
+                    status, response_headers, data = self._send(connection, method, url, body, headers, 
+                                                                 write and write_chunk, timeout)
+            except socket.timeout:
+                connection.close()
+                event['error'] = 'timeout'
+                raise JenkinsTimeout('%s %s: timed out after %.1fs' % (method, self.url + path, timeout))
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                event['error'] = str(e)
+                raise JenkinsError('%s %s: %s' % (method, self.url + path, e or e.__class__.__name__))
+            
+            self._release_connection(connection)
+            event['status'] = status
+            event['bytes'] = len(body or '') + len(data) + sum(written)
+            
+        if method == 'GET' and status < 400:
+            with self._lock:
+                self._latencies.append(time.time() - start)
+                del self._latencies[:-HEDGE_SAMPLES]
+        return status, response_headers, data
+    
+    
+    def _hedged_attempt(self, method, path, headers):
+        '''
+        Makes a request like `_attempt`, but if `hedge_percentile` is set and the request takes 
+        longer than that percentile of the latencies of previous requests, makes the same request 
+        again in another connection and uses whichever answers first.
+        '''
+        import Queue
+        import threading
+        
+        delay = None
+        if self.hedge_percentile is not None:
+            with self._lock:
+                latencies = sorted(self._latencies)
+            if len(latencies) >= HEDGE_MIN_SAMPLES:
+                delay = latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100.0))]
+        if delay is None:
+            return self._attempt(method, path, None, headers)
+        
+        answers = Queue.Queue()
+        def run():
+            try:
+                answers.put((self._attempt(method, path, None, headers), None))
+            except JenkinsError, e:
+                answers.put((None, e))
+                
+        def start():
+            thread = threading.Thread(target=run)
+            thread.setDaemon(True)
+            thread.start()
+            
+        start()
+        try:
+            result, error = answers.get(timeout=delay)
+            pending = 0
+        except Queue.Empty:
+            with trace('http', 'hedge', url=self.url + path):
+                start()
+            result, error = answers.get()
+            pending = 1
+        # if the first answer is an error, the hedged request may still succeed
+        if error is not None and pending:
+            result, error = answers.get()
+        if error is not None:
+            raise error
+        return result
+    
+    
+    def get_json(self, path, tree=None, depth=None):
+        '''
+        Returns the decoded data from the "api/json" endpoint of the given path.
+        
+        :param tree: filter with the fields that should be returned, for example "jobs[name,color]".
+        '''
+        import json
+        import urllib
+        
+        query = []
+        if tree is not None:
+            query.append(('tree', tree))
+        if depth is not None:
+            query.append(('depth', depth))
+        url = path + '/api/json'
+        if query:
+            url += '?' + urllib.urlencode(query)
+        _, data = self.request('GET', url)
+        return json.loads(data)
+    
+    
+    def get_job_info(self, name, tree='name,color'):
+        '''
+        :return: the job's data filtered by `tree`, or None if the job doesn't exist.
+        '''
+        try:
+            return self.get_json(job_path(name), tree=tree)
+        except UnknownJob:
+            if self.index is not None:
+                self.index.discard(name)
+            return None
+        
+        
+    def might_have_job(self, name, refresh=True):
+        '''
+        Checks if the job might exist, without asking the server about it.
+        
+        :param refresh: if the job index has expired, refreshes it before answering.
+        :return: False only if there's a fresh job index and the job is not in it.
+        '''
+        if self.index is None:
+            return True
+        folder = name.rpartition('/')[0]
+        with self.index.lock:
+            if refresh and not self.index.is_fresh(folder):
+                self.index.refresh(self, folder)
+            return not self.index.is_fresh(folder) or self.index.has_job(name)
+    
+    
+    def get_jobs(self, fields='name,color', folder='', subfolders=False):
+        '''
+        Fetches the given fields of all jobs in the given folder (by default, at the top level) with
+        a single request, refreshing the job index with them.
+        
+        :param subfolders: also fetches the jobs in the folders found (one level deep).
+        :return: list of dicts with the data of each job, with its full name ("folder/job") as 
+            "name"; empty if the folder doesn't exist.
+        '''
+        tree = fields
+        if subfolders:
+            tree += ',jobs[%s]' % fields
+        try:
+            items = self.get_json(job_path(folder) if folder else '', tree='jobs[%s]' % tree).get('jobs', [])
+        except UnknownJob:
+            items = []
+        jobs = []
+        self._add_folder_jobs(jobs, folder, items)
+        return jobs
+    
+    
+    def _add_folder_jobs(self, jobs, folder, items):
+        prefix = folder + '/' if folder else ''
+        folder_jobs = []
+        for item in items:
+            job = dict(item)
+            job['name'] = prefix + job['name']
+            children = job.pop('jobs', None)
+            folder_jobs.append(job)
+            if children is not None:
+                self._add_folder_jobs(jobs, job['name'], children)
+        if self.index is not None:
+            self.index.update(folder_jobs, folder)
+        jobs[:0] = folder_jobs
+    
+    
+    def get_job_config(self, name):
+        _, data = self.request('GET', job_path(name) + '/config.xml')
+        return data
+    
+    
+    def get_job_config_if_modified(self, name, etag=None, last_modified=None):
+        '''
+        Fetches the configuration of the job unless it didn't change since it was fetched with the
+        given validators.
+        
+        :return: tuple (config, etag, last modified): config is None if it was not modified.
+        '''
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        status, response_headers, data = self._request('GET', job_path(name) + '/config.xml', None, headers, ())
+        etag = response_headers.get('etag', etag)
+        last_modified = response_headers.get('last-modified', last_modified)
+        if status == 304:
+            return None, etag, last_modified
+        return data, etag, last_modified
+    
+    
+    def get_source_config(self, name):
+        '''
+        Returns the configuration of a source job, from the TemplateCache if there's one.
+        '''
+        if self.templates is None:
+            return self.get_job_config(name)
+        return self.templates.get_config(self, name)
+    
+    
+    def update_job_config(self, name, config):
+        self.request('POST', job_path(name) + '/config.xml', config, XML_HEADERS)
+        
+        
+    def create_job(self, name, config):
+        '''
+        Creates a job with the given configuration, creating the folders it's in if needed.
+        '''
+        import urllib
+        folder, _, leaf = name.rpartition('/')
+        path = (job_path(folder) if folder else '') + '/createItem?' + urllib.urlencode([('name', leaf)])
+        try:
+            self.request('POST', path, config, XML_HEADERS)
+        except UnknownJob:
+            if not folder:
+                raise
+            try:
+                self.create_job(folder, FOLDER_CONFIG)
+            except JenkinsError, e:
+                # created meanwhile by another worker
+                if e.status != 400:
+                    raise
+            self.request('POST', path, config, XML_HEADERS)
+        if self.index is not None:
+            self.index.add(name)
+        
+        
+    def delete_job(self, name):
+        try:
+            self.request('POST', job_path(name) + '/doDelete', '')
+        except UnknownJob:
+            if self.index is not None:
+                self.index.discard(name)
+            raise
+        if self.index is not None:
+            self.index.discard(name)
+        
+        
+    def build_job(self, name):
+        self.request('POST', job_path(name) + '/build', '')
+        
+        
+    def run_batch(self, operations):
+        '''
+        Applies the given operations to jobs with a single request to the script console (which
+        needs the "Overall/Administer" permission), instead of one or more requests for each.
+        
+        :param operations: list of dicts with the "action" ('add', 'remove' or 'start') and "job" 
+            name of each operation, and the "config" of the job for 'add'. Jobs added or removed 
+            are recorded in the SnapshotStore with the operation's "branch", "source-job" and 
+            "base" (see `SnapshotStore.record`), which are not sent to the server.
+        :return: list with a tuple (status, error) for each operation, with the status that 
+            `create_feature_branch_job`, `remove_feature_job` or `start_feature_job` would give, 
+            or a JenkinsError if the operation failed.
+        '''
+        import base64
+        import json
+        import urllib
+        
+        sent = [dict((key, value) for key, value in operation.iteritems() if key in ('action', 'job', 'config')) 
+                for operation in operations]
+        payload = base64.b64encode(json.dumps(sent))
+        body = urllib.urlencode([('script', BATCH_SCRIPT % payload)])
+        _, data = self.request('POST', '/scriptText', body, FORM_HEADERS)
+        lines = data.strip().splitlines()
+        try:
+            results = json.loads(lines[-1])
+        except (ValueError, IndexError):
+            results = None
+        if not isinstance(results, list) or len(results) != len(operations):
+            raise JenkinsError('POST %s/scriptText: unexpected output: %s' % (self.url, data.strip()[:500]))
+        
+        statuses = []
+        for operation, result in zip(operations, results):
+            if 'error' in result:
+                statuses.append((None, JenkinsError('%s: %s' % (operation['job'], result['error']))))
+                continue
+            status = str(result['status'])
+            if self.index is not None:
+                if status == 'CREATED':
+                    self.index.add(operation['job'])
+                elif operation['action'] == 'remove':
+                    self.index.discard(operation['job'])
+            if self.snapshots is not None and status in ('CREATED', 'UPDATED', 'REMOVED'):
+                before = result.get('before')
+                if before is not None:
+                    before = before.encode('utf-8')
+                self.snapshots.record(operation['job'], operation.get('branch'), before, 
+                                      operation.get('config'), operation.get('base'), 
+                                      operation.get('source-job'))
+            statuses.append((status, None))
+        return statuses
+        
+        
+    def notify_commit(self, repository_url, branch, token=None):
+        '''
+        Notifies the git plugin about new commits in the given repository and branch.
+        
+        :return: list of messages from the server (which jobs were scheduled, etc).
+        '''
+        import urllib
+        query = [('url', repository_url), ('branches', branch)]
+        if token:
+            query.append(('token', token))
+        _, data = self.request('GET', '/git/notifyCommit?' + urllib.urlencode(query))
+        return [line.strip() for line in data.splitlines() if line.strip()]
+        
+        
+    def _acquire_connection(self):
+        '''
+        :return: tuple (connection, reused), reusing an idle connection if there's one available.
+        '''
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop(), True
+        return self._create_connection(), False
+    
+    
+    def _release_connection(self, connection):
+        with self._lock:
+            self._idle_connections.append(connection)
+            
+            
+    def _create_connection(self):
+        import httplib
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc)
+        return httplib.HTTPConnection(self.netloc)
+    
+    
+    def _send(self, connection, method, url, body, headers, write=None, timeout=None):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        # always read the whole body, so the connection can be reused
+        if write is not None and response.status < 400:
+            data = ''
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                write(chunk)
+        else:
+            data = response.read()
+        if response.will_close:
+            connection.close()
+        return response.status, dict(response.getheaders()), data
+    
+    
+XML_HEADERS = {'Content-Type' : 'application/xml'}
+FOLDER_CONFIG = '<com.cloudbees.hudson.plugins.folder.Folder/>'
+FORM_HEADERS = {'Content-Type' : 'application/x-www-form-urlencoded'}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Groovy program run by `JenkinsClient.run_batch` in the script console, with the operations 
+# (a JSON list encoded in base64) in place of "%s"; prints a JSON list with the result of each one
+# (with the configuration "before" updating or removing a job).
+# The tests only check that it's well formed (FakeJenkins simulates what it does), so changes must be
+# tried against a real Jenkins.
+BATCH_SCRIPT = '''\
+import groovy.json.JsonOutput
+import groovy.json.JsonSlurper
+import javax.xml.parsers.DocumentBuilderFactory
+import javax.xml.transform.stream.StreamSource
+import jenkins.model.Jenkins
+import org.w3c.dom.Node
+import org.xml.sax.InputSource
+
+// like normalize_config in cit.py: comments, blank text and text after child elements are ignored
+def normalize(String xml) {
+    def builder = DocumentBuilderFactory.newInstance().newDocumentBuilder()
+    def root = builder.parse(new InputSource(new StringReader(xml))).documentElement
+    strip(root)
+    root.normalize()
+    return root
+}
+
+def strip(Node node) {
+    def afterElement = false
+    def children = node.childNodes
+    for (child in (0..<children.length).collect { children.item(it) }) {
+        if (child.nodeType == Node.ELEMENT_NODE) {
+            afterElement = true
+            strip(child)
+        } else if (child.nodeType != Node.TEXT_NODE || afterElement || !child.nodeValue.trim()) {
+            node.removeChild(child)
+        }
+    }
+}
+
+// creates the item in its folder, creating the folders that don't exist yet
+def create(Jenkins instance, String fullName, String config) {
+    def parent = instance
+    def names = fullName.tokenize('/')
+    names.take(names.size() - 1).each { name ->
+        parent = parent.getItem(name) ?: parent.createProjectFromXML(name, 
+            new ByteArrayInputStream("<com.cloudbees.hudson.plugins.folder.Folder/>".getBytes('UTF-8')))
+    }
+    parent.createProjectFromXML(names.last(), new ByteArrayInputStream(config.getBytes('UTF-8')))
+}
+
+def apply(Jenkins instance, operation) {
+    def item = instance.getItemByFullName(operation.job)
+    switch (operation.action) {
+        case 'add':
+            if (item == null) {
+                create(instance, operation.job, operation.config)
+                return [status: 'CREATED']
+            }
+            def current = item.configFile.asString()
+            if (normalize(current).isEqualNode(normalize(operation.config))) {
+                return [status: 'UNCHANGED']
+            }
+            item.updateByXml(new StreamSource(new StringReader(operation.config)))
+            return [status: 'UPDATED', before: current]
+        case 'remove':
+            if (item == null) {
+                return [status: 'NOT FOUND']
+            }
+            def removed = item.configFile.asString()
+            item.delete()
+            return [status: 'REMOVED', before: removed]
+        case 'start':
+            if (item == null) {
+                return [status: 'NOT FOUND']
+            } else if (item.isBuilding()) {
+                return [status: 'RUNNING']
+            } else if (item.isInQueue()) {
+                return [status: 'QUEUED']
+            } else if (!item.isBuildable()) {
+                return [error: 'job is disabled']
+            }
+            item.scheduleBuild2(0)
+            return [status: 'STARTED']
+    }
+    return [error: 'unknown action: ' + operation.action]
+}
+
+def operations = new JsonSlurper().parseText(new String('%s'.decodeBase64(), 'UTF-8'))
+println JsonOutput.toJson(operations.collect { operation ->
+    try {
+        return apply(Jenkins.instance, operation)
+    } catch (Exception e) {
+        return [error: e.toString()]
+    }
+})
+'''
+
+# server errors worth retrying idempotent requests for (usually overloaded or restarting servers)
+RETRY_STATUSES = (502, 503, 504)
+RETRY_MAX_BACKOFF = 10.0
+
+# number of latencies of recent requests used to decide when to hedge requests, and the minimum
+# needed to start hedging 
+HEDGE_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 10
+
+
+#===================================================================================================
+# JobIndex
+#===================================================================================================
+class JobIndex(object):
+    '''
+    Local copy of the names (and colors) of the jobs in a Jenkins server, so cit can tell if jobs 
+    exist without asking the server.
+    
+    Each folder in the index (or the top level, '') is filled by a single query for all jobs in it,
+    expires `ttl` seconds later and in the meantime is updated by the jobs cit itself creates and
+    deletes.
+    '''
+    
+    def __init__(self, filename, url, ttl, clock=None):
+        import threading
+        import time
+        
+        self.filename = filename
+        self.url = url
+        self.ttl = ttl
+        self.clock = clock or time.time
+        self.jobs = {}
+        # time each folder was filled
+        self.timestamps = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+        
+        data = read_cache_file(filename)
+        if data is not None and data[0] == url and isinstance(data[1], dict):
+            _, self.timestamps, self.jobs = data
+            
+            
+    def is_fresh(self, folder=''):
+        return 0 <= self.clock() - self.timestamps.get(folder, 0) < self.ttl
+    
+    
+    def refresh(self, jenkins, folder=''):
+        jenkins.get_jobs('name,color', folder)
+        
+        
+    def update(self, jobs, folder=''):
+        '''
+        Replaces the jobs of the given folder in the index by the given list of jobs data (with 
+        full names), fetched from the server.
+        '''
+        with self.lock:
+            for name in [name for name in self.jobs if name.rpartition('/')[0] == folder]:
+                del self.jobs[name]
+            self.jobs.update((job['name'], job.get('color')) for job in jobs)
+            self.timestamps[folder] = self.clock()
+            self.dirty = True
+            
+            
+    def has_job(self, name):
+        return name in self.jobs
+
+    
+    
+    def add(self, name, color='notbuilt'):
+        with self.lock:
+            self.jobs[name] = color
+            self.dirty = True
+            
+            
+    def discard(self, name):
+        '''
+        Removes the given job from the index, and everything in it if it's a folder.
+        '''
+        with self.lock:
+            for job_name in [job_name for job_name in self.jobs 
+                             if job_name == name or job_name.startswith(name + '/')]:
+                del self.jobs[job_name]
+                self.dirty = True
+            if self.timestamps.pop(name, None) is not None:
+                # nothing is left in a removed folder
+                self.timestamps[name] = self.clock()
+                
+                
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                timestamps = dict((folder, timestamp) for folder, timestamp in self.timestamps.iteritems()
+                                  if 0 <= self.clock() - timestamp < self.ttl)
+                write_cache_file(self.filename, (self.url, timestamps, self.jobs))
+                self.dirty = False
+                
+                
+#===================================================================================================
+# TemplateCache
+#===================================================================================================
+class TemplateCache(object):
+    '''
+    Cache of the configurations of the source jobs of a Jenkins server, and of the templates made
+    from them (see `make_feature_branch_config`), kept in cit's cache directory.
+    
+    If the server sent an ETag or Last-Modified with a configuration, it is revalidated with a 
+    conditional request at most once per command, which transfers it again only if it has 
+    changed. Jenkins doesn't send those for job configurations though, so otherwise the cached 
+    configuration is used for `ttl` seconds after being fetched (if not 0), and fetched again after
+    that.
+    '''
+    
+    def __init__(self, cache_dir, url, ttl, clock=None):
+        import threading
+        import time
+        
+        self.cache_dir = cache_dir
+        self.url = url
+        self.ttl = ttl
+        self.clock = clock or time.time
+        self.lock = threading.Lock()
+        # configurations and templates used by the current command
+        self._configs = {}
+        self._templates = {}
+        
+        
+    def get_config(self, jenkins, job_name):
+        '''
+        Returns the configuration of the given job, from the cache if it's still valid.
+        '''
+        import zlib
+        
+        with self.lock:
+            if job_name in self._configs:
+                return self._configs[job_name]
+        
+        key = '%s\0%s' % (self.url, job_name)
+        filename = os.path.join(self.cache_dir, 'source-%08x.cache' % (zlib.crc32(key) & 0xffffffff))
+        cached = read_cache_file(filename)
+        if cached is not None and cached[0] == key:
+            _, timestamp, etag, last_modified, config = cached
+            if etag is None and last_modified is None and 0 <= self.clock() - timestamp < self.ttl:
+                return self._remember_config(job_name, config)
+        else:
+            etag = last_modified = config = None
+            
+        new_config, etag, last_modified = jenkins.get_job_config_if_modified(job_name, etag, last_modified)
+        if new_config is not None:
+            config = new_config
+        write_cache_file(filename, (key, self.clock(), etag, last_modified, config))
+        return self._remember_config(job_name, config)
+    
+    
+    def get_template(self, source_config, rules):
+        '''
+        Returns the template made from the given configuration by `make_feature_branch_template`,
+        from the cache if the same configuration was already transformed by the same rules.
+        
+        :return: tuple (template, warnings).
+        '''
+        import hashlib
+        
+        key = hashlib.sha1(rules.get_key() + '\0' + source_config).hexdigest()
+        with self.lock:
+            if key in self._templates:
+                return self._templates[key]
+            
+        filename = os.path.join(self.cache_dir, 'template-%s.cache' % key[:16])
+        cached = read_cache_file(filename)
+        if cached is not None and cached[0] == key:
+            template = cached[1]
+        else:
+            template = make_feature_branch_template(source_config, rules)
+            write_cache_file(filename, (key, template))
+            
+        with self.lock:
+            self._templates[key] = template
+        return template
+    
+    
+    def forget(self):
+        '''
+        Forgets the configurations used by the current command, so they are revalidated by the 
+        next one.
+        '''
+        with self.lock:
+            self._configs.clear()
+            self._templates.clear()
+            
+            
+    def _remember_config(self, job_name, config):
+        with self.lock:
+            self._configs[job_name] = config
+        return config
+    
+    
+#===================================================================================================
+# SnapshotStore
+#===================================================================================================
+class SnapshotStore(object):
+    '''
+    Local store of the configurations of the feature jobs changed by cit, so they can be restored
+    by `cit_rollback`.
+    
+    Configurations are kept in files named by the sha1 of their contents (so each distinct 
+    configuration is kept only once), compressed, and as a delta against the configuration of 
+    their source job when given (feature job configurations differ from it in a few lines only).
+    
+    Each command that changes jobs records a snapshot: the configuration of each job it changed 
+    before and after the change (None if the job didn't exist), written by `commit`. Removed jobs
+    are recorded too, so they can be restored.
+    '''
+    
+    def __init__(self, directory, url, clock=None):
+        import threading
+        import time
+        
+        self.directory = directory
+        self.url = url
+        self.clock = clock or time.time
+        self.lock = threading.Lock()
+        # changes recorded by the current command: job name => (branch, sha before, sha after, 
+        # source job)
+        self._changes = {}
+        
+        
+    def put(self, config, base=None):
+        '''
+        Stores the given configuration, as a delta against `base` if that's smaller.
+        
+        :return: the sha1 of the configuration, used to get it back with `get`.
+        '''
+        import hashlib
+        
+        sha = hashlib.sha1(config).hexdigest()
+        filename = self._object_filename(sha)
+        if not os.path.isfile(filename):
+            data = ('full', config)
+            if base is not None and base != config:
+                base_sha = self.put(base)
+                delta = make_delta(base, config)
+                if len(repr(delta)) < len(config):
+                    data = ('delta', base_sha, delta)
+            self._write(filename, data)
+        return sha
+    
+    
+    def get(self, sha):
+        '''
+        :return: the configuration stored with the given sha1.
+        :raise KeyError: if there's no such configuration.
+        '''
+        data = self._read(self._object_filename(sha))
+        if data is None:
+            raise KeyError(sha)
+        if data[0] == 'delta':
+            _, base_sha, delta = data
+            return apply_delta(self.get(base_sha), delta)
+        return data[1]
+    
+    
+    def record(self, job_name, branch, before, after, base=None, source_job=None):
+        '''
+        Records a change to the given job in the current command's snapshot.
+        
+        :param before: configuration of the job before the change, or None if it didn't exist.
+        :param after: configuration of the job after the change, or None if it was removed.
+        :param base: configuration the others are stored as deltas against (the source job's).
+        :param source_job: name of the source job of the job, if known.
+        '''
+        before_sha = None if before is None else self.put(before, base)
+        after_sha = None if after is None else self.put(after, base)
+        with self.lock:
+            if job_name in self._changes:
+                # changed more than once: the snapshot keeps the first state
+                before_sha = self._changes[job_name][1]
+                source_job = source_job or self._changes[job_name][3]
+            self._changes[job_name] = (branch, before_sha, after_sha, source_job)
+            
+            
+    def commit(self):
+        '''
+        Writes the snapshot of the changes recorded by the current command, if any.
+        
+        :return: the id of the snapshot, or None.
+        '''
+        import hashlib
+        import time
+        
+        with self.lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return None
+        now = self.clock()
+        snapshot = {'url' : self.url, 'time' : now, 'jobs' : changes}
+        snapshot_id = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), 
+                                 hashlib.sha1(repr(sorted(changes.items()))).hexdigest()[:6])
+        self._write(os.path.join(self.directory, 'snapshots', snapshot_id), snapshot)
+        return snapshot_id
+    
+    
+    def get_snapshots(self):
+        '''
+        :return: list of (snapshot id, snapshot) of the server's snapshots, from oldest to newest;
+            each snapshot is a dict with its "time" and "jobs" (job name => (branch, sha before, 
+            sha after, source job name or None)).
+        '''
+        directory = os.path.join(self.directory, 'snapshots')
+        if not os.path.isdir(directory):
+            return []
+        snapshots = []
+        for snapshot_id in os.listdir(directory):
+            snapshot = self._read(os.path.join(directory, snapshot_id))
+            if snapshot is not None and snapshot['url'] == self.url:
+                for name, change in snapshot['jobs'].items():
+                    snapshot['jobs'][name] = tuple(change) + (None,) * (4 - len(change))
+                snapshots.append((snapshot_id, snapshot))
+        return sorted(snapshots, key=lambda (snapshot_id, snapshot): (snapshot['time'], snapshot_id))
+    
+    
+    def get_jobs(self):
+        '''
+        :return: dict with the (branch, source job name) of the jobs which exist according to the 
+            snapshots (created or changed by cit, and not removed since), by name.
+        '''
+        jobs = {}
+        for _, snapshot in self.get_snapshots():
+            for name, (branch, _, after_sha, source_job) in snapshot['jobs'].iteritems():
+                if after_sha is None:
+                    jobs.pop(name, None)
+                else:
+                    jobs[name] = (branch, source_job)
+        return jobs
+    
+    
+    def get_configs(self, job_names):
+        '''
+        :return: dict with the configuration cit last wrote for each of the given jobs which exist 
+            according to the snapshots (see `get_jobs`), including the current command's changes, 
+            by name.
+        '''
+        job_names = set(job_names)
+        shas = {}
+        for _, snapshot in self.get_snapshots():
+            for name, (_, _, after_sha, _) in snapshot['jobs'].iteritems():
+                if name in job_names:
+                    shas[name] = after_sha
+        with self.lock:
+            for name, (_, _, after_sha, _) in self._changes.iteritems():
+                if name in job_names:
+                    shas[name] = after_sha
+        configs = {}
+        for name, sha in shas.iteritems():
+            if sha is not None:
+                try:
+                    configs[name] = self.get(sha)
+                except KeyError:
+                    # the object was removed: the job's configuration is fetched instead
+                    pass
+        return configs
+    
+    
+    def _object_filename(self, sha):
+        return os.path.join(self.directory, 'objects', sha[:2], sha[2:])
+    
+    
+    def _read(self, filename):
+        import marshal
+        import zlib
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return marshal.loads(zlib.decompress(f.read()))
+            except (zlib.error, EOFError, ValueError, TypeError):
+                return None
+        finally:
+            f.close()
+            
+            
+    def _write(self, filename, data):
+        import marshal
+        import thread
+        import zlib
+        
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created meanwhile by another thread
+                if not os.path.isdir(directory):
+                    raise
+        temp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), thread.get_ident())
+        f = open(temp_filename, 'wb')
+        try:
+            f.write(zlib.compress(marshal.dumps(data), 9))
+        finally:
+            f.close()
+        if sys.platform == 'win32' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+        
+        
+#===================================================================================================
+# make_delta
+#===================================================================================================
+def make_delta(base, text):
+    '''
+    Returns the difference between two texts, so `apply_delta(base, delta)` gives back `text`.
+    
+    :return: list with the lines of `text`, as either (start, end) ranges of lines copied from 
+        `base` or strings with new lines.
+    '''
+    import difflib
+    
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append((i1, i2))
+        elif j1 < j2:
+            delta.append(''.join(lines[j1:j2]))
+    return delta
+
+
+#===================================================================================================
+# apply_delta
+#===================================================================================================
+def apply_delta(base, delta):
+    base_lines = base.splitlines(True)
+    parts = []
+    for part in delta:
+        if isinstance(part, tuple):
+            parts.extend(base_lines[part[0]:part[1]])
+        else:
+            parts.append(part)
+    return ''.join(parts)
+
+
+#===================================================================================================
+# create_jenkins_client
+#===================================================================================================
+DEFAULT_INDEX_TTL = 300
+# Jenkins can't tell if a source configuration has changed, so it's fetched by each command
+DEFAULT_TEMPLATE_TTL = 0
+DEFAULT_TIMEOUT = 30
+DEFAULT_DEADLINE = 300
+DEFAULT_RETRIES = 2
+
+def create_jenkins_client(global_config, deadline=True):
+    '''
+    Creates a JenkinsClient for the server in the global config, with a JobIndex kept in cit's 
+    cache directory (unless disabled by setting "index-ttl" to 0) and a TemplateCache (whose 
+    configurations are kept for "template-ttl" seconds, if they can't be revalidated), and a SnapshotStore
+    in "snapshot-dir" (unless it's null). While serving (`cit_serve`), clients are reused by later 
+    commands.
+    
+    Requests are limited by "timeout" and "retries", and optionally hedged after the latency 
+    percentile in "hedge-percentile". 
+    
+    :param deadline: if False, the command's requests are not limited by the "deadline" (for 
+        commands that run until interrupted).
+    '''
+    jenkins_config = global_config['jenkins']
+    url = jenkins_config['url']
+    ttl = jenkins_config.get('index-ttl', DEFAULT_INDEX_TTL)
+    cache_dir = get_cache_dir(global_config)
+    
+    template_ttl = jenkins_config.get('template-ttl', DEFAULT_TEMPLATE_TTL)
+    snapshot_dir = global_config.get('snapshot-dir')
+    key = (url, ttl, template_ttl, cache_dir, snapshot_dir)
+    if _shared_clients is not None and key in _shared_clients:
+        jenkins = _shared_clients[key]
+    else:
+        jenkins = _create_jenkins_client(url, ttl, template_ttl, cache_dir, snapshot_dir)
+        if _shared_clients is not None:
+            jenkins.persistent = True
+            _shared_clients[key] = jenkins
+        
+    jenkins.timeout = jenkins_config.get('timeout', DEFAULT_TIMEOUT)
+    jenkins.retries = jenkins_config.get('retries', DEFAULT_RETRIES)
+    jenkins.hedge_percentile = jenkins_config.get('hedge-percentile')
+    jenkins.set_deadline(jenkins_config.get('deadline', DEFAULT_DEADLINE) if deadline else None)
+    return jenkins
+
+
+def _create_jenkins_client(url, ttl, template_ttl, cache_dir, snapshot_dir):
+    import zlib
+    
+    index = None
+    templates = None
+    if cache_dir is not None:
+        if ttl:
+            filename = os.path.join(cache_dir, 'jobs-%08x.cache' % (zlib.crc32(url) & 0xffffffff))
+            index = JobIndex(filename, url, ttl)
+        templates = TemplateCache(cache_dir, url, template_ttl)
+    snapshots = None
+    if snapshot_dir is not None:
+        snapshots = SnapshotStore(snapshot_dir, url)
+    return JenkinsClient(url, index, templates, snapshots)
+
+
+#===================================================================================================
+# job_path
+#===================================================================================================
+def job_path(name):
+    '''
+    Returns the path of the given job, with jobs in folders named by their full name ("folder/job").
+    '''
+    import urllib
+    return ''.join('/job/%s' % urllib.quote(part, safe='') for part in name.split('/'))
+
+
+#===================================================================================================
+# is_running
+#===================================================================================================
+def is_running(job_info):
+    '''
+    Returns True if the job has a build in progress, given its data containing the "color" field
+    (Jenkins animates the job's ball while it is building). 
+    '''
+    return job_info.get('color', '').endswith('_anime')
+
+
+#===================================================================================================
+# cit server
+# ----------
+#
+# "cit serve" keeps a process running which executes the commands of other cit processes, so 
+# they reuse its loaded configuration, open connections and job index instead of starting from 
+# scratch. Commands are forwarded through a Unix socket in cit's cache directory.
+#
+#===================================================================================================
+
+# commands executed by a running "cit serve"; commands that follow builds for a long time (watch,
+# log) or are interactive (init) always run in their own process
+FORWARDED_COMMANDS = ('add', 'rm', 'start', 'notify', 'prune', 'sync')
+
+# while serving: loaded configuration files by name, as (key, marshalled data) 
+_config_memo = None
+
+# while serving: JenkinsClients kept open between commands
+_shared_clients = None
+
+#===================================================================================================
+# cit_serve
+#===================================================================================================
+def cit_serve(global_config_file):
+    '''
+    Executes commands forwarded by other cit processes until interrupted (Ctrl+C).
+    '''
+    import socket
+    
+    if not hasattr(socket, 'AF_UNIX'):
+        print >> sys.stderr, 'cit serve is not supported in this platform'
+        return RETURN_CODE_UNKNOWN_COMMAND
+    
+    socket_path = get_server_socket(global_config_file)
+    if os.path.exists(socket_path):
+        if _connect_to_server(socket_path) is not None:
+            print >> sys.stderr, 'cit is already being served at %s' % socket_path
+            return RETURN_CODE_UNKNOWN_COMMAND
+        # left behind by a server which didn't exit cleanly
+        os.remove(socket_path)
+    
+    server = create_command_server(socket_path)
+    print 'serving cit commands at %s (Ctrl+C to stop)' % socket_path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return RETURN_CODE_OK
+
+
+#===================================================================================================
+# create_command_server
+#===================================================================================================
+def create_command_server(socket_path):
+    '''
+    Creates a server executing commands forwarded by `forward_command`, one at a time, listening
+    on the given Unix socket. While the server is open configuration files and Jenkins clients 
+    are kept in memory; `server_close` releases them and removes the socket.
+    '''
+    import SocketServer
+    
+    class _CommandServer(SocketServer.UnixStreamServer):
+        
+        def server_close(self):
+            global _config_memo, _shared_clients
+            SocketServer.UnixStreamServer.server_close(self)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            clients, _shared_clients, _config_memo = _shared_clients or {}, None, None
+            for client in clients.itervalues():
+                client.persistent = False
+                client.close()
+                
+    class _CommandHandler(SocketServer.StreamRequestHandler):
+        
+        def handle(self):
+            import json
+            import struct
+            import threading
+            
+            size = struct.unpack('!I', self.rfile.read(4))[0]
+            request = json.loads(self.rfile.read(size))
+            lock = threading.Lock()
+            return_code = run_forwarded_command(
+                request,
+                _ChannelWriter(self.wfile, 'o', lock),
+                _ChannelWriter(self.wfile, 'e', lock),
+            )
+            _ChannelWriter(self.wfile, 'x', lock).write(str(return_code))
+            
+    global _config_memo, _shared_clients
+    directory = os.path.dirname(socket_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    server = _CommandServer(socket_path, _CommandHandler)
+    _config_memo = {}
+    _shared_clients = {}
+    return server
+
+
+#===================================================================================================
+# run_forwarded_command
+#===================================================================================================
+def run_forwarded_command(request, stdout, stderr):
+    '''
+    Executes a command forwarded by `forward_command` in this process, as if it were running in the
+    forwarding process: same arguments, current directory and environment variables.
+    
+    :return: the command's return code.
+    '''
+    import traceback
+    
+    def to_str(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    
+    saved = os.getcwd(), dict(os.environ), sys.stdout, sys.stderr
+    try:
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update((to_str(name), to_str(value)) for name, value in request['env'].iteritems())
+        sys.stdout, sys.stderr = stdout, stderr
+        # git files (HEAD, config) may have changed since the last command
+        _git_cache.clear()
+        try:
+            argv = [to_str(arg) for arg in request['argv']]
+            return main(argv, to_str(request['global_config_file']), forward=False)
+        except Exception:
+            traceback.print_exc(file=stderr)
+            return 1
+    finally:
+        cwd, environ, sys.stdout, sys.stderr = saved
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+
+
+#===================================================================================================
+# forward_command
+#===================================================================================================
+def forward_command(global_config_file, argv):
+    '''
+    Executes the command given by argv in a running "cit serve" process (if there's one for the
+    given global config), writing its output to stdout and stderr as it is produced.
+    
+    :return: the command's return code, or None if no server is running.
+    '''
+    socket_path = get_server_socket(global_config_file)
+    if not os.path.exists(socket_path):
+        return None
+    connection = _connect_to_server(socket_path)
+    if connection is None:
+        return None
+    
+    import json
+    import struct
+    
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+        request = json.dumps({
+            'argv' : argv,
+            'cwd' : os.getcwd(),
+            'env' : dict(os.environ),
+            'global_config_file' : os.path.abspath(global_config_file),
+        })
+        connection.sendall(struct.pack('!I', len(request)) + request)
+        
+        stream = connection.makefile('rb')
+        while True:
+            header = stream.read(5)
+            if len(header) < 5:
+                print >> stderr, 'cit server closed the connection'
+                return RETURN_CODE_JOB_FAILED
+            channel, size = struct.unpack('!cI', header)
+            data = stream.read(size)
+            if channel == 'x':
+                return int(data)
+            output = stdout if channel == 'o' else stderr
+            output.write(data)
+            output.flush()
+    finally:
+        connection.close()
+        
+        
+def _connect_to_server(socket_path):
+    '''
+    :return: a socket connected to the server at the given path, or None if it's not running.
+    '''
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+
+#===================================================================================================
+# get_server_socket
+#===================================================================================================
+def get_server_socket(global_config_file):
+    '''
+    Returns the path of the socket used by "cit serve" for the given global config file.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(global_config_file)), '.cit-cache', 'cit.sock')
+
+
+#===================================================================================================
+# _ChannelWriter
+#===================================================================================================
+class _ChannelWriter(object):
+    '''
+    File-like object sending what is written to it to the forwarding process, as messages tagged 
+    with the channel they belong to: "o" (stdout), "e" (stderr) or "x" (return code).
+    '''
+    
+    softspace = 0
+    
+    def __init__(self, stream, channel, lock):
+        self.stream = stream
+        self.channel = channel
+        self.lock = lock
+        
+        
+    def write(self, data):
+        import struct
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self.lock:
+            self.stream.write(struct.pack('!cI', self.channel, len(data)) + data)
+            self.stream.flush()
+            
+            
+    def flush(self):
+        pass
+
+
+#===================================================================================================
+# cit configuration
+# -----------------
+#
+# Functions and commands that deal with cit's configuration. 
+#  
+#===================================================================================================
+
+#===================================================================================================
+# cit_init
+#===================================================================================================
+def cit_init(global_config, stdin):
+    cit_file_name, config = load_cit_local_config(os.getcwd(), get_cache_dir(global_config))
+    
+    print 'Configuring jobs for feature branches: %s' % cit_file_name
+    print 
+    
+    updated = 0
+    while True:
+        sys.stdout.write('Source job (empty to exit):      ')
+        source_job = stdin.readline().strip()
+        if not source_job:
+            break
+        
+        sys.stdout.write('Feature job (shh, use $name):    ')
+        fb_job = stdin.readline().strip()
+        if not fb_job:
+            break
+        
+        fb_data = {
+            'source-job' : source_job,
+            'feature-branch-job' : fb_job, 
+        }
+        config.setdefault('jobs', []).append(fb_data)
+        updated += 1
+        print 'Done! Next?'
+        print
+        
+    print 
+    if updated:
+        f = file(cit_file_name, 'w')
+        f.write(dump_yaml(config))
+        f.close()
+        print 'Done! Configured %d job(s)!' % updated
+    else:
+        print 'Abort? Okaay.'
+    
+    
+#===================================================================================================
+# cit_install
+#===================================================================================================
+def cit_install(global_config_file, stdin):
+    print '=' * 60
+    print 'Configuration'
+    print '=' * 60
+    sys.stdout.write('- Enter Jenkins URL:   ')
+    jenkins_url = stdin.readline().strip()
+    if not jenkins_url.startswith('http'):
+        jenkins_url = 'http://' + jenkins_url
+        
+    print
+    print 'Checking Jenkins server...',
+    try:
+        with contextlib.closing(JenkinsClient(jenkins_url)) as jenkins:
+            jenkins.get_json('', tree='mode')
+    except JenkinsError, e:
+        print 'ERROR (%s)' % e
+    else:
+        print 'OK'
+    
+    config = {
+    'jenkins' : {
+        'url' : jenkins_url,
+        }
+    }
+    
+    f = file(global_config_file, 'w')
+    f.write(dump_yaml(config))
+    f.close()
+    
+
+#===================================================================================================
+# get_configured_jobs
+#===================================================================================================
+def get_configured_jobs(branch, job_config):  
+    folder = get_feature_folder(branch, job_config)
+    for job in job_config['jobs']:
+        job_name = job['source-job'] 
+        new_job_name = job['feature-branch-job'].replace('$name', branch)
+        if folder:
+            new_job_name = folder + '/' + new_job_name
+        yield job_name, new_job_name
+        
+        
+#===================================================================================================
+# get_feature_folder
+#===================================================================================================
+def get_feature_folder(branch, job_config):
+    '''
+    Returns the folder of the feature jobs of the given branch, from the "folder" in .cit.yaml: a
+    folder for the feature jobs of all branches, or for each branch if it contains "$name" (only
+    allowed in its last part). Returns '' if feature jobs are not in a folder.
+    
+    :raise RuntimeError: if the branch contains "/", which would put its feature jobs in 
+        subfolders (and make them look like the jobs of another branch).
+    '''
+    if '/' in branch:
+        raise RuntimeError('feature jobs can not be made for branches with "/" in their name: %s' % branch)
+    return get_folder_pattern(job_config).replace('$name', branch)
+
+
+#===================================================================================================
+# get_folder_pattern
+#===================================================================================================
+def get_folder_pattern(job_config):
+    '''
+    Returns the "folder" in .cit.yaml, with "$name" for the branch ('' if not in a folder).
+    
+    :raise RuntimeError: if "$name" is not only in the last part of the folder: the folders of all
+        branches must be in the same parent folder, to be found with a single request.
+    '''
+    folder = job_config.get('folder') or ''
+    if '$name' in folder.rpartition('/')[0]:
+        raise RuntimeError('"$name" is only allowed in the last part of the folder in .cit.yaml: %r' % folder)
+    return folder
+
+
+#===================================================================================================
+# get_feature_job_infos
+#===================================================================================================
+def get_feature_job_infos(jenkins, job_config, fields, branches=None):
+    '''
+    Fetches the given fields of the jobs where the feature jobs of the given branches (or of all 
+    branches) are, with a single request: all jobs in Jenkins, or only the jobs in their folder.
+    
+    :return: dict with the data of each job, by full name.
+    '''
+    folder = get_folder_pattern(job_config)
+    if '$name' not in folder:
+        jobs = jenkins.get_jobs(fields, folder)
+    elif branches is not None and len(branches) == 1:
+        jobs = jenkins.get_jobs(fields, get_feature_folder(branches[0], job_config))
+    else:
+        # the folders of all branches are in the same parent folder
+        jobs = jenkins.get_jobs(fields, folder.rpartition('/')[0], subfolders=True)
+    return dict((job['name'], job) for job in jobs)
+
+
+#===================================================================================================
+# remove_feature_jobs
+#===================================================================================================
+def remove_feature_jobs(jenkins, job_config, jobs, workers, job_names=None):
+    '''
+    Removes the given feature jobs concurrently (see `remove_feature_job`). With a folder for each
+    branch, the folder of each branch is removed at once with all jobs in it, instead of each job, 
+    if it only has the jobs to remove (otherwise only those jobs are removed, and the folder is 
+    kept).
+    
+    :param jobs: list of items ((source job name, branch), new job name).
+    :param job_names: full names of the jobs in the folders of the branches, if just fetched (see 
+        `get_feature_job_infos`); otherwise the folder of each branch is listed before removing it.
+    :return: iterator of (item, status, error) like `run_concurrently`, with status 'REMOVED' or
+        'NOT FOUND'.
+    '''
+    # only the configurations cit doesn't know already are fetched for the snapshot
+    known_configs = {}
+    if jenkins.snapshots is not None:
+        known_configs = jenkins.snapshots.get_configs(new_job_name for _, new_job_name in jobs)
+    
+    if '$name' not in get_folder_pattern(job_config):
+        def rm_job(item):
+            (job_name, branch), new_job_name = item
+            return remove_feature_job(jenkins, new_job_name, branch, job_name, known_configs.get(new_job_name))
+        return run_concurrently(rm_job, jobs, workers)
+    
+    source_jobs = dict((new_job_name, job_name) for (job_name, _), new_job_name in jobs)
+    
+    def rm_folder(branch):
+        folder = get_feature_folder(branch, job_config)
+        if job_names is None:
+            # not from the job index: it may not know about jobs created by others
+            folder_jobs = set(job['name'] for job in jenkins.get_jobs('name,color', folder))
+        else:
+            folder_jobs = set(name for name in job_names if name.rpartition('/')[0] == folder)
+        branch_jobs = set(new_job_name for (_, job_branch), new_job_name in jobs if job_branch == branch)
+        existing = branch_jobs & folder_jobs
+        if not existing:
+            return existing
+        if not folder_jobs <= branch_jobs:
+            # the folder has other jobs, which are not cit's to remove
+            return set(new_job_name for new_job_name in existing if remove_feature_job(
+                jenkins, new_job_name, branch, source_jobs[new_job_name], 
+                known_configs.get(new_job_name)) == 'REMOVED')
+        
+        configs = {}
+        try:
+            if jenkins.snapshots is not None:
+                for new_job_name in sorted(existing):
+                    configs[new_job_name] = known_configs.get(new_job_name) or jenkins.get_job_config(new_job_name)
+            jenkins.delete_job(folder)
+        except UnknownJob:
+            return set()
+        for new_job_name, config in configs.iteritems():
+            jenkins.snapshots.record(new_job_name, branch, config, None, source_job=source_jobs[new_job_name])
+        return existing
+    
+    branches = []
+    for (_, branch), _ in jobs:
+        if branch not in branches:
+            branches.append(branch)
+    removed = dict((branch, (existing, error)) 
+                   for branch, existing, error in run_concurrently(rm_folder, branches, workers))
+    
+    def results():
+        for item in jobs:
+            (_, branch), new_job_name = item
+            existing, error = removed[branch]
+            if error is not None:
+                yield item, None, error
+            else:
+                yield item, 'REMOVED' if new_job_name in existing else 'NOT FOUND', None
+    return results()
+
+
+#===================================================================================================
+# run_on_servers
+#===================================================================================================
+def run_on_servers(command, global_config, grouped=True):
+    '''
+    Runs command(server_global_config) for each Jenkins server used by the jobs in .cit.yaml.
+    
+    Jobs are configured in the "jenkins" server of the global config unless they name one of
+    the "servers" in it. With more than one server, the command runs for all of them 
+    concurrently, each with its own client, and `load_job_config` only returns the jobs of the 
+    server the command is running for.
+    
+    :param grouped: the output of each server is printed at once under a header with its name,
+        as soon as the command finishes for that server; otherwise output is printed as it is 
+        produced (for commands which follow builds, like "watch").
+    :return: the sum of the results of the command (the number of failures).
+    '''
+    if not global_config.get('servers'):
+        return command(global_config)
+    
+    _, job_config = load_cit_local_config(os.getcwd(), get_cache_dir(global_config))
+    server_names = []
+    for job in job_config['jobs']:
+        if job.get('server') not in server_names:
+            server_names.append(job.get('server'))
+            
+    failures = 0
+    servers = []
+    for server_name in server_names:
+        try:
+            servers.append(get_server_config(global_config, server_name))
+        except KeyError:
+            print >> sys.stderr, 'unknown server in .cit.yaml: %s' % server_name
+            failures += 1
+    
+    if len(servers) == 1:
+        return failures + command(servers[0])
+    
+    def run(server_config):
+        if grouped:
+            output.capture()
+        try:
+            return command(server_config)
+        finally:
+            if grouped:
+                server_output[server_config['server']] = output.release()
+    
+    server_output = {}
+    output = _ThreadOutput(sys.stdout)
+    if grouped:
+        sys.stdout = output
+    try:
+        # output of the servers is printed by this thread, which is not capturing its output
+        for server_config, result, error in run_concurrently(run, servers, len(servers), ordered=False):
+            if grouped:
+                print '%s: %s' % (server_config['server'] or 'jenkins', server_config['jenkins']['url'])
+                sys.stdout.write(server_output.pop(server_config['server']))
+            if error is not None:
+                print '%s (%s)' % (server_config['jenkins']['url'], format_error(error))
+                failures += 1
+            else:
+                failures += result
+    finally:
+        sys.stdout = output.stream
+    return failures
+
+
+#===================================================================================================
+# get_server_config
+#===================================================================================================
+def get_server_config(global_config, server_name):
+    '''
+    Returns a copy of the global config for running commands on the given server (None for the
+    default "jenkins" server), with the server's configuration as its "jenkins" section.
+    
+    :raise KeyError: if the server is not configured.
+    '''
+    server_config = dict(global_config, server=server_name)
+    if server_name is not None:
+        server_config['jenkins'] = global_config.get('servers', {})[server_name]
+    return server_config
+
+
+#===================================================================================================
+# load_job_config
+#===================================================================================================
+def load_job_config(global_config):
+    '''
+    Loads the .cit.yaml file of the current git repository.
+    
+    :return: tuple (.cit.yaml file name, loaded config), with only the jobs of the server given 
+        by `get_server_config` if the config is for a specific server.
+    '''
+    cit_file_name, job_config = load_cit_local_config(os.getcwd(), get_cache_dir(global_config))
+    if 'server' in global_config:
+        server_name = global_config['server']
+        jobs = [job for job in job_config['jobs'] if job.get('server') == server_name]
+        job_config = dict(job_config, jobs=jobs)
+    return cit_file_name, job_config
+
+
+#===================================================================================================
+# _ThreadOutput
+#===================================================================================================
+class _ThreadOutput(object):
+    '''
+    Stand-in for sys.stdout which keeps what is written by threads capturing their output in a 
+    buffer for each thread, writing everything else to the original stream.
+    '''
+    
+    def __init__(self, stream):
+        import threading
+        self.stream = stream
+        self._local = threading.local()
+        
+        
+    def capture(self):
+        import StringIO
+        self._local.buffer = StringIO.StringIO()
+        
+        
+    def release(self):
+        '''
+        Stops capturing the output of the current thread.
+        
+        :return: the captured output.
+        '''
+        buffer = self._local.buffer
+        del self._local.buffer
+        return buffer.getvalue()
+    
+    
+    def write(self, data):
+        getattr(self._local, 'buffer', self.stream).write(data)
+        
+        
+    def flush(self):
+        if getattr(self._local, 'buffer', None) is None:
+            self.stream.flush()
+            
+            
+    # used by the print statement between items
+    softspace = property(lambda self: getattr(self._local, 'softspace', 0),
+                         lambda self, value: setattr(self._local, 'softspace', value))
+            
+            
+#===================================================================================================
+# load_cit_local_config
+#===================================================================================================
+def load_cit_local_config(from_dir, cache_dir=None):
+    '''
+    Finds the root of the git repository containing `from_dir`, loading its .cit.yaml file.
+    
+    :param cache_dir: if given, the parsed config is cached in this directory (see 
+        `load_config_file`).
+    :return: tuple (.cit.yaml file name, loaded config).
+    '''
+    tries = 0
+    max_tries = 20
+    while True:
+        gitdir = os.path.join(from_dir, '.git')
+        if os.path.exists(gitdir):
+            break
+        from_dir = os.path.dirname(from_dir)
+        
+        tries += 1    
+        if tries >= max_tries:
+            raise RuntimeError('could not find .git directory')
+        
+    cit_file_name = os.path.join(from_dir, '.cit.yaml')
+    
+    config = {}
+    if os.path.isfile(cit_file_name):
+        loaded_config = load_config_file(cit_file_name, cache_dir) or {}
+        config.update(loaded_config)
+        
+    return cit_file_name, config
+
+
+#===================================================================================================
+# load_config_file
+#===================================================================================================
+def load_config_file(filename, cache_dir=None):
+    '''
+    Loads the given yaml configuration file.
+    
+    If `cache_dir` is given, the loaded data is also saved there in a binary form, which is used 
+    instead of parsing the file again while its size and modification time don't change. While
+    serving (`cit_serve`), it is also kept in memory.
+    '''
+    import marshal
+    import zlib
+    
+    stat = os.stat(filename)
+    filename = os.path.abspath(filename)
+    key = (filename, stat.st_mtime, stat.st_size)
+    
+    with trace('config', os.path.basename(filename), file=filename) as event:
+        if _config_memo is not None and filename in _config_memo and _config_memo[filename][0] == key:
+            event['cached'] = True
+            # a new copy for each command, which may change it
+            return marshal.loads(_config_memo[filename][1])
+        
+        cache_file = None
+        data = None
+        event['cached'] = False
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, 'config-%08x.cache' % (zlib.crc32(filename) & 0xffffffff))
+            cached = read_cache_file(cache_file)
+            if cached is not None and cached[0] == key:
+                event['cached'] = True
+                data = cached[1]
+            
+        if not event['cached']:
+            f = file(filename)
+            try:
+                data = load_yaml(f.read())
+            finally:
+                f.close()
+            if cache_file is not None:
+                write_cache_file(cache_file, (key, data))
+            
+        if _config_memo is not None:
+            _config_memo[filename] = (key, marshal.dumps(data))
+        return data
+
+
+#===================================================================================================
+# load_yaml
+#===================================================================================================
+def load_yaml(contents):
+    '''
+    Parses yaml contents, using the much faster LibYAML based loader if it is available.
+    '''
+    import yaml
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
+    return yaml.load(contents, Loader=loader)
+
+
+#===================================================================================================
+# dump_yaml
+#===================================================================================================
+def dump_yaml(data):
+    import yaml
+    return yaml.dump(data, default_flow_style=False)
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv, global_config_file=None, stdin=None, forward=True):
+    # default values
+    if global_config_file is None:
+        global_config_file = os.path.join(os.path.dirname(__file__), 'citconfig.yaml')
+        
+    if stdin is None:
+        stdin = sys.stdin
+        
+    argv = list(argv)
+    
+    # use a running "cit serve", if there's one
+    if forward and len(argv) > 1 and argv[1] in FORWARDED_COMMANDS:
+        return_code = forward_command(global_config_file, argv)
+        if return_code is not None:
+            return return_code
+    
+    trace_format, trace_file = pop_trace_options(argv)
+    if trace_format is not None and _tracer is None:
+        with traced(trace_format, trace_file):
+            with trace('command', ' '.join(argv[1:2])):
+                return main(argv, global_config_file, stdin, forward=False)
+    
+    workers = pop_option(argv, '--jobs', '-j')
+    job_pattern = pop_option(argv, '--job')
+    remote = pop_option(argv, '--remote')
+    dry_run = '--dry-run' in argv
+    if dry_run:
+        argv.remove('--dry-run')
+    plan_only = '--plan' in argv
+    if plan_only:
+        argv.remove('--plan')
+    all_branches = '--all' in argv
+    if all_branches:
+        argv.remove('--all')
+    workspace = pop_option(argv, '--workspace')
+    snapshot_id = pop_option(argv, '--to')
+    list_only = '--list' in argv
+    if list_only:
+        argv.remove('--list')
+        
+    # --install option: used to initialize configuration
+    if '--install' in argv:
+        cit_install(global_config_file, stdin)
+        return RETURN_CODE_OK
+    
+    # read global config
+    if not os.path.isfile(global_config_file):
+        print >> sys.stderr, 'could not find cit config file at: %s' % global_config_file
+        return RETURN_CODE_CONFIG_NOT_FOUND
+        
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(global_config_file)), '.cit-cache')
+    global_config = load_config_file(global_config_file, cache_dir)
+    global_config.setdefault('cache-dir', cache_dir)
+    global_config.setdefault('snapshot-dir', os.path.join(os.path.dirname(cache_dir), '.cit-snapshots'))
+    if workers is not None:
+        global_config['workers'] = int(workers)
+    
+    # command dispatch
+    if len(argv) <= 1:
+        print_help() 
+        return RETURN_CODE_OK
+    elif argv[1] == 'init':
+        cit_init(global_config, stdin)
+        return RETURN_CODE_OK
+    elif argv[1] == 'serve':
+        return cit_serve(global_config_file)
+    elif workspace is not None:
+        if argv[1] not in WORKSPACE_COMMANDS:
+            print '--workspace can only be used with: %s' % ', '.join(WORKSPACE_COMMANDS)
+            return RETURN_CODE_UNKNOWN_COMMAND
+        branch = argv[2] if len(argv) > 2 else None
+        if cit_workspace(argv[1], workspace, branch, global_config):
+            return RETURN_CODE_JOB_FAILED
+        return RETURN_CODE_OK
+    elif argv[1] in ('add', 'start', 'rm', 'notify', 'watch', 'log', 'prune', 'sync', 'rollback'):
+        if len(argv) > 2:
+            branch = argv[2]
+        else:
+            branch = None
+        commands = {
+            'add' : lambda config: cit_add(branch, config),
+            'start' : lambda config: cit_start(argv[2:], config, all_branches),
+            'rm' : lambda config: cit_rm(branch, config),
+            'notify' : lambda config: cit_notify(branch, config),
+            'watch' : lambda config: cit_watch(branch, config),
+            'log' : lambda config: cit_log(branch, config, job_pattern),
+            'prune' : lambda config: cit_prune(config, dry_run, remote),
+            'sync' : lambda config: cit_sync(config, plan_only, remote),
+            'rollback' : lambda config: cit_rollback(branch, config, snapshot_id, all_branches, list_only),
+        }
+        grouped = argv[1] not in ('watch', 'log')
+        failures = run_on_servers(commands[argv[1]], global_config, grouped)
+        if failures:
+            return RETURN_CODE_JOB_FAILED
+        return RETURN_CODE_OK
+    else:
+        print 'Unknown command: "%s"' % argv[1]
+        print_help()
+        return RETURN_CODE_UNKNOWN_COMMAND
+
+    return RETURN_CODE_OK
+
+
+# Error Codes --------------------------------------------------------------------------------------
+
+RETURN_CODE_OK = 0 
+RETURN_CODE_UNKNOWN_COMMAND = 2
+RETURN_CODE_CONFIG_NOT_FOUND = 3 
+RETURN_CODE_JOB_FAILED = 4
+
+
+#===================================================================================================
+# print_help
+#===================================================================================================
+def print_help():
+    print 'Commands:'    
+    print     
+    print '    init                   configures jobs for feature branches for this git repo'
+    print '    add [BRANCH]           add a new feature branch job to Jenkins'
+    print '    start [BRANCH...]      starts a new build for the given feature branches'
+    print '        [--all]            of all branches with feature jobs'
+    print '    rm [BRANCH]            removes job for feature branches given'
+    print '    notify [BRANCH]        notifies Jenkins that the given branch has been pushed'
+    print '    watch [BRANCH]         shows the status of the builds of the given branch until they finish'
+    print '    log [BRANCH]           shows the console output of the builds of the given branch'
+    print '        [--job PATTERN]    only of jobs matching the given pattern'
+    print '    prune                  removes feature jobs of branches that don\'t exist anymore'
+    print '        [--dry-run]        only lists the jobs that would be removed'
+    print '        [--remote REMOTE]  uses the branches in the given remote instead of the local ones'
+    print '    sync                   updates the feature jobs of all branches with the configuration in .cit.yaml'
+    print '        [--plan]           only lists the changes that would be made'
+    print '        [--remote REMOTE]  uses the branches in the given remote instead of the local ones'
+    print '    rollback [BRANCH]      restores the feature jobs of the given branch before the last change'
+    print '        [--to SNAPSHOT]    before the given snapshot and all later changes'
+    print '        [--all]            of all branches'
+    print '        [--list]           only lists the snapshots'
+    print '    serve                  keeps running to execute the commands of other cit processes faster'
+    print    
+    print 'Options:'
+    print
+    print '    -j, --jobs N           number of jobs handled in parallel (default: %d)' % DEFAULT_WORKERS
+    print '    --workspace DIR        runs add, start or rm for all repositories under DIR at once'
+    print '    --trace[=FORMAT]       reports the time spent in requests and other operations, as a'
+    print '                           summary (default), json or chrome (chrome://tracing) trace'
+    print '    --trace-file FILE      writes the trace report to FILE instead of stderr'
+    print
+
+
+#===================================================================================================
+# tracing
+# -------
+#
+# Optional record of where cit spends its time (requests, subprocesses, configuration files and
+# the phases of configuring jobs), enabled with --trace or the CIT_TRACE environment variable.
+#
+#===================================================================================================
+
+TRACE_FORMATS = ('summary', 'json', 'chrome')
+
+# Tracer collecting events, or None while tracing is disabled
+_tracer = None
+
+#===================================================================================================
+# trace
+#===================================================================================================
+def trace(category, name, **args):
+    '''
+    Context manager recording the time taken by the code inside it as an event, if tracing is 
+    enabled. The dict returned by the context manager may be filled with more data about the 
+    event (such as the status of a request); while tracing is disabled, it is simply discarded.
+    
+    Usage::
+    
+        with trace('http', 'GET', url=url) as event:
+            ...
+            event['status'] = status
+    '''
+    if _tracer is None:
+        return _NULL_EVENT
+    return _tracer.event(category, name, args)
+
+
+class _NullEvent(object):
+    
+    def __enter__(self):
+        return {}
+    
+    def __exit__(self, *exc_info):
+        pass
+    
+_NULL_EVENT = _NullEvent()
+
+
+#===================================================================================================
+# Tracer
+#===================================================================================================
+class Tracer(object):
+    '''
+    Collects the events recorded by `trace`, from any thread.
+    '''
+    
+    def __init__(self, clock=None):
+        import threading
+        import time
+        
+        self.clock = clock or time.time
+        self.start = self.clock()
+        self.events = []
+        self.lock = threading.Lock()
+        self._threads = {}
+        
+        
+    @contextlib.contextmanager
+    def event(self, category, name, args):
+        import threading
+        
+        start = self.clock()
+        try:
+            yield args
+        finally:
+            duration = self.clock() - start
+            thread = threading.current_thread().ident
+            with self.lock:
+                self.events.append({
+                    'category' : category,
+                    'name' : name,
+                    'start' : start - self.start,
+                    'duration' : duration,
+                    'thread' : self._threads.setdefault(thread, len(self._threads) + 1),
+                    'args' : args,
+                })
+                
+                
+    def write_summary(self, stream, slowest=10):
+        '''
+        Writes a table with the number of events, total and maximum time and bytes transferred 
+        for each category (and for each request method), followed by the slowest events.
+        '''
+        totals = {}
+        for event in self.events:
+            keys = [event['category']]
+            if event['category'] == 'http':
+                keys.append('http %s' % event['name'])
+            for key in keys:
+                count, total, maximum, size = totals.get(key, (0, 0.0, 0.0, 0))
+                totals[key] = (count + 1, total + event['duration'], max(maximum, event['duration']),
+                               size + event['args'].get('bytes', 0))
+        
+        stream.write('%-20s %8s %10s %10s %12s\n' % ('', 'count', 'total (s)', 'max (s)', 'bytes'))
+        for key in sorted(totals):
+            stream.write('%-20s %8d %10.3f %10.3f %12d\n' % ((key,) + totals[key]))
+            
+        stream.write('\nslowest:\n')
+        events = sorted(self.events, key=lambda event: event['duration'], reverse=True)
+        for event in events[:slowest]:
+            details = ' '.join('%s=%s' % item for item in sorted(event['args'].iteritems()))
+            stream.write('%10.3f  %-12s %s %s\n' % (event['duration'], event['category'], event['name'], details))
+            
+            
+    def write_json(self, stream):
+        '''
+        Writes all events as a json list, with times in seconds since tracing started.
+        '''
+        import json
+        json.dump(self.events, stream, indent=1, sort_keys=True)
+        stream.write('\n')
+        
+        
+    def write_chrome_trace(self, stream):
+        '''
+        Writes all events in the Trace Event Format, which can be opened in chrome://tracing.
+        '''
+        import json
+        trace_events = [{
+            'name' : event['name'],
+            'cat' : event['category'],
+            'ph' : 'X',
+            'ts' : int(event['start'] * 1e6),
+            'dur' : int(event['duration'] * 1e6),
+            'pid' : 1,
+            'tid' : event['thread'],
+            'args' : event['args'],
+        } for event in self.events]
+        json.dump({'traceEvents' : trace_events}, stream)
+        stream.write('\n')
+        
+        
+#===================================================================================================
+# traced
+#===================================================================================================
+@contextlib.contextmanager
+def traced(trace_format, trace_file=None):
+    '''
+    Enables tracing while inside the context manager, writing the events in the given format
+    (one of TRACE_FORMATS) to the given file, or to stderr, at the end.
+    '''
+    global _tracer
+    _tracer = Tracer()
+    try:
+        yield _tracer
+    finally:
+        tracer, _tracer = _tracer, None
+        stream = sys.stderr if trace_file is None else file(trace_file, 'w')
+        try:
+            if trace_format == 'json':
+                tracer.write_json(stream)
+            elif trace_format == 'chrome':
+                tracer.write_chrome_trace(stream)
+            else:
+                tracer.write_summary(stream)
+        finally:
+            if trace_file is not None:
+                stream.close()
+
+
+#===================================================================================================
+# pop_trace_options
+#===================================================================================================
+def pop_trace_options(argv):
+    '''
+    Removes the tracing options from argv (in place): "--trace" (summary) or "--trace=FORMAT", and
+    "--trace-file FILE". The CIT_TRACE and CIT_TRACE_FILE environment variables are used when the
+    options are not given.
+    
+    :return: tuple (format, file): format is None if tracing is disabled, and file is None to
+        write to stderr.
+    '''
+    trace_format = os.environ.get('CIT_TRACE') or None
+    if '--trace' in argv:
+        argv.remove('--trace')
+        trace_format = 'summary'
+    else:
+        trace_format = pop_option(argv, '--trace') or trace_format
+        
+    if trace_format is not None and trace_format not in TRACE_FORMATS:
+        # CIT_TRACE=1, for instance
+        trace_format = 'summary'
+        
+    trace_file = pop_option(argv, '--trace-file') or os.environ.get('CIT_TRACE_FILE') or None
+    return trace_format, trace_file
+
+
+#===================================================================================================
+# general utilities
+# -----------------
+# 
+# General utilities that didn't fit in any other category. 
+#
+#===================================================================================================
+
+#===================================================================================================
+# check_output
+#===================================================================================================
+def check_output(*args, **kwargs):
+    '''
+    Support subprocess.check_output for Python < 2.7
+    '''
+    import subprocess
+    with trace('subprocess', ' '.join(args[0])):
+        try:
+            return subprocess.check_output(*args, **kwargs)
+        except AttributeError:
+            kwargs['stdout'] = subprocess.PIPE
+            popen = subprocess.Popen(*args, **kwargs)
+            stdout, stderr = popen.communicate()
+            if popen.returncode != 0:
+                raise subprocess.CalledProcessError
+            return stdout
+
+#===================================================================================================
+# read_cache_file
+#===================================================================================================
+def read_cache_file(filename):
+    '''
+    Reads data saved with `write_cache_file`, returning None if the file doesn't exist or is 
+    not valid.
+    '''
+    import marshal
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        f.close()
+    
+
+#===================================================================================================
+# write_cache_file
+#===================================================================================================
+def write_cache_file(filename, data):
+    '''
+    Saves the given data (made of builtin types) in a binary file, replacing it atomically so 
+    concurrent readers never see a partially written file. Failures are ignored, since caches can 
+    always be rebuilt.
+    '''
+    import marshal
+    import thread
+    # threads of the same process (`run_concurrently`, `cit_serve`) may write the same file
+    temp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), thread.get_ident())
+    try:
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(temp_filename, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        if sys.platform == 'win32' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError, ValueError):
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+            
+            
+#===================================================================================================
+# get_cache_dir
+#===================================================================================================
+def get_cache_dir(global_config):
+    '''
+    Returns the directory where cit keeps its caches, by default ".cit-cache" next to the global 
+    config file.
+    '''
+    return global_config.get('cache-dir')
+
+
+#===================================================================================================
+# import_element_tree
+#===================================================================================================
+def import_element_tree():
+    '''
+    Imports ElementTree on demand, preferring its C implementation.
+    '''
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    return ET
+
+
+#===================================================================================================
+# pop_option
+#===================================================================================================
+def pop_option(argv, *names):
+    '''
+    Removes an option given as "NAME VALUE" or "NAME=VALUE" from argv (in place).
+    
+    :return: the option's value, or None if the option was not given.
+    '''
+    for index, arg in enumerate(argv):
+        if not isinstance(arg, basestring):
+            continue
+        for name in names:
+            if arg == name and index + 1 < len(argv):
+                value = argv[index + 1]
+                del argv[index:index + 2]
+                return value
+            elif arg.startswith(name + '='):
+                del argv[index]
+                return arg[len(name) + 1:]
+    return None
+
+
+#===================================================================================================
+# get_workers
+#===================================================================================================
+DEFAULT_WORKERS = 4
+
+def get_workers(global_config):
+    '''
+    Returns the number of jobs that should be handled in parallel, configured by the "workers" key
+    in the global config or by the --jobs command line option.
+    '''
+    return max(1, int(global_config.get('workers', DEFAULT_WORKERS)))
+
+
+#===================================================================================================
+# run_concurrently
+#===================================================================================================
+def run_concurrently(func, items, workers, ordered=True):
+    '''
+    Calls func(item) for each item using a pool of at most `workers` threads.
+    
+    :param ordered: if False, results are yielded in the order they are done instead.
+    :return: generator of (item, result, error) tuples, in the same order as `items`, yielded as 
+        soon as each one is done. `error` is the exception raised by func (in which case `result` 
+        is None), or None if the call was successful.
+    '''
+    import Queue
+    import threading
+    
+    items = list(items)
+    
+    def call(item):
+        try:
+            return func(item), None
+        except Exception, e:
+            return None, e
+    
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            result, error = call(item)
+            yield item, result, error
+        return
+    
+    results = [None] * len(items)
+    done_events = [threading.Event() for _ in items]
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+    for index in xrange(len(items)):
+        pending.put(index)
+        
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = call(items[index])
+            done_events[index].set()
+            finished.put(index)
+            
+    for _ in xrange(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        
+    if not ordered:
+        for _ in items:
+            # wait with a timeout so the main thread is still responsive to Ctrl+C 
+            while True:
+                try:
+                    index = finished.get(timeout=0.1)
+                    break
+                except Queue.Empty:
+                    pass
+            result, error = results[index]
+            yield items[index], result, error
+        return
+    
+    for index, item in enumerate(items):
+        # wait with a timeout so the main thread is still responsive to Ctrl+C 
+        while not done_events[index].is_set():
+            done_events[index].wait(0.1)
+        result, error = results[index]
+        yield item, result, error
+    
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    sys.exit(main(sys.argv)) 
@@ -0,0 +1,468 @@
+'''
+In-process fake of the subset of Jenkins' remote access API used by cit, so tests can run without
+a real Jenkins server.
+
+Usage::
+
+    with FakeJenkins() as jenkins:
+        jenkins.add_job('my-job', config_xml)
+        cit.main(...)   # using jenkins.url
+        assert jenkins.requests == [('GET', '/job/my-job/config.xml'), ...]
+'''
+from __future__ import with_statement
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+
+#===================================================================================================
+# FakeJenkins
+#===================================================================================================
+class FakeJenkins(object):
+
+    def __init__(self, latency=0.0):
+        '''
+        :param latency: seconds taken to answer each request, to simulate a remote server.
+        '''
+        self.latency = latency
+        self.jobs = {}
+        self.notifications = []
+        self.requests = []
+        self.connections = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.faults = []
+        self.scripts = []
+        # like Jenkins itself, no ETag for job configurations unless enabled
+        self.etags = False
+        self.lock = threading.RLock()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def add_job(self, name, config, color='blue'):
+        '''
+        Adds a job (or a folder, given a folder configuration), named by its full name 
+        ("folder/job").
+        '''
+        with self.lock:
+            self.jobs[name] = {'name' : name, 'config' : config, 'color' : color, 'builds' : [], 
+                               'in_queue' : False, 'folder' : config.startswith(FOLDER_TAG)}
+
+
+    def queue_build(self, name):
+        '''
+        Puts a build of the given job in the queue, waiting for an executor.
+        '''
+        with self.lock:
+            self.jobs[name]['in_queue'] = True
+
+
+    def start_build(self, name, estimated_duration=60.0):
+        with self.lock:
+            job = self.jobs[name]
+            job['in_queue'] = False
+            job['builds'].append({
+                'number' : len(job['builds']) + 1,
+                'building' : True,
+                'result' : None,
+                'timestamp' : int(time.time() * 1000),
+                'estimatedDuration' : int(estimated_duration * 1000),
+                'log' : '',
+            })
+            job['color'] = job['color'].split('_')[0] + '_anime'
+
+
+    def append_log(self, name, text):
+        with self.lock:
+            self.jobs[name]['builds'][-1]['log'] += text
+
+
+    def finish_build(self, name, result='SUCCESS'):
+        with self.lock:
+            job = self.jobs[name]
+            job['builds'][-1].update(building=False, result=result)
+            job['color'] = RESULT_COLORS[result]
+
+
+    def add_fault(self, path, status=None, delay=0.0, count=1):
+        '''
+        Makes the next `count` requests to the given path wait `delay` seconds before being answered,
+        and answered with the given error status instead of being handled (if given).
+        '''
+        with self.lock:
+            self.faults.append({'path' : path, 'status' : status, 'delay' : delay, 'count' : count})
+            
+            
+    def pop_fault(self, path):
+        with self.lock:
+            for fault in self.faults:
+                if fault['path'] == path:
+                    fault['count'] -= 1
+                    if fault['count'] == 0:
+                        self.faults.remove(fault)
+                    return fault
+        return None
+    
+    
+    def reset_requests(self):
+        with self.lock:
+            self.requests = []
+            self.connections = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+
+    def handle(self, method, path, query, body, headers=None):
+        '''
+        :param headers: dict of request headers, with lowercase names.
+        :return: tuple (status, content type, response body), optionally followed by a dict of
+            extra response headers.
+        '''
+        with self.lock:
+            self.requests.append((method, path))
+
+            if path == '/api/json' and method == 'GET':
+                data = {'mode' : 'NORMAL', 'jobs' : [self._job_data(name) for name in self._children('')]}
+                return self._json(data, query)
+
+            if path == '/createItem' and method == 'POST':
+                return self._create_item(query['name'], query, body)
+
+            if path == '/scriptText' and method == 'POST':
+                return self._run_script(dict(urlparse.parse_qsl(body))['script'])
+
+            if path == '/git/notifyCommit' and method == 'GET':
+                self.notifications.append(query)
+                repository = '<url>%s</url>' % query['url']
+                lines = ['Scheduled polling of %s' % name for name, job in sorted(self.jobs.iteritems())
+                         if repository in job['config'] and 'hudson.triggers.SCMTrigger' in job['config']]
+                if not lines:
+                    lines = ['No git jobs using repository: %s and branches: %s' % (query['url'], query['branches'])]
+                return 200, 'text/plain', '\n'.join(lines) + '\n'
+
+            # jobs in folders have paths like /job/folder/job/name
+            match = re.match(r'^((?:/job/[^/]+)+)(/.*)$', path)
+            if match is None:
+                return 404, 'text/plain', 'Not found'
+            name = '/'.join(urllib.unquote(part) for part in match.group(1).split('/job/')[1:])
+            job = self.jobs.get(name)
+            if job is None:
+                return 404, 'text/plain', 'Not found'
+            action = match.group(2)
+
+            if action == '/createItem' and method == 'POST' and job['folder']:
+                return self._create_item(name + '/' + query['name'], query, body)
+            elif action == '/api/json' and method == 'GET':
+                return self._json(self._job_data(name), query)
+            elif action == '/config.xml' and method == 'GET':
+                if not self.etags:
+                    return 200, 'application/xml', job['config']
+                etag = '"%s"' % hashlib.md5(job['config']).hexdigest()
+                if (headers or {}).get('if-none-match') == etag:
+                    return 304, 'application/xml', '', {'ETag' : etag}
+                return 200, 'application/xml', job['config'], {'ETag' : etag}
+            elif action == '/config.xml' and method == 'POST':
+                job['config'] = body
+                if job['color'] == 'disabled':
+                    job['color'] = 'notbuilt'
+                return 200, 'text/plain', ''
+            elif action == '/doDelete' and method == 'POST':
+                # folders are removed with everything in them
+                for job_name in list(self.jobs):
+                    if job_name == name or job_name.startswith(name + '/'):
+                        del self.jobs[job_name]
+                return 302, 'text/plain', ''
+            elif action == '/build' and method == 'POST':
+                if job['color'] == 'disabled':
+                    return 409, 'text/plain', 'Job is disabled'
+                self.start_build(name)
+                return 201, 'text/plain', ''
+
+            match = re.match(r'^/(\d+)/logText/progressiveText$', action)
+            if match is not None and method == 'GET':
+                number = int(match.group(1))
+                if not 0 < number <= len(job['builds']):
+                    return 404, 'text/plain', 'Not found'
+                build = job['builds'][number - 1]
+                text = build['log'][int(query.get('start', 0)):]
+                headers = {'X-Text-Size' : str(len(build['log']))}
+                if build['building']:
+                    headers['X-More-Data'] = 'true'
+                return 200, 'text/plain', text, headers
+
+            return 404, 'text/plain', 'Not found'
+
+
+    def _create_item(self, name, query, body):
+        if name in self.jobs:
+            return 400, 'text/plain', 'A job already exists with the name %s' % name
+        if query.get('mode') == 'copy':
+            source = self.jobs.get(query['from'])
+            if source is None:
+                return 400, 'text/plain', 'No such job: %s' % query['from']
+            self.add_job(name, source['config'], color='disabled')
+        else:
+            self.add_job(name, body, color='notbuilt')
+        return 200, 'text/plain', ''
+
+
+    def _children(self, folder):
+        '''
+        :return: sorted full names of the jobs directly in the given folder ('' for the top level).
+        '''
+        return sorted(name for name in self.jobs if name.rpartition('/')[0] == folder)
+
+
+    def _run_script(self, script):
+        '''
+        Simulates the batch script generated by cit (cit.BATCH_SCRIPT), applying the operations 
+        given to it to the jobs and printing their results like the script would.
+        '''
+        self.scripts.append(script)
+        match = re.search(r"'([A-Za-z0-9+/=]*)'\.decodeBase64\(\)", script)
+        if match is None:
+            return 200, 'text/plain', 'groovy.lang.MissingPropertyException: unknown script\n'
+        results = []
+        for operation in json.loads(base64.b64decode(match.group(1))):
+            name = operation['job']
+            job = self.jobs.get(name)
+            if operation['action'] == 'add':
+                config = operation['config'].encode('utf-8')
+                if job is None:
+                    folders = name.split('/')[:-1]
+                    for index in xrange(len(folders)):
+                        folder = '/'.join(folders[:index + 1])
+                        if folder not in self.jobs:
+                            self.add_job(folder, FOLDER_TAG + '/>')
+                    self.add_job(name, config, color='notbuilt')
+                    results.append({'status' : 'CREATED'})
+                elif normalize_xml(job['config']) == normalize_xml(config):
+                    results.append({'status' : 'UNCHANGED'})
+                else:
+                    results.append({'status' : 'UPDATED', 'before' : job['config']})
+                    job['config'] = config
+                    if job['color'] == 'disabled':
+                        job['color'] = 'notbuilt'
+            elif job is None:
+                results.append({'status' : 'NOT FOUND'})
+            elif operation['action'] == 'remove':
+                del self.jobs[name]
+                results.append({'status' : 'REMOVED', 'before' : job['config']})
+            elif job['color'].endswith('_anime'):
+                results.append({'status' : 'RUNNING'})
+            elif job['in_queue']:
+                results.append({'status' : 'QUEUED'})
+            elif job['color'] == 'disabled':
+                results.append({'error' : 'job is disabled'})
+            else:
+                self.start_build(name)
+                results.append({'status' : 'STARTED'})
+        return 200, 'text/plain', json.dumps(results) + '\n'
+
+
+    def _job_data(self, name):
+        job = self.jobs[name]
+        url = self.url + ''.join('/job/%s' % urllib.quote(part) for part in name.split('/')) + '/'
+        if job['folder']:
+            return {
+                'name' : name.rpartition('/')[2],
+                'url' : url,
+                'jobs' : [self._job_data(child) for child in self._children(name)],
+            }
+        return {
+            'name' : name.rpartition('/')[2],
+            'color' : job['color'],
+            'url' : url,
+            'inQueue' : job['in_queue'],
+            'lastBuild' : self._build_data(job['builds'][-1]) if job['builds'] else None,
+        }
+
+
+    def _build_data(self, build):
+        data = dict(build)
+        del data['log']
+        return data
+
+
+    def _json(self, data, query):
+        if 'tree' in query:
+            data = filter_tree(data, query['tree'])
+        return 200, 'application/json', json.dumps(data)
+
+
+FOLDER_TAG = '<com.cloudbees.hudson.plugins.folder.Folder'
+
+RESULT_COLORS = {'SUCCESS' : 'blue', 'UNSTABLE' : 'yellow', 'FAILURE' : 'red', 'ABORTED' : 'aborted'}
+
+
+#===================================================================================================
+# normalize_xml
+#===================================================================================================
+def normalize_xml(xml):
+    '''
+    Returns a canonical form of the given xml, ignoring what cit's batch script ignores when 
+    comparing configurations (blank text and text after child elements).
+    '''
+    tree = ElementTree.fromstring(xml)
+    for elem in tree.iter():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        elem.tail = None
+    return ElementTree.tostring(tree)
+
+
+#===================================================================================================
+# filter_tree
+#===================================================================================================
+def filter_tree(data, tree):
+    '''
+    Filters data the same way Jenkins does with the "tree" query parameter, for example
+    "name,jobs[name,color]".
+    '''
+    if isinstance(data, list):
+        return [filter_tree(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+
+    result = {}
+    for field, subtree in parse_tree(tree):
+        if field in data:
+            if subtree is None:
+                result[field] = data[field]
+            else:
+                result[field] = filter_tree(data[field], subtree)
+    return result
+
+
+def parse_tree(tree):
+    '''
+    :return: list of (field, subtree) for the top-level fields of the given tree spec, with subtree
+        being None for fields without nested fields.
+    '''
+    fields = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(tree + ','):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            spec = tree[start:index].strip()
+            start = index + 1
+            if '[' in spec:
+                field, subtree = spec.split('[', 1)
+                fields.append((field, subtree[:-1]))
+            elif spec:
+                fields.append((spec, None))
+    return fields
+
+
+#===================================================================================================
+# _Server
+#===================================================================================================
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        with self.fake.lock:
+            self.fake.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        
+        
+    def handle_error(self, request, client_address):
+        # clients that time out close their connections before they are answered
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+#===================================================================================================
+# _Handler
+#===================================================================================================
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    # send each response at once (writing headers one by one in small packets makes each request
+    # wait for delayed TCP acknowledgments)
+    wbufsize = -1
+
+    def do_GET(self):
+        self._handle('GET')
+
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+    def _handle(self, method):
+        parsed = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        fault = fake.pop_fault(parsed.path)
+        if fault is not None:
+            time.sleep(fault['delay'])
+        if fault is not None and fault['status'] is not None:
+            with fake.lock:
+                fake.requests.append((method, parsed.path))
+            response = fault['status'], 'text/plain', 'Fault'
+        else:
+            request_headers = dict((name.lower(), value) for name, value in self.headers.items())
+            response = fake.handle(method, parsed.path, query, body, request_headers)
+        status, content_type, data = response[:3]
+        headers = response[3] if len(response) > 3 else {}
+        with fake.lock:
+            fake.bytes_received += len(self.path) + len(body)
+            fake.bytes_sent += len(data)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, *args):
+        pass
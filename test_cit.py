@@ -1,186 +1,1565 @@
-from __future__ import with_statement
-from jenkinsapi.jenkins import Jenkins
-import cit
-import hashlib
-import os
-import pytest
-import time
-import xml.etree.ElementTree as ET
-import StringIO
-import yaml
-import mock
-
-
-JENKINS_URL = 'http://localhost:8080'
-JOB_TEST_PREFIX = 'cit-test-job-'
-
-#===================================================================================================
-# teardown_module
-#===================================================================================================
-def teardown_module(module):
-    jenkins = Jenkins(JENKINS_URL)
-    for name, job in jenkins.get_jobs():
-        if name.startswith(JOB_TEST_PREFIX):
-            jenkins.delete_job(name)
-
-#===================================================================================================
-# jenkins
-#===================================================================================================
-@pytest.fixture
-def tmp_job_name():
-    config = file(os.path.join(os.path.dirname(__file__), 'test_config.xml')).read()
-    
-    jenkins = Jenkins(JENKINS_URL)
-    
-    hasher = hashlib.sha1(str(time.time()))
-    job_name = '%s%s' % (JOB_TEST_PREFIX, hasher.hexdigest())
-    
-    job = jenkins.create_job(job_name, config)
-    job.update_config(config) 
-    
-    return job_name
-    
-
-#===================================================================================================
-# test_add
-#===================================================================================================
-@pytest.mark.parametrize('branch', ['new-feature', None])
-def test_add(tmp_job_name, tmpdir, branch):
-    cwd = str(tmpdir.join('.git', 'src', 'plk'))
-    os.makedirs(cwd)
-    os.chdir(cwd)
-    
-    global_config_file = str(tmpdir.join('citconfig.yaml'))
-    global_config = {'jenkins' : {'url' : JENKINS_URL}}
-    yaml.dump(global_config, file(global_config_file, 'w'))
-    
-    cit_config = {
-        'jobs' : [{
-            'source-job' : tmp_job_name,
-            'feature-branch-job' : tmp_job_name + '-$name',
-        }],
-    }
-    cit_config_file = str(tmpdir.join('.cit.yaml'))
-    yaml.dump(cit_config, file(cit_config_file, 'w'))
-    
-    with mock.patch('cit.get_git_branch', autospec=True) as mock_get_git_branch:
-        mock_get_git_branch.return_value = 'new-feature'
-        
-        with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
-            mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
-            assert cit.main(['cit', 'add', branch], global_config_file=global_config_file) == cit.RETURN_CODE_OK
-    
-    branch = 'new-feature'
-    
-    jenkins = Jenkins(JENKINS_URL)
-    new_job_name = tmp_job_name + '-' + branch
-    assert jenkins.has_job(new_job_name), "no job %s found. available: %s" % (new_job_name, jenkins.get_jobs_list())
-    
-    config_xml = jenkins.get_job(new_job_name).get_config()
-    
-    # ensure we configured branch correctly
-    config = ET.fromstring(config_xml)
-    branches_elements = list(config.findall('.//branches'))
-    assert len(branches_elements) == 1
-    branches_elem = branches_elements[0]
-    name_elem = branches_elem.findall('hudson.plugins.git.BranchSpec/name')[0]    
-    assert name_elem.text == branch
-    
-    # ensure we have updated the display name with the feature branch's name
-    display_name_elements = list(config.findall('.//displayName'))
-    assert len(display_name_elements) == 1
-    display_name_element = display_name_elements[0]
-    assert display_name_element.text == 'SS win32 (%s)' % branch
-    
-    # ensure we have set the user email recipient
-    recipient_elements = list(config.findall('.//hudson.tasks.Mailer/recipients'))
-    assert len(recipient_elements) == 1
-    recipient_element = recipient_elements[0]
-    assert recipient_element.text == 'anonymous@somewhere.com'
-    
-    # ensure we don't have build parameters anymore
-    params = list(config.findall('.//hudson.model.ParametersDefinitionProperty'))
-    assert len(params) == 0
-    
-    # ensure triggered repository polling
-    triggers = list(config.findall('.//hudson.triggers.SCMTrigger'))
-    assert len(triggers) == 1
-    assert triggers[0].find('spec').text == 'H/5 * * * *'
-    
-    # ensure no build is triggered after the job
-    build_triggers = list(config.findall('.//hudson.tasks.BuildTrigger'))
-    assert len(build_triggers) == 0
-    
-    
-#===================================================================================================
-# test_cit_init
-#===================================================================================================
-def test_cit_init(tmpdir, capsys):    
-    cwd = str(tmpdir.join('.git', 'src', 'plk'))
-    os.makedirs(cwd)
-    os.chdir(cwd)
-    
-    global_config_file = str(tmpdir.join('citconfig.yaml'))
-    global_config = {'jenkins' : {'url' : JENKINS_URL}}
-    yaml.dump(global_config, file(global_config_file, 'w'))
-    
-    input_lines = [
-        'project_win32', 
-        'project_$name_win32',
-        'project_win64', 
-        'project_$name_win64',
-        '',
-    ]
-    stdin = StringIO.StringIO('\n'.join(input_lines))
-    assert cit.main(['cit', 'init'], stdin=stdin, global_config_file=global_config_file) == cit.RETURN_CODE_OK
-    
-    cit_file = tmpdir.join('.cit.yaml')
-    assert cit_file.ensure()
-    contents = cit_file.read()
-    obtained = yaml.load(contents)
-    
-    expected = {
-        'jobs' : [
-            {
-                'source-job': 'project_win32',
-                'feature-branch-job' : 'project_$name_win32', 
-            },
-            {
-                'source-job': 'project_win64',
-                'feature-branch-job' : 'project_$name_win64', 
-            },
-        ]
-    }
-    assert obtained == expected 
-    
-    
-#===================================================================================================
-# test_cit_install
-#===================================================================================================
-def test_cit_install(tmpdir):    
-    cwd = str(tmpdir.join('src', 'plk'))
-    os.makedirs(cwd)
-    os.chdir(cwd)
-    
-    global_config_file = tmpdir.join('citconfig.yaml')
-    
-    input_lines = [
-        'localhost:8080',
-        '',
-    ]
-    stdin = StringIO.StringIO('\n'.join(input_lines))
-    
-    assert cit.main(['cit'], global_config_file=str(global_config_file)) == cit.RETURN_CODE_CONFIG_NOT_FOUND
-    assert cit.main(['cit', '--install'], stdin=stdin, global_config_file=str(global_config_file)) == cit.RETURN_CODE_OK
-    
-    assert global_config_file.ensure()
-    contents = global_config_file.read()
-    obtained = yaml.load(contents)
-    assert obtained == {'jenkins' : {'url' : 'http://localhost:8080'}}     
-    
-    
-#===================================================================================================
-# main    
-#===================================================================================================
-if __name__ == '__main__':    
+from __future__ import with_statement
+from fake_jenkins import FakeJenkins
+import benchmark
+from jenkinsapi.jenkins import Jenkins
+import base64
+import cit
+import distutils.spawn
+import hashlib
+import os
+import pytest
+import re
+import time
+import xml.etree.ElementTree as ET
+import StringIO
+import json
+import subprocess
+import threading
+import sys
+import yaml
+import mock
+
+
+JENKINS_URL = 'http://localhost:8080'
+JOB_TEST_PREFIX = 'cit-test-job-'
+
+#===================================================================================================
+# teardown_module
+#===================================================================================================
+def teardown_module(module):
+    jenkins = Jenkins(JENKINS_URL)
+    for name, job in jenkins.get_jobs():
+        if name.startswith(JOB_TEST_PREFIX):
+            jenkins.delete_job(name)
+
+#===================================================================================================
+# jenkins
+#===================================================================================================
+@pytest.fixture
+def tmp_job_name():
+    config = file(os.path.join(os.path.dirname(__file__), 'test_config.xml')).read()
+    
+    jenkins = Jenkins(JENKINS_URL)
+    
+    hasher = hashlib.sha1(str(time.time()))
+    job_name = '%s%s' % (JOB_TEST_PREFIX, hasher.hexdigest())
+    
+    job = jenkins.create_job(job_name, config)
+    job.update_config(config) 
+    
+    return job_name
+    
+
+#===================================================================================================
+# test_add
+#===================================================================================================
+@pytest.mark.parametrize('branch', ['new-feature', None])
+def test_add(tmp_job_name, tmpdir, branch):
+    cwd = str(tmpdir.join('.git', 'src', 'plk'))
+    os.makedirs(cwd)
+    os.chdir(cwd)
+    
+    global_config_file = str(tmpdir.join('citconfig.yaml'))
+    global_config = {'jenkins' : {'url' : JENKINS_URL}}
+    yaml.dump(global_config, file(global_config_file, 'w'))
+    
+    cit_config = {
+        'jobs' : [{
+            'source-job' : tmp_job_name,
+            'feature-branch-job' : tmp_job_name + '-$name',
+        }],
+    }
+    cit_config_file = str(tmpdir.join('.cit.yaml'))
+    yaml.dump(cit_config, file(cit_config_file, 'w'))
+    
+    with mock.patch('cit.get_git_branch', autospec=True) as mock_get_git_branch:
+        mock_get_git_branch.return_value = 'new-feature'
+        
+        with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+            mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+            assert cit.main(['cit', 'add', branch], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    
+    branch = 'new-feature'
+    
+    jenkins = Jenkins(JENKINS_URL)
+    new_job_name = tmp_job_name + '-' + branch
+    assert jenkins.has_job(new_job_name), "no job %s found. available: %s" % (new_job_name, jenkins.get_jobs_list())
+    
+    config_xml = jenkins.get_job(new_job_name).get_config()
+    
+    # ensure we configured branch correctly
+    config = ET.fromstring(config_xml)
+    branches_elements = list(config.findall('.//branches'))
+    assert len(branches_elements) == 1
+    branches_elem = branches_elements[0]
+    name_elem = branches_elem.findall('hudson.plugins.git.BranchSpec/name')[0]    
+    assert name_elem.text == branch
+    
+    # ensure we have updated the display name with the feature branch's name
+    display_name_elements = list(config.findall('.//displayName'))
+    assert len(display_name_elements) == 1
+    display_name_element = display_name_elements[0]
+    assert display_name_element.text == 'SS win32 (%s)' % branch
+    
+    # ensure we have set the user email recipient
+    recipient_elements = list(config.findall('.//hudson.tasks.Mailer/recipients'))
+    assert len(recipient_elements) == 1
+    recipient_element = recipient_elements[0]
+    assert recipient_element.text == 'anonymous@somewhere.com'
+    
+    # ensure we don't have build parameters anymore
+    params = list(config.findall('.//hudson.model.ParametersDefinitionProperty'))
+    assert len(params) == 0
+    
+    # ensure triggered repository polling
+    triggers = list(config.findall('.//hudson.triggers.SCMTrigger'))
+    assert len(triggers) == 1
+    assert triggers[0].find('spec').text == 'H/5 * * * *'
+    
+    # ensure no build is triggered after the job
+    build_triggers = list(config.findall('.//hudson.tasks.BuildTrigger'))
+    assert len(build_triggers) == 0
+    
+    
+#===================================================================================================
+# test_cit_init
+#===================================================================================================
+def test_cit_init(tmpdir, capsys):    
+    cwd = str(tmpdir.join('.git', 'src', 'plk'))
+    os.makedirs(cwd)
+    os.chdir(cwd)
+    
+    global_config_file = str(tmpdir.join('citconfig.yaml'))
+    global_config = {'jenkins' : {'url' : JENKINS_URL}}
+    yaml.dump(global_config, file(global_config_file, 'w'))
+    
+    input_lines = [
+        'project_win32', 
+        'project_$name_win32',
+        'project_win64', 
+        'project_$name_win64',
+        '',
+    ]
+    stdin = StringIO.StringIO('\n'.join(input_lines))
+    assert cit.main(['cit', 'init'], stdin=stdin, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    
+    cit_file = tmpdir.join('.cit.yaml')
+    assert cit_file.ensure()
+    contents = cit_file.read()
+    obtained = yaml.load(contents)
+    
+    expected = {
+        'jobs' : [
+            {
+                'source-job': 'project_win32',
+                'feature-branch-job' : 'project_$name_win32', 
+            },
+            {
+                'source-job': 'project_win64',
+                'feature-branch-job' : 'project_$name_win64', 
+            },
+        ]
+    }
+    assert obtained == expected 
+    
+    
+#===================================================================================================
+# test_cit_install
+#===================================================================================================
+def test_cit_install(tmpdir):    
+    cwd = str(tmpdir.join('src', 'plk'))
+    os.makedirs(cwd)
+    os.chdir(cwd)
+    
+    global_config_file = tmpdir.join('citconfig.yaml')
+    
+    input_lines = [
+        'localhost:8080',
+        '',
+    ]
+    stdin = StringIO.StringIO('\n'.join(input_lines))
+    
+    assert cit.main(['cit'], global_config_file=str(global_config_file)) == cit.RETURN_CODE_CONFIG_NOT_FOUND
+    assert cit.main(['cit', '--install'], stdin=stdin, global_config_file=str(global_config_file)) == cit.RETURN_CODE_OK
+    
+    assert global_config_file.ensure()
+    contents = global_config_file.read()
+    obtained = yaml.load(contents)
+    assert obtained == {'jenkins' : {'url' : 'http://localhost:8080'}}     
+    
+    
+#===================================================================================================
+# fake_jenkins
+#===================================================================================================
+@pytest.fixture
+def fake_jenkins():
+    config = file(os.path.join(os.path.dirname(__file__), 'test_config.xml')).read()
+    with FakeJenkins() as jenkins:
+        jenkins.add_job('source-job', config)
+        yield jenkins
+        
+        
+@pytest.fixture
+def cit_runner(fake_jenkins, capsys):
+    '''
+    Returns a function making the run(*args) helper of a test: run resets the requests of the fake
+    jenkins, runs cit as the given git user (anonymous by default), checks its return code (unless return_code=None is
+    given) and returns the lines it printed.
+    '''
+    def make_runner(global_config_file, options=(), jenkins=fake_jenkins, 
+                    user=('anonymous', 'anonymous@somewhere.com')):
+        def run(*args, **kwargs):
+            expected_return_code = kwargs.pop('return_code', cit.RETURN_CODE_OK)
+            jenkins.reset_requests()
+            with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+                mock_get_git_user.return_value = user
+                return_code = cit.main(['cit'] + list(options) + list(args), global_config_file=global_config_file)
+            if expected_return_code is not None:
+                assert return_code == expected_return_code
+            out, err = capsys.readouterr()
+            return out.splitlines()
+        return run
+    return make_runner
+        
+        
+#===================================================================================================
+# test_commands_with_fake_jenkins
+#===================================================================================================
+def test_commands_with_fake_jenkins(tmpdir, fake_jenkins, cit_runner):
+    global_config = {'jenkins' : {'url' : fake_jenkins.url, 'index-ttl' : 0}}
+    run_cit = cit_runner(create_cit_files(tmpdir, ['source-job'], global_config))
+    
+    def run(*args):
+        lines = run_cit(*args)
+        # all requests of a command go through a single keep-alive connection
+        assert fake_jenkins.connections == 1
+        return lines
+    
+    assert run('add', 'feature', '-j', '1') == ['source-job => source-job-feature (CREATED)']
+    # the job is created already configured, without an intermediate copy of the source job
+    assert fake_jenkins.requests == [
+        ('GET', '/job/source-job/config.xml'),
+        ('GET', '/job/source-job-feature/config.xml'),
+        ('POST', '/createItem'),
+    ]
+    config = ET.fromstring(fake_jenkins.jobs['source-job-feature']['config'])
+    assert config.find('.//hudson.plugins.git.BranchSpec/name').text == 'feature'
+    assert config.find('.//hudson.tasks.Mailer/recipients').text == 'anonymous@somewhere.com'
+    
+    # adding again does not write anything, since the configuration is the same
+    assert run('add', 'feature', '-j', '1') == ['source-job => source-job-feature (UNCHANGED)']
+    assert [method for method, _ in fake_jenkins.requests] == ['GET', 'GET']
+    
+    # changes to the source job are seen by the next command, though Jenkins sends no ETag
+    fake_jenkins.jobs['source-job']['config'] = fake_jenkins.jobs['source-job']['config'].replace(
+        'SS win32', 'SS win64')
+    assert run('add', 'feature', '-j', '1') == ['source-job => source-job-feature (UPDATED)']
+    assert fake_jenkins.requests[-1] == ('POST', '/job/source-job-feature/config.xml')
+    assert len(fake_jenkins.requests) == 3
+    assert run('start', 'feature') == ['source-job-feature (STARTED)']
+    assert run('start', 'feature') == ['source-job-feature (RUNNING)']
+    assert run('rm', 'feature') == ['source-job-feature (REMOVED)']
+    assert run('rm', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert run('start', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert fake_jenkins.requests == [('GET', '/api/json')]
+    
+    
+#===================================================================================================
+# test_job_index
+#===================================================================================================
+def test_job_index(tmpdir, fake_jenkins, cit_runner):
+    global_config_file = create_cit_files(tmpdir, ['source-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    run = cit_runner(global_config_file)
+    
+    # index is filled by a single query
+    assert run('rm', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert fake_jenkins.requests == [('GET', '/api/json')]
+    
+    # while the index is fresh, jobs known not to exist don't need any requests
+    assert run('rm', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert fake_jenkins.requests == []
+    
+    assert run('add', 'feature') == ['source-job => source-job-feature (CREATED)']
+    assert fake_jenkins.requests == [('GET', '/job/source-job/config.xml'), ('POST', '/createItem')]
+    
+    # start reads the state of all jobs with a single request
+    assert run('start', 'feature') == ['source-job-feature (STARTED)']
+    assert fake_jenkins.requests == [('GET', '/api/json'), ('POST', '/job/source-job-feature/build')]
+    # the configuration kept in its snapshot is the one cit wrote, so it's not fetched again
+    assert run('rm', 'feature') == ['source-job-feature (REMOVED)']
+    assert fake_jenkins.requests == [('POST', '/job/source-job-feature/doDelete')]
+    assert run('rm', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert fake_jenkins.requests == []
+    
+    # outdated index: job created by someone else is updated instead
+    fake_jenkins.add_job('source-job-feature', fake_jenkins.jobs['source-job']['config'])
+    assert run('add', 'feature') == ['source-job => source-job-feature (UPDATED)']
+    
+    # index expires after its ttl
+    with mock.patch('time.time', return_value=time.time() + cit.DEFAULT_INDEX_TTL):
+        fake_jenkins.jobs.clear()
+        assert run('start', 'feature') == ['source-job-feature (NOT FOUND)']
+        assert fake_jenkins.requests == [('GET', '/api/json')]
+    
+    
+#===================================================================================================
+# test_template_cache
+#===================================================================================================
+def test_template_cache(tmpdir, fake_jenkins):
+    source_config = file(os.path.join(os.path.dirname(__file__), 'test_config.xml')).read()
+    fake_jenkins.add_job('source-job', source_config)
+    clock = mock.Mock(return_value=1000.0)
+    templates = cit.TemplateCache(str(tmpdir), fake_jenkins.url, 60, clock)
+    jenkins = cit.JenkinsClient(fake_jenkins.url, templates=templates)
+    
+    # fetched once per command
+    assert jenkins.get_source_config('source-job') == source_config
+    assert jenkins.get_source_config('source-job') == source_config
+    assert fake_jenkins.requests == [('GET', '/job/source-job/config.xml')]
+    
+    # with a ttl, used by later commands without asking the server until it expires
+    fake_jenkins.reset_requests()
+    jenkins.close()
+    templates = cit.TemplateCache(str(tmpdir), fake_jenkins.url, 60, clock)
+    jenkins = cit.JenkinsClient(fake_jenkins.url, templates=templates)
+    assert jenkins.get_source_config('source-job') == source_config
+    assert fake_jenkins.requests == []
+    
+    changed_config = source_config.replace('SS win32', 'SS win64')
+    fake_jenkins.jobs['source-job']['config'] = changed_config
+    clock.return_value += 60
+    jenkins.close()
+    assert jenkins.get_source_config('source-job') == changed_config
+    assert fake_jenkins.requests == [('GET', '/job/source-job/config.xml')]
+    
+    # always fetched without a ttl
+    fake_jenkins.reset_requests()
+    templates.ttl = 0
+    jenkins.close()
+    assert jenkins.get_source_config('source-job') == changed_config
+    assert len(fake_jenkins.requests) == 1
+    
+    # with an ETag, revalidated by each command without transferring it again, whatever the ttl
+    fake_jenkins.etags = True
+    jenkins.close()
+    jenkins.get_source_config('source-job')
+    templates.ttl = 60
+    fake_jenkins.reset_requests()
+    jenkins.close()
+    assert jenkins.get_source_config('source-job') == changed_config
+    assert fake_jenkins.requests == [('GET', '/job/source-job/config.xml')]
+    assert fake_jenkins.bytes_sent == 0
+    fake_jenkins.jobs['source-job']['config'] = source_config
+    jenkins.close()
+    assert jenkins.get_source_config('source-job') == source_config
+    fake_jenkins.jobs['source-job']['config'] = changed_config
+    jenkins.close()
+    assert jenkins.get_source_config('source-job') == changed_config
+    
+    # feature configs made from the cached template are the same as transforming the source config
+    rules = cit.get_default_rules()
+    for branch, email in [('feature', 'user@somewhere.com'), ('a&b<c>', ''), ('"quoted"', ''), ('SS win64', 'x@y.com')]:
+        expected = cit.make_feature_branch_config(changed_config, branch, email, rules)
+        assert cit.make_feature_branch_config(changed_config, branch, email, rules, templates) == expected
+    # branches found in the source config or with quotes are transformed without the template
+    assert len(templates._templates) == 1
+    assert len(tmpdir.listdir(lambda p: p.basename.startswith('template-'))) == 1
+    
+    
+#===================================================================================================
+# test_start_many_branches
+#===================================================================================================
+def test_start_many_branches(tmpdir, fake_jenkins, capsys):
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    config = fake_jenkins.jobs['source-job']['config']
+    for name in ('source-job-a', 'other-job-a', 'source-job-b', 'other-job-b', 'source-job-c'):
+        fake_jenkins.add_job(name, config)
+    fake_jenkins.start_build('source-job-a')
+    fake_jenkins.queue_build('other-job-b')
+    
+    fake_jenkins.reset_requests()
+    argv = ['cit', 'start', 'a', 'b', 'a']
+    assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'source-job-a (RUNNING)',
+        'other-job-a (STARTED)',
+        'source-job-b (STARTED)',
+        'other-job-b (QUEUED)',
+    ]
+    assert sorted(fake_jenkins.requests) == [
+        ('GET', '/api/json'),
+        ('POST', '/job/other-job-a/build'),
+        ('POST', '/job/source-job-b/build'),
+    ]
+    
+    # all branches with feature jobs: jobs already started are not started again
+    fake_jenkins.reset_requests()
+    argv = ['cit', 'start', '--all']
+    assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'source-job-a (RUNNING)',
+        'other-job-a (RUNNING)',
+        'source-job-b (RUNNING)',
+        'other-job-b (QUEUED)',
+        'source-job-c (STARTED)',
+        'other-job-c (NOT FOUND)',
+    ]
+    assert sorted(fake_jenkins.requests) == [('GET', '/api/json'), ('POST', '/job/source-job-c/build')]
+    
+    
+#===================================================================================================
+# test_notify
+#===================================================================================================
+@pytest.mark.parametrize('notify', ['commit', 'build'])
+def test_notify(tmpdir, fake_jenkins, capsys, monkeypatch, notify):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    global_config = {'jenkins' : {'url' : fake_jenkins.url, 'notify-token' : 'secret'}}
+    global_config_file = create_cit_files(tmpdir, ['source-job'], global_config, trigger='push', notify=notify)
+    tmpdir.join('.git', 'config').write('[remote "origin"]\n\turl = git@github.com:nicoddemus/cit.git\n')
+    
+    with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+        mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+        assert cit.main(['cit', 'add', 'feature'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    
+    # job doesn't poll the repository by itself 
+    config = ET.fromstring(fake_jenkins.jobs['source-job-feature']['config'])
+    triggers = config.findall('./triggers/hudson.triggers.SCMTrigger')
+    assert len(triggers) == 1
+    assert not triggers[0].find('spec').text
+    
+    capsys.readouterr()
+    fake_jenkins.reset_requests()
+    assert cit.main(['cit', 'notify', 'feature'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    out, err = capsys.readouterr()
+    if notify == 'commit':
+        assert out.splitlines() == [
+            'git@github.com:nicoddemus/cit.git (NOTIFIED)',
+            '  Scheduled polling of source-job-feature',
+        ]
+        assert fake_jenkins.notifications == [{
+            'url' : 'git@github.com:nicoddemus/cit.git', 
+            'branches' : 'feature', 
+            'token' : 'secret',
+        }]
+        assert len(fake_jenkins.requests) == 1
+    else:
+        assert out.splitlines() == ['source-job-feature (STARTED)']
+        assert fake_jenkins.jobs['source-job-feature']['color'] == 'notbuilt_anime'
+        assert fake_jenkins.requests[-1] == ('POST', '/job/source-job-feature/build')
+    
+    
+#===================================================================================================
+# test_watch
+#===================================================================================================
+def test_watch(tmpdir, fake_jenkins, capsys):
+    source_jobs = ['source-job', 'other-job', 'missing-job']
+    global_config_file = create_cit_files(tmpdir, source_jobs, {'jenkins' : {'url' : fake_jenkins.url}})
+    config = fake_jenkins.jobs['source-job']['config']
+    fake_jenkins.add_job('source-job-feature', config)
+    fake_jenkins.add_job('other-job-feature', config)
+    fake_jenkins.start_build('source-job-feature', estimated_duration=1000)
+    fake_jenkins.start_build('other-job-feature', estimated_duration=1000)
+    
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            fake_jenkins.finish_build('source-job-feature', 'SUCCESS')
+        elif len(sleeps) == 5:
+            fake_jenkins.finish_build('other-job-feature', 'FAILURE')
+    
+    with mock.patch('time.sleep', side_effect=sleep):
+        fake_jenkins.reset_requests()
+        argv = ['cit', 'watch', 'feature']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+        
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'source-job-feature (BUILDING 0%)',
+        'other-job-feature (BUILDING 0%)',
+        'missing-job-feature (NOT FOUND)',
+        'source-job-feature (SUCCESS)',
+        'other-job-feature (FAILURE)',
+    ]
+    # one request per refresh, waiting longer while nothing changes
+    assert fake_jenkins.requests == [('GET', '/api/json')] * 6
+    assert sleeps == [2.0, 3.0, 4.5, 2.0, 3.0]
+    
+    
+#===================================================================================================
+# test_log
+#===================================================================================================
+def test_log(tmpdir, fake_jenkins, capsys):
+    source_jobs = ['source-job', 'other-job', 'missing-job', 'idle-job']
+    global_config_file = create_cit_files(tmpdir, source_jobs, {'jenkins' : {'url' : fake_jenkins.url}})
+    config = fake_jenkins.jobs['source-job']['config']
+    for name in ('source-job-feature', 'other-job-feature', 'idle-job-feature'):
+        fake_jenkins.add_job(name, config)
+    fake_jenkins.start_build('source-job-feature')
+    fake_jenkins.start_build('other-job-feature')
+    fake_jenkins.append_log('source-job-feature', 'Started\nBuil')
+    
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 1:
+            fake_jenkins.append_log('source-job-feature', 'ding\r\n')
+            fake_jenkins.append_log('other-job-feature', 'Started\n')
+        elif len(sleeps) == 3:
+            fake_jenkins.append_log('source-job-feature', 'Finished: SUCCESS')
+            fake_jenkins.finish_build('source-job-feature')
+            fake_jenkins.finish_build('other-job-feature')
+    
+    with mock.patch('time.sleep', side_effect=sleep):
+        fake_jenkins.reset_requests()
+        argv = ['cit', 'log', 'feature']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+        
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'missing-job-feature (NOT FOUND)',
+        'idle-job-feature (NOT BUILT)',
+        '[source-job-feature] Started',
+        '[source-job-feature] Building',
+        '[other-job-feature] Started',
+        '[source-job-feature] Finished: SUCCESS',
+    ]
+    # waits longer while there is no new output
+    assert sleeps == [1.0, 1.0, 2.0]
+    # only new output is requested on each round
+    log_requests = [path for _, path in fake_jenkins.requests if 'logText' in path]
+    assert log_requests[-2:] == [
+        '/job/source-job-feature/1/logText/progressiveText',
+        '/job/other-job-feature/1/logText/progressiveText',
+    ]
+    assert fake_jenkins.connections == 1
+    
+    # filtering jobs by name
+    fake_jenkins.reset_requests()
+    argv = ['cit', 'log', 'feature', '--job', 'other-*']
+    assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['[other-job-feature] Started']
+    
+    
+#===================================================================================================
+# test_console_stream
+#===================================================================================================
+def test_console_stream():
+    output = StringIO.StringIO()
+    stream = cit.ConsoleStream('job', 1, output)
+    stream.MAX_LINE_LENGTH = 4
+    stream._write('a\nbcdefghij')
+    stream._write('k\nl')
+    stream.close()
+    assert output.getvalue().splitlines() == ['[job] a', '[job] bcde', '[job] fghi', '[job] jk', '[job] l']
+    
+    
+#===================================================================================================
+# test_prune
+#===================================================================================================
+def test_prune(tmpdir, fake_jenkins, capsys):
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    git_dir = tmpdir.join('.git')
+    git_dir.join('refs', 'heads', 'master').ensure()
+    git_dir.join('refs', 'remotes', 'origin', 'HEAD').ensure()
+    git_dir.join('packed-refs').write(
+        '# pack-refs with: peeled fully-peeled\n'
+        '4b825dc642cb6eb9a060e54bf8d69288fbee4904 refs/remotes/origin/other\n'
+        '4b825dc642cb6eb9a060e54bf8d69288fbee4904 refs/tags/gone\n'
+    )
+    config = fake_jenkins.jobs['source-job']['config']
+    for name in ('source-job-master', 'source-job-gone', 'other-job-other', 'other-job-gone', 'unrelated-gone'):
+        fake_jenkins.add_job(name, config)
+    
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        argv = ['cit', 'prune', '--dry-run']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['other-job-gone (TO REMOVE)', 'source-job-gone (TO REMOVE)']
+        assert 'source-job-gone' in fake_jenkins.jobs
+        
+        fake_jenkins.reset_requests()
+        argv = ['cit', 'prune']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['other-job-gone (REMOVED)', 'source-job-gone (REMOVED)']
+        assert sorted(fake_jenkins.jobs) == ['other-job-other', 'source-job', 'source-job-master', 
+                                             'unrelated-gone']
+        # the jobs weren't made by cit, so their configurations are fetched for the snapshot
+        assert sorted(fake_jenkins.requests) == [
+            ('GET', '/api/json'),
+            ('GET', '/job/other-job-gone/config.xml'),
+            ('GET', '/job/source-job-gone/config.xml'),
+            ('POST', '/job/other-job-gone/doDelete'),
+            ('POST', '/job/source-job-gone/doDelete'),
+        ]
+        
+    # branches in a remote
+    with mock.patch('cit.check_output', autospec=True) as mock_check_output:
+        mock_check_output.return_value = '4b825dc642cb6eb9a060e54bf8d69288fbee4904\trefs/heads/other\n'
+        argv = ['cit', 'prune', '--remote', 'origin']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['source-job-master (REMOVED)']
+        mock_check_output.assert_called_once_with(('git', 'ls-remote', '--heads', 'origin'), cwd=str(tmpdir))
+        
+    # with overlapping patterns, jobs are kept if any of the branches they may belong to exists
+    job_config = {'jobs' : [{'source-job' : 'source-job', 'feature-branch-job' : 'proj-$name'},
+                            {'source-job' : 'other-job', 'feature-branch-job' : 'proj-$name-linux'}]}
+    tmpdir.join('.cit.yaml').write(yaml.dump(job_config))
+    for name in ('proj-master', 'proj-master-linux', 'proj-gone-linux'):
+        fake_jenkins.add_job(name, config)
+    assert cit.find_feature_branch_jobs(['proj-master', 'proj-master-linux'], job_config) == \
+        {'proj-master' : 'master', 'proj-master-linux' : 'master'}
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        assert cit.main(['cit', 'prune'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['proj-gone-linux (REMOVED)']
+    assert 'proj-master-linux' in fake_jenkins.jobs
+    
+    
+#===================================================================================================
+# test_folders
+#===================================================================================================
+def test_folders(tmpdir, fake_jenkins, cit_runner):
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], {'jenkins' : {'url' : fake_jenkins.url}},
+                                          folder='features/$name')
+    fake_jenkins.add_job('other-job', fake_jenkins.jobs['source-job']['config'])
+    fake_jenkins.add_job('features', '<com.cloudbees.hudson.plugins.folder.Folder/>')
+    tmpdir.join('.git', 'refs', 'heads', 'master').ensure()
+    run = cit_runner(global_config_file)
+    
+    # the folder of the branch is created with the first job
+    assert run('add', 'feature', '-j', '1') == [
+        'source-job => features/feature/source-job-feature (CREATED)',
+        'other-job => features/feature/other-job-feature (CREATED)',
+    ]
+    assert fake_jenkins.requests[:5] == [
+        ('GET', '/job/source-job/config.xml'),
+        ('GET', '/job/features/job/feature/job/source-job-feature/config.xml'),
+        ('POST', '/job/features/job/feature/createItem'),
+        ('POST', '/job/features/createItem'),
+        ('POST', '/job/features/job/feature/createItem'),
+    ]
+    assert sorted(fake_jenkins.jobs) == ['features', 'features/feature', 'features/feature/other-job-feature',
+                                         'features/feature/source-job-feature', 'other-job', 'source-job']
+    
+    # only the jobs in the folder of the branch are queried
+    assert run('start', 'feature') == ['features/feature/source-job-feature (STARTED)', 
+                                       'features/feature/other-job-feature (STARTED)']
+    assert fake_jenkins.requests[0] == ('GET', '/job/features/job/feature/api/json')
+    assert len(fake_jenkins.requests) == 3
+    
+    # the folder is removed with all jobs in it, if it has nothing else
+    assert run('rm', 'feature') == ['features/feature/source-job-feature (REMOVED)', 
+                                    'features/feature/other-job-feature (REMOVED)']
+    assert fake_jenkins.requests == [('GET', '/job/features/job/feature/api/json'), 
+                                     ('POST', '/job/features/job/feature/doDelete')]
+    assert run('rm', 'feature') == ['features/feature/source-job-feature (NOT FOUND)', 
+                                    'features/feature/other-job-feature (NOT FOUND)']
+    assert fake_jenkins.requests == [('GET', '/job/features/job/feature/api/json')]
+    
+    # ...unless it has other jobs, which are kept
+    run('add', 'feature')
+    fake_jenkins.add_job('features/feature/someone-elses-job', fake_jenkins.jobs['source-job']['config'])
+    assert run('rm', 'feature') == ['features/feature/source-job-feature (REMOVED)', 
+                                    'features/feature/other-job-feature (REMOVED)']
+    assert sorted(name for name in fake_jenkins.jobs if name.startswith('features/feature')) == [
+        'features/feature', 'features/feature/someone-elses-job']
+    fake_jenkins.handle('POST', '/job/features/job/feature/doDelete', {}, '')
+    
+    # branch names can't make subfolders
+    with pytest.raises(RuntimeError):
+        run('add', 'feature/foo')
+    assert 'features/feature' not in fake_jenkins.jobs
+    
+    # pruning finds the feature jobs of all branches with a single request
+    run('add', 'master')
+    run('add', 'gone')
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        assert run('prune') == ['features/gone/other-job-gone (REMOVED)', 'features/gone/source-job-gone (REMOVED)']
+    assert fake_jenkins.requests == [('GET', '/job/features/api/json'), 
+                                     ('POST', '/job/features/job/gone/doDelete')]
+    assert sorted(fake_jenkins.jobs)[:2] == ['features', 'features/master']
+    
+    assert cit.job_path('features/a b') == '/job/features/job/a%20b'
+    job_config = {'folder' : 'ci', 'jobs' : [{'source-job' : 'source-job', 'feature-branch-job' : 'source-job-$name'}]}
+    assert cit.find_feature_branch_jobs(['ci/source-job-a', 'source-job-b', 'ci/other-a'], job_config) == \
+        {'ci/source-job-a' : 'a'}
+    assert list(cit.get_configured_jobs('a', job_config)) == [('source-job', 'ci/source-job-a')]
+    job_config['folder'] = '$name/ci'
+    with pytest.raises(RuntimeError):
+        list(cit.get_configured_jobs('a', job_config))
+    with pytest.raises(RuntimeError):
+        cit.find_feature_branch_jobs(['a/ci/source-job-a'], job_config)
+    
+    
+#===================================================================================================
+# test_sync
+#===================================================================================================
+def test_sync(tmpdir, fake_jenkins, capsys):
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    git_dir = tmpdir.join('.git')
+    git_dir.join('config').write('[user]\n\tname = User\n\temail = user@somewhere.com\n')
+    git_dir.join('refs', 'heads', 'master').ensure()
+    git_dir.join('refs', 'heads', 'feature').ensure()
+    git_dir.join('refs', 'heads', 'untracked').ensure()
+    
+    source_config = fake_jenkins.jobs['source-job']['config']
+    fake_jenkins.add_job('other-job', source_config.replace('SS win32', 'SS linux64'))
+    master_config, _ = cit.make_feature_branch_config(source_config, 'master', 'user@somewhere.com')
+    fake_jenkins.add_job('source-job-master', master_config)
+    fake_jenkins.add_job('other-job-master', fake_jenkins.jobs['source-job-master']['config'])
+    fake_jenkins.add_job('source-job-feature', source_config)
+    fake_jenkins.add_job('source-job-gone', source_config)
+    
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        argv = ['cit', 'sync', '--plan']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            'source-job-feature (TO UPDATE)',
+            'other-job-feature (TO CREATE)',
+            'other-job-master (TO UPDATE)',
+            'source-job-gone (TO REMOVE)',
+            '1 to create, 2 to update, 1 to remove, 1 unchanged',
+        ]
+        assert fake_jenkins.jobs['source-job-feature']['config'] == source_config
+        assert 'other-job-feature' not in fake_jenkins.jobs
+        assert 'source-job-gone' in fake_jenkins.jobs
+        
+        fake_jenkins.reset_requests()
+        argv = ['cit', 'sync']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            'source-job-feature (UPDATED)',
+            'other-job-feature (CREATED)',
+            'other-job-master (UPDATED)',
+            'source-job-gone (REMOVED)',
+            '1 created, 2 updated, 1 removed, 1 unchanged',
+        ]
+        # source configurations are fetched only once
+        source_requests = [r for r in fake_jenkins.requests if r[1] in ('/job/source-job/config.xml', '/job/other-job/config.xml')]
+        assert sorted(source_requests) == [('GET', '/job/other-job/config.xml'), ('GET', '/job/source-job/config.xml')]
+        # job list, source configs, current configs of existing (and removed) jobs, and one request 
+        # per change
+        assert len(fake_jenkins.requests) == 1 + 2 + 4 + 4
+        
+        argv = ['cit', 'sync', '--plan']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['0 to create, 0 to update, 0 to remove, 4 unchanged']
+        
+        
+#===================================================================================================
+# test_sync_patterns
+#===================================================================================================
+def test_sync_patterns(tmpdir, fake_jenkins, capsys):
+    global_config_file = create_cit_files(tmpdir, [], {'jenkins' : {'url' : fake_jenkins.url}})
+    tmpdir.join('.git', 'config').write('[user]\n\tname = User\n\temail = user@somewhere.com\n')
+    tmpdir.join('.git', 'refs', 'heads', 'feature').ensure()
+    config = fake_jenkins.jobs['source-job']['config']
+    fake_jenkins.add_job('other-job', config)
+    
+    def sync(source_pattern, other_pattern):
+        job_config = {'jobs' : [{'source-job' : 'source-job', 'feature-branch-job' : source_pattern},
+                                {'source-job' : 'other-job', 'feature-branch-job' : other_pattern}]}
+        tmpdir.join('.cit.yaml').write(yaml.dump(job_config))
+        with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+            assert cit.main(['cit', 'sync'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        out, err = capsys.readouterr()
+        return out.splitlines()
+    
+    # "proj-feature-linux" could be the job of a branch "feature-linux", which doesn't exist
+    fake_jenkins.add_job('proj-feature', config)
+    fake_jenkins.add_job('proj-feature-linux', config)
+    assert sync('proj-$name', 'proj-$name-linux') == [
+        'proj-feature (UPDATED)',
+        'proj-feature-linux (UPDATED)',
+        '0 created, 2 updated, 0 removed, 0 unchanged',
+    ]
+    
+    # jobs made by cit are known even after renaming them in .cit.yaml
+    assert sync('proj-fb-$name', 'proj-fb-$name-linux') == [
+        'proj-fb-feature (CREATED)',
+        'proj-fb-feature-linux (CREATED)',
+        'proj-feature (REMOVED)',
+        'proj-feature-linux (REMOVED)',
+        '2 created, 0 updated, 2 removed, 0 unchanged',
+    ]
+    assert sorted(fake_jenkins.jobs) == ['other-job', 'proj-fb-feature', 'proj-fb-feature-linux', 'source-job']
+    assert sync('proj-fb-$name', 'proj-fb-$name-linux') == ['0 created, 0 updated, 0 removed, 2 unchanged']
+    
+    
+#===================================================================================================
+# test_sync_users
+#===================================================================================================
+def test_sync_users(tmpdir, fake_jenkins, cit_runner):
+    global_config_file = create_cit_files(tmpdir, ['source-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    tmpdir.join('.git', 'refs', 'heads', 'alice-feature').ensure()
+    tmpdir.join('.git', 'refs', 'heads', 'bob-feature').ensure()
+    run_alice = cit_runner(global_config_file, user=('alice', 'alice@somewhere.com'))
+    run_bob = cit_runner(global_config_file, user=('bob', 'bob@somewhere.com'))
+    
+    def get_recipients():
+        return [ET.fromstring(fake_jenkins.jobs[name]['config']).find('.//hudson.tasks.Mailer/recipients').text
+                for name in ['source-job-alice-feature', 'source-job-bob-feature']]
+    
+    run_alice('add', 'alice-feature')
+    run_bob('add', 'bob-feature')
+    
+    # each job keeps notifying the user who added it
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        assert run_alice('sync') == ['0 created, 0 updated, 0 removed, 2 unchanged']
+        assert get_recipients() == ['alice@somewhere.com', 'bob@somewhere.com']
+        
+        fake_jenkins.jobs['source-job']['config'] = fake_jenkins.jobs['source-job']['config'].replace(
+            'SS win32', 'SS win64')
+        assert run_alice('sync') == [
+            'source-job-alice-feature (UPDATED)',
+            'source-job-bob-feature (UPDATED)',
+            '0 created, 2 updated, 0 removed, 0 unchanged',
+        ]
+        assert get_recipients() == ['alice@somewhere.com', 'bob@somewhere.com']
+        assert 'SS win64' in fake_jenkins.jobs['source-job-bob-feature']['config']
+    
+    
+#===================================================================================================
+# test_rollback
+#===================================================================================================
+def test_rollback(tmpdir, fake_jenkins, cit_runner):
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    tmpdir.join('.git', 'config').write('[user]\n\tname = User\n\temail = user@somewhere.com\n')
+    config_v1 = fake_jenkins.jobs['source-job']['config']
+    fake_jenkins.add_job('other-job', config_v1)
+    run = cit_runner(global_config_file)
+    
+    def list_snapshots():
+        return [line.split()[0] for line in run('rollback', 'feature', '--list')]
+    
+    run('add', 'feature')
+    feature_v1 = fake_jenkins.jobs['source-job-feature']['config']
+    fake_jenkins.jobs['source-job']['config'] = config_v1.replace('<description></description>', 
+                                                                  '<description>v2</description>', 1)
+    run('add', 'feature')
+    feature_v2 = fake_jenkins.jobs['source-job-feature']['config']
+    assert feature_v2 != feature_v1
+    snapshots = list_snapshots()
+    assert len(snapshots) == 2
+    
+    # undoes the last change (other-job was not changed), and then the rollback itself
+    assert run('rollback', 'feature') == ['source-job-feature (RESTORED)']
+    assert fake_jenkins.jobs['source-job-feature']['config'] == feature_v1
+    assert len(list_snapshots()) == 3
+    run('rollback', 'feature')
+    assert fake_jenkins.jobs['source-job-feature']['config'] == feature_v2
+    
+    # back to before the jobs were created
+    assert run('rollback', 'feature', '--to', snapshots[0]) == [
+        'other-job-feature (REMOVED)',
+        'source-job-feature (REMOVED)',
+    ]
+    assert 'source-job-feature' not in fake_jenkins.jobs
+    assert run('rollback', 'other', '--list') == []
+    
+    # feature configs are stored once, as small deltas against the source config
+    store = cit.SnapshotStore(str(tmpdir.join('.cit-snapshots')), fake_jenkins.url)
+    objects = tmpdir.join('.cit-snapshots', 'objects').visit(fil=lambda path: path.check(file=1))
+    assert len(list(objects)) == 4
+    sha = hashlib.sha1(feature_v2).hexdigest()
+    assert store.get(sha) == feature_v2
+    assert store._read(store._object_filename(sha))[0] == 'delta'
+    
+    # removals are recorded too, with both backends, so they can be undone
+    for backend in ('rest', 'script'):
+        yaml.dump({'jenkins' : {'url' : fake_jenkins.url, 'backend' : backend}}, file(global_config_file, 'w'))
+        run('add', 'feature')
+        assert run('rm', 'feature') == ['source-job-feature (REMOVED)', 'other-job-feature (REMOVED)']
+        assert run('rollback', 'feature') == ['other-job-feature (RESTORED)', 'source-job-feature (RESTORED)']
+        assert fake_jenkins.jobs['source-job-feature']['config'] == feature_v2
+        
+    # but jobs removed without cit are not created again
+    fake_jenkins.jobs['source-job']['config'] = config_v1
+    assert run('add', 'feature')[0] == 'source-job => source-job-feature (UPDATED)'
+    fake_jenkins.handle('POST', '/job/source-job-feature/doDelete', {}, '')
+    assert run('rollback', 'feature') == ['source-job-feature (NOT FOUND)']
+    assert 'source-job-feature' not in fake_jenkins.jobs
+    
+    
+#===================================================================================================
+# test_trace
+#===================================================================================================
+def test_trace(tmpdir, fake_jenkins, capsys, monkeypatch):
+    global_config_file = create_cit_files(tmpdir, ['source-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    trace_file = str(tmpdir.join('trace.json'))
+    
+    with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+        mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+        argv = ['cit', 'add', 'feature', '--trace=json', '--trace-file', trace_file]
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        
+    events = json.load(file(trace_file))
+    assert [(e['category'], e['name']) for e in events if e['category'] in ('http', 'job')] == [
+        ('http', 'GET'), 
+        ('job', 'fetch source'), 
+        ('job', 'transform'), 
+        ('http', 'GET'),
+        ('job', 'compare'),
+        ('http', 'POST'),
+        ('job', 'create'),
+    ]
+    http_events = [e for e in events if e['category'] == 'http']
+    assert http_events[0]['args']['url'] == fake_jenkins.url + '/job/source-job/config.xml'
+    assert [e['args']['status'] for e in http_events] == [200, 404, 200]
+    assert http_events[0]['args']['bytes'] == len(fake_jenkins.jobs['source-job']['config'])
+    assert set(e['category'] for e in events) == set(['command', 'config', 'http', 'job'])
+    assert cit._tracer is None
+    
+    # summary to stderr, enabled by the environment
+    monkeypatch.setenv('CIT_TRACE', '1')
+    capsys.readouterr()
+    assert cit.main(['cit', 'rm', 'feature'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['source-job-feature (REMOVED)']
+    lines = err.splitlines()
+    assert lines[0].split() == ['count', 'total', '(s)', 'max', '(s)', 'bytes']
+    assert [line.split()[:2] for line in lines[1:5]] == [['command', '1'], ['config', '2'], ['http', '2'], 
+                                                         ['http', 'GET']]
+    assert 'slowest:' in lines
+    
+    # chrome trace
+    monkeypatch.setenv('CIT_TRACE', 'chrome')
+    monkeypatch.setenv('CIT_TRACE_FILE', trace_file)
+    assert cit.main(['cit', 'rm', 'feature'], global_config_file=global_config_file) == cit.RETURN_CODE_OK
+    trace_events = json.load(file(trace_file))['traceEvents']
+    assert set(e['ph'] for e in trace_events) == set(['X'])
+    assert trace_events[-1]['name'] == 'rm'
+    
+    
+#===================================================================================================
+# test_multiple_servers
+#===================================================================================================
+def test_multiple_servers(tmpdir, fake_jenkins, capsys):
+    config = fake_jenkins.jobs['source-job']['config']
+    with FakeJenkins(latency=0.2) as slow_jenkins:
+        slow_jenkins.add_job('source-job', config)
+        global_config = {
+            'jenkins' : {'url' : slow_jenkins.url},
+            'servers' : {
+                'windows' : {'url' : fake_jenkins.url},
+                'offline' : {'url' : 'http://127.0.0.1:1'},
+            },
+        }
+        global_config_file = create_cit_files(tmpdir, [], global_config)
+        cit_config = {'jobs' : [
+            {'source-job' : 'source-job', 'feature-branch-job' : 'source-job-$name'},
+            {'source-job' : 'source-job', 'feature-branch-job' : 'source-job-$name', 'server' : 'windows'},
+        ]}
+        yaml.dump(cit_config, file(str(tmpdir.join('.cit.yaml')), 'w'))
+        
+        with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+            mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+            argv = ['cit', 'add', 'feature']
+            assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_OK
+        
+        # output of each server is grouped, and the slow server doesn't hold up the others
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            'windows: %s' % fake_jenkins.url,
+            'source-job => source-job-feature (CREATED)',
+            'jenkins: %s' % slow_jenkins.url,
+            'source-job => source-job-feature (CREATED)',
+        ]
+        assert 'source-job-feature' in fake_jenkins.jobs
+        assert 'source-job-feature' in slow_jenkins.jobs
+        
+        # unreachable server
+        cit_config['jobs'][0]['server'] = 'offline'
+        yaml.dump(cit_config, file(str(tmpdir.join('.cit.yaml')), 'w'))
+        argv = ['cit', 'rm', 'feature']
+        assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+        out, err = capsys.readouterr()
+        lines = out.splitlines()
+        assert sorted(lines[::2]) == ['offline: http://127.0.0.1:1', 'windows: %s' % fake_jenkins.url]
+        assert 'source-job-feature (REMOVED)' in lines
+        assert any(line.startswith('source-job-feature (ERROR: ') for line in lines)
+        
+        
+#===================================================================================================
+# test_serve
+#===================================================================================================
+def test_serve(tmpdir, fake_jenkins, cit_runner):
+    global_config_file = create_cit_files(tmpdir, ['source-job'], {'jenkins' : {'url' : fake_jenkins.url}})
+    tmpdir.join('.git', 'config').write('[user]\n\tname = User\n\temail = user@somewhere.com\n')
+    socket_path = cit.get_server_socket(global_config_file)
+    run = cit_runner(global_config_file)
+    
+    server = cit.create_command_server(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        assert run('add', 'feature') == ['source-job => source-job-feature (CREATED)']
+        assert fake_jenkins.connections == 1
+        
+        # later commands reuse the server's connections
+        assert run('start', 'feature') == ['source-job-feature (STARTED)']
+        assert fake_jenkins.connections == 0
+        assert len(fake_jenkins.requests) == 2
+        
+        # changes in .cit.yaml are seen by the next command
+        tmpdir.join('.cit.yaml').write(yaml.dump({'jobs' : [
+            {'source-job' : 'source-job', 'feature-branch-job' : 'renamed-$name'}]}))
+        assert run('rm', 'feature') == ['renamed-feature (NOT FOUND)']
+        
+        # errors are reported by the forwarding process
+        tmpdir.join('.cit.yaml').write('jobs: [')
+        run('rm', 'feature', return_code=1)
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    # without a server, commands run in their own process
+    tmpdir.join('.cit.yaml').write(yaml.dump({'jobs' : [
+        {'source-job' : 'source-job', 'feature-branch-job' : 'renamed-$name'}]}))
+    assert not os.path.exists(socket_path)
+    assert cit._shared_clients is None
+    assert run('rm', 'feature') == ['renamed-feature (NOT FOUND)']
+        
+        
+#===================================================================================================
+# test_workspace
+#===================================================================================================
+def test_workspace(tmpdir, fake_jenkins, capsys, cit_runner):
+    global_config_file = str(tmpdir.join('citconfig.yaml'))
+    yaml.dump({'jenkins' : {'url' : fake_jenkins.url}}, file(global_config_file, 'w'))
+    fake_jenkins.add_job('other-job', fake_jenkins.jobs['source-job']['config'])
+    
+    workspace = tmpdir.join('workspace')
+    for repo, source_job in [('repo-a', 'source-job'), ('group/repo-b', 'other-job'), ('.hidden', 'source-job')]:
+        workspace.join(repo, '.git', 'config').ensure().write('[user]\n\tname = User\n\temail = user@somewhere.com\n')
+        workspace.join(repo, '.git', 'HEAD').write('ref: refs/heads/master\n')
+        cit_config = {'jobs' : [{'source-job' : source_job, 'feature-branch-job' : source_job + '-$name'}]}
+        workspace.join(repo, '.cit.yaml').write(yaml.dump(cit_config))
+    # repositories inside repositories are not searched
+    workspace.join('repo-a', 'sub', '.git').ensure(dir=True)
+    workspace.join('repo-a', 'sub', '.cit.yaml').write(yaml.dump({'jobs' : []}))
+    workspace.join('not-a-repo', 'README').ensure()
+    
+    assert cit.find_cit_repositories(str(workspace)) == [str(workspace.join('group', 'repo-b')), 
+                                                         str(workspace.join('repo-a'))]
+    
+    run = cit_runner(global_config_file, options=['--workspace', str(workspace)])
+    
+    assert run('add', 'feature') == [
+        os.path.join('group', 'repo-b') + ':',
+        'other-job => other-job-feature (CREATED)',
+        'repo-a:',
+        'source-job => source-job-feature (CREATED)',
+    ]
+    assert run('start', 'feature') == [
+        os.path.join('group', 'repo-b') + ':',
+        'other-job-feature (STARTED)',
+        'repo-a:',
+        'source-job-feature (STARTED)',
+    ]
+    # the state of the jobs of all repositories is read with a single request
+    assert sorted(fake_jenkins.requests) == [
+        ('GET', '/api/json'),
+        ('POST', '/job/other-job-feature/build'),
+        ('POST', '/job/source-job-feature/build'),
+    ]
+    # the checked out branch of each repository
+    assert run('rm') == [
+        os.path.join('group', 'repo-b') + ':',
+        'other-job-master (NOT FOUND)',
+        'repo-a:',
+        'source-job-master (NOT FOUND)',
+    ]
+    
+    argv = ['cit', '--workspace', str(workspace), 'watch']
+    assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_UNKNOWN_COMMAND
+    capsys.readouterr()
+    
+    # a repository using an unknown server fails on its own
+    cit_config = {'jobs' : [{'source-job' : 'source-job', 'feature-branch-job' : 'source-job-$name', 
+                             'server' : 'missing'}]}
+    workspace.join('group', 'repo-b', '.cit.yaml').write(yaml.dump(cit_config))
+    argv = ['cit', '--workspace', str(workspace), 'rm', 'feature']
+    assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        os.path.join('group', 'repo-b') + ':',
+        'source-job-feature (ERROR: unknown server in .cit.yaml: missing)',
+        'repo-a:',
+        'source-job-feature (REMOVED)',
+    ]
+    
+    # with a folder for each branch, the folder is removed with all jobs in it
+    fake_jenkins.add_job('features', '<com.cloudbees.hudson.plugins.folder.Folder/>')
+    cit_config = {'folder' : 'features/$name', 'jobs' : [
+        {'source-job' : 'source-job', 'feature-branch-job' : 'source-job-$name'},
+        {'source-job' : 'other-job', 'feature-branch-job' : 'other-job-$name'}]}
+    workspace.join('group', 'repo-b', '.cit.yaml').write(yaml.dump(cit_config))
+    run('add', 'feature')
+    assert 'features/feature/other-job-feature' in fake_jenkins.jobs
+    assert run('rm', 'feature') == [
+        os.path.join('group', 'repo-b') + ':',
+        'features/feature/source-job-feature (REMOVED)',
+        'features/feature/other-job-feature (REMOVED)',
+        'repo-a:',
+        'source-job-feature (REMOVED)',
+    ]
+    assert [name for name in sorted(fake_jenkins.jobs) if name.startswith('features')] == ['features']
+    assert ('POST', '/job/features/job/feature/doDelete') in fake_jenkins.requests
+    assert not any(path.startswith('/job/features/job/feature/job/') for _, path in fake_jenkins.requests)
+        
+        
+#===================================================================================================
+# test_timeouts
+#===================================================================================================
+def test_timeouts(tmpdir, fake_jenkins, capsys):
+    global_config = {'jenkins' : {'url' : fake_jenkins.url, 'timeout' : 0.2, 'retries' : 0}}
+    global_config_file = create_cit_files(tmpdir, ['source-job', 'other-job'], global_config)
+    source_config = fake_jenkins.jobs['source-job']['config']
+    fake_jenkins.add_job('other-job', source_config)
+    jenkins = cit.JenkinsClient(fake_jenkins.url)
+    jenkins.retry_backoff = 0
+    config_path = '/job/source-job/config.xml'
+    
+    # GETs failing with server errors or timing out are retried, but not forever
+    fake_jenkins.add_fault(config_path, status=503, count=2)
+    assert jenkins.get_job_config('source-job') == source_config
+    assert fake_jenkins.requests == [('GET', config_path)] * 3
+    fake_jenkins.add_fault(config_path, status=503, count=3)
+    with pytest.raises(cit.JenkinsError) as e:
+        jenkins.get_job_config('source-job')
+    assert e.value.status == 503
+    
+    jenkins.timeout = 0.2
+    fake_jenkins.add_fault(config_path, delay=1.0)
+    assert jenkins.get_job_config('source-job') == source_config
+    
+    # other requests are not retried
+    fake_jenkins.reset_requests()
+    fake_jenkins.add_fault(config_path, status=503)
+    with pytest.raises(cit.JenkinsError):
+        jenkins.update_job_config('source-job', source_config)
+    assert fake_jenkins.requests == [('POST', config_path)]
+    
+    # no request goes past the deadline
+    jenkins.set_deadline(0.5)
+    fake_jenkins.add_fault(config_path, delay=1.0, count=10)
+    start = time.time()
+    with pytest.raises(cit.JenkinsTimeout):
+        jenkins.get_job_config('source-job')
+    assert time.time() - start < 0.9
+    fake_jenkins.faults = []
+    jenkins.set_deadline(None)
+    
+    # slow requests are hedged by a second one once there are enough latencies to compare to
+    jenkins.timeout = 5.0
+    jenkins.hedge_percentile = 90
+    for i in xrange(cit.HEDGE_MIN_SAMPLES):
+        jenkins.get_job_config('source-job')
+    fake_jenkins.add_fault(config_path, delay=1.0)
+    start = time.time()
+    assert jenkins.get_job_config('source-job') == source_config
+    assert time.time() - start < 0.9
+    jenkins.close()
+    
+    # commands report jobs that timed out, without waiting for them
+    fake_jenkins.add_fault(config_path, delay=1.0)
+    with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+        mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+        assert cit.main(['cit', 'add', 'feature'], global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'source-job => source-job-feature (TIMEOUT)',
+        'other-job => other-job-feature (CREATED)',
+    ]
+    
+    
+#===================================================================================================
+# test_script_backend
+#===================================================================================================
+def test_script_backend(tmpdir, fake_jenkins, cit_runner):
+    source_config = fake_jenkins.jobs['source-job']['config']
+    
+    def run_commands(jenkins, backend):
+        '''
+        Runs the same commands with the given backend, returning their output and the jobs left.
+        '''
+        jenkins.add_job('other-job', source_config)
+        global_config = {'jenkins' : {'url' : jenkins.url, 'backend' : backend}}
+        global_config_file = create_cit_files(tmpdir.mkdir(backend), ['source-job', 'other-job'], global_config)
+        
+        run_cit = cit_runner(global_config_file, jenkins=jenkins)
+        
+        def run(*args):
+            lines = run_cit(*args, return_code=None)
+            # errors are described differently by each backend
+            return [re.sub(r'\(ERROR: .*\)', '(ERROR)', line) for line in lines], len(jenkins.requests)
+        
+        results = [run('add', 'feature'), run('add', 'feature')]
+        jenkins.jobs['other-job']['config'] = source_config.replace('SS win32', 'SS win64')
+        results += [run('add', 'feature'), run('start', 'feature')]
+        jenkins.finish_build('source-job-feature')
+        jenkins.queue_build('source-job-feature')
+        jenkins.jobs['other-job-feature']['color'] = 'disabled'
+        results += [run('start', 'feature'), run('rm', 'feature'), run('rm', 'feature')]
+        configs = dict((name, job['config']) for name, job in jenkins.jobs.iteritems())
+        return results, configs
+    
+    rest_results, rest_configs = run_commands(fake_jenkins, 'rest')
+    with FakeJenkins() as script_jenkins:
+        script_jenkins.add_job('source-job', source_config)
+        script_results, script_configs = run_commands(script_jenkins, 'script')
+    
+    # same results and jobs, but each command changes all jobs with a single request
+    assert [output for output, _ in script_results] == [output for output, _ in rest_results]
+    assert script_configs == rest_configs
+    assert [requests for _, requests in script_results] == [3, 3, 3, 1, 1, 1, 1]
+    assert len(script_jenkins.scripts) == 7
+    
+    outputs = [output for output, _ in script_results]
+    assert outputs[:3] == [
+        ['source-job => source-job-feature (CREATED)', 'other-job => other-job-feature (CREATED)'],
+        ['source-job => source-job-feature (UNCHANGED)', 'other-job => other-job-feature (UNCHANGED)'],
+        ['source-job => source-job-feature (UNCHANGED)', 'other-job => other-job-feature (UPDATED)'],
+    ]
+    assert outputs[4] == ['source-job-feature (QUEUED)', 'other-job-feature (ERROR)']
+    assert outputs[5:] == [['source-job-feature (REMOVED)', 'other-job-feature (REMOVED)'],
+                           ['source-job-feature (NOT FOUND)', 'other-job-feature (NOT FOUND)']]
+    
+    # with --workspace, the jobs of all repositories are changed by a single request too
+    workspace = tmpdir.join('workspace')
+    for repo, source_job in [('repo-a', 'source-job'), ('repo-b', 'other-job')]:
+        workspace.join(repo, '.git', 'HEAD').ensure().write('ref: refs/heads/master\n')
+        cit_config = {'jobs' : [{'source-job' : source_job, 'feature-branch-job' : source_job + '-$name'}]}
+        workspace.join(repo, '.cit.yaml').write(yaml.dump(cit_config))
+    with FakeJenkins() as workspace_jenkins:
+        workspace_jenkins.add_job('source-job', source_config)
+        workspace_jenkins.add_job('other-job', source_config)
+        global_config_file = str(tmpdir.join('citconfig.yaml'))
+        yaml.dump({'jenkins' : {'url' : workspace_jenkins.url, 'backend' : 'script'}}, file(global_config_file, 'w'))
+        run = cit_runner(global_config_file, options=['--workspace', str(workspace)], jenkins=workspace_jenkins)
+        
+        assert run('add', 'feature') == ['repo-a:', 'source-job => source-job-feature (CREATED)', 
+                                         'repo-b:', 'other-job => other-job-feature (CREATED)']
+        assert len(workspace_jenkins.requests) == 3
+        assert run('start', 'feature') == ['repo-a:', 'source-job-feature (STARTED)', 
+                                           'repo-b:', 'other-job-feature (STARTED)']
+        assert len(workspace_jenkins.requests) == 1
+        assert run('rm', 'feature') == ['repo-a:', 'source-job-feature (REMOVED)', 
+                                        'repo-b:', 'other-job-feature (REMOVED)']
+        assert len(workspace_jenkins.requests) == 1
+        assert len(workspace_jenkins.scripts) == 3
+        assert sorted(workspace_jenkins.jobs) == ['other-job', 'source-job']
+    
+    # FakeJenkins only reads the operations from the scripts: check the rest is exactly BATCH_SCRIPT
+    for script in script_jenkins.scripts:
+        payload = re.search(r"'([A-Za-z0-9+/=]*)'\.decodeBase64\(\)", script).group(1)
+        assert script == cit.BATCH_SCRIPT % payload
+        assert isinstance(json.loads(base64.b64decode(payload)), list)
+    
+    # and that its brackets are balanced, outside strings and comments
+    code = re.sub(r'//[^\n]*|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'', '', cit.BATCH_SCRIPT)
+    stack = []
+    for char in code:
+        if char in '([{':
+            stack.append(char)
+        elif char in ')]}':
+            assert stack and stack.pop() == '([{'[')]}'.index(char)]
+    assert stack == []
+    
+    
+#===================================================================================================
+# test_batch_script_syntax
+#===================================================================================================
+GROOVY_PARSE_SCRIPT = '''
+import org.codehaus.groovy.control.CompilationUnit
+import org.codehaus.groovy.control.Phases
+
+// only parses the script: Jenkins' classes are not needed
+def unit = new CompilationUnit()
+unit.addSource(new File(args[0]))
+unit.compile(Phases.CONVERSION)
+'''
+
+@pytest.mark.skipif(distutils.spawn.find_executable('groovy') is None, reason='needs groovy')
+def test_batch_script_syntax(tmpdir):
+    '''
+    The script of the script console backend is only run by a real Jenkins (FakeJenkins simulates
+    it), so at least make sure it's valid Groovy.
+    '''
+    tmpdir.join('parse.groovy').write(GROOVY_PARSE_SCRIPT)
+    tmpdir.join('batch.groovy').write(cit.BATCH_SCRIPT % base64.b64encode('[]'))
+    popen = subprocess.Popen(['groovy', 'parse.groovy', 'batch.groovy'], cwd=str(tmpdir), 
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = popen.communicate()[0]
+    assert popen.returncode == 0, output
+    
+    
+#===================================================================================================
+# test_make_feature_branch_config_is_idempotent
+#===================================================================================================
+def test_make_feature_branch_config_is_idempotent():
+    source_config = file(os.path.join(os.path.dirname(__file__), 'test_config.xml')).read()
+    config, warnings = cit.make_feature_branch_config(source_config, 'feature', 'user@somewhere.com')
+    assert warnings == []
+    
+    config_again, warnings = cit.make_feature_branch_config(config, 'feature', 'user@somewhere.com')
+    assert cit.normalize_config(config_again) == cit.normalize_config(config)
+    
+    tree = ET.fromstring(config_again)
+    assert tree.find('./displayName').text == 'SS win32 (feature)'
+    assert len(tree.findall('.//hudson.triggers.SCMTrigger')) == 1
+    
+    
+#===================================================================================================
+# test_feature_branch_rules
+#===================================================================================================
+def test_feature_branch_rules():
+    source_config = '''
+        <project>
+          <description>Build of master</description>
+          <builders>
+            <hudson.tasks.Shell><command>make BRANCH=$name</command></hudson.tasks.Shell>
+            <hudson.tasks.Ant><targets>clean</targets></hudson.tasks.Ant>
+          </builders>
+          <triggers/>
+        </project>
+    '''
+    job_config = {
+        'default-rules' : False,
+        'rules' : [
+            {'path' : './description', 'substitute' : {'master' : '$name'}},
+            {'path' : './/hudson.tasks.Shell/command', 'substitute' : True},
+            {'path' : './builders/hudson.tasks.Ant', 'remove' : True},
+            {'path' : './triggers', 'append' : '<timer><spec>@daily</spec></timer>'},
+            {'path' : './scm/url', 'set' : 'git@$email', 'create' : True},
+            {'path' : './/missing', 'remove' : True, 'warn-if-missing' : 'nothing to remove'},
+        ],
+    }
+    rules = cit.get_feature_branch_rules(job_config)
+    config, warnings = cit.make_feature_branch_config(source_config, 'feature', 'me@somewhere.com', rules)
+    assert warnings == ['nothing to remove']
+    
+    tree = ET.fromstring(config)
+    assert tree.find('./description').text == 'Build of feature'
+    assert [e.tag for e in tree.find('./builders')] == ['hudson.tasks.Shell']
+    assert tree.find('.//command').text == 'make BRANCH=feature'
+    assert [e.tag for e in tree.find('./triggers')] == ['timer']
+    assert tree.find('./scm/url').text == 'git@me@somewhere.com'
+    
+    config_again, _ = cit.make_feature_branch_config(config, 'feature', 'me@somewhere.com', rules)
+    assert cit.normalize_config(config_again) == cit.normalize_config(config)
+    
+    with pytest.raises(RuntimeError):
+        cit.get_feature_branch_rules({'rules' : [{'path' : 'description', 'remove' : True}]})
+    with pytest.raises(RuntimeError):
+        cit.get_feature_branch_rules({'rules' : [{'path' : './description'}]})
+        
+        
+#===================================================================================================
+# test_add_reports_failures_in_order
+#===================================================================================================
+def test_add_reports_failures_in_order(tmpdir, capsys):
+    global_config_file = create_cit_files(tmpdir, ['job-%d' % i for i in xrange(6)])
+    
+    def create_feature_branch_job(jenkins, job_name, new_job_name, branch, user_email, rules=None):
+        # finish jobs out of order to ensure output is still reported in the configured order
+        time.sleep(0.01 * (6 - int(job_name[-1])))
+        if job_name == 'job-3':
+            raise RuntimeError('oops')
+        return 'CREATED', []
+    
+    with mock.patch('cit.JenkinsClient', autospec=True):
+        with mock.patch('cit.create_feature_branch_job', side_effect=create_feature_branch_job):
+            with mock.patch('cit.get_git_user', autospec=True) as mock_get_git_user:
+                mock_get_git_user.return_value = ('anonymous', 'anonymous@somewhere.com')
+                argv = ['cit', 'add', 'feature', '--jobs', '3']
+                assert cit.main(argv, global_config_file=global_config_file) == cit.RETURN_CODE_JOB_FAILED
+    
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        'job-0 => job-0-feature (CREATED)',
+        'job-1 => job-1-feature (CREATED)',
+        'job-2 => job-2-feature (CREATED)',
+        'job-3 => job-3-feature (ERROR: oops)',
+        'job-4 => job-4-feature (CREATED)',
+        'job-5 => job-5-feature (CREATED)',
+    ]
+    
+    
+#===================================================================================================
+# test_run_concurrently
+#===================================================================================================
+@pytest.mark.parametrize('workers', [1, 4])
+def test_run_concurrently(workers):
+    def func(x):
+        time.sleep(0.01 * (5 - x))
+        if x == 2:
+            raise ValueError(x)
+        return x * 10
+    
+    results = list(cit.run_concurrently(func, range(5), workers))
+    assert [item for item, _, _ in results] == range(5)
+    assert [result for _, result, _ in results] == [0, 10, None, 30, 40]
+    errors = [error for _, _, error in results]
+    assert [type(error) for error in errors] == [type(None)] * 2 + [ValueError] + [type(None)] * 2
+    
+    
+#===================================================================================================
+# test_git_helpers
+#===================================================================================================
+def test_git_helpers(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir.join('home')))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir.join('xdg')))
+    tmpdir.join('xdg', 'git', 'config').ensure().write('[user]\n\temail = xdg@somewhere.com\n')
+    tmpdir.join('home', '.gitconfig').ensure().write('[user]\n\tname = Global User\n')
+    
+    git_dir = tmpdir.join('repo', '.git')
+    git_dir.join('HEAD').ensure().write('ref: refs/heads/feature\n')
+    git_dir.join('config').write('[core]\n\tbare = false\n[user]\n\tname = "Local User" # comment\n')
+    
+    # worktree of the same repository
+    worktree_dir = git_dir.join('worktrees', 'wt')
+    worktree_dir.join('HEAD').ensure().write('4b825dc642cb6eb9a060e54bf8d69288fbee4904\n')
+    worktree_dir.join('commondir').write('../..\n')
+    tmpdir.join('wt', '.git').ensure().write('gitdir: %s\n' % worktree_dir)
+    
+    with mock.patch('cit.check_output', side_effect=AssertionError('should not run git')):
+        cit_file_name = str(tmpdir.join('repo', '.cit.yaml'))
+        assert cit.get_git_branch(cit_file_name) == 'feature'
+        assert cit.get_git_user(cit_file_name) == ('Local User', 'xdg@somewhere.com')
+        
+        cit_file_name = str(tmpdir.join('wt', '.cit.yaml'))
+        assert cit.get_git_branch(cit_file_name) == 'HEAD'
+        assert cit.get_git_user(cit_file_name) == ('Local User', 'xdg@somewhere.com')
+        
+    # included files are not supported: fall back to running git 
+    git_dir = tmpdir.join('other', '.git')
+    git_dir.join('HEAD').ensure().write('ref: refs/heads/master\n')
+    git_dir.join('config').write('[include]\n\tpath = ../user.gitconfig\n')
+    with mock.patch('cit.check_output', autospec=True) as mock_check_output:
+        mock_check_output.side_effect = lambda args, cwd: {'user.name' : 'Included User\n', 
+                                                           'user.email' : 'included@somewhere.com\n'}[args[-1]]
+        cit_file_name = str(tmpdir.join('other', '.cit.yaml'))
+        assert cit.get_git_user(cit_file_name) == ('Included User', 'included@somewhere.com')
+        assert mock_check_output.call_args[1] == {'cwd' : str(tmpdir.join('other'))}
+    
+    
+#===================================================================================================
+# test_parse_git_config
+#===================================================================================================
+def test_parse_git_config():
+    contents = '''
+        # comment
+        [remote "origin"]
+            url = git@github.com:nicoddemus/cit.git ; comment
+            fetch = +refs/heads/*:refs/remotes/origin/*
+        [Section.SubSection]
+            Key = "value with \\"quotes\\" ; and \\\\ escapes"
+            flag
+        [alias]
+            long = log \\
+                --oneline
+    '''
+    assert cit.parse_git_config(contents) == [
+        ('remote.origin.url', 'git@github.com:nicoddemus/cit.git'),
+        ('remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'),
+        ('section.subsection.key', 'value with "quotes" ; and \\ escapes'),
+        ('section.subsection.flag', 'true'),
+        ('alias.long', 'log                 --oneline'),
+    ]
+    
+    
+#===================================================================================================
+# test_request_counts
+#===================================================================================================
+@pytest.mark.parametrize('jobs', [10, 100])
+def test_request_counts(jobs):
+    results = benchmark.run_benchmark(jobs)
+    assert [result['command'] for result in results] == benchmark.COMMANDS
+    assert benchmark.check_request_limits(results) == []
+    
+    
+#===================================================================================================
+# test_startup_imports
+#===================================================================================================
+STARTUP_SCRIPT = '''
+import sys
+import cit
+cit.main(['cit'], global_config_file=sys.argv[1])
+modules = sorted(sys.modules)
+import json
+sys.stderr.write(json.dumps(modules))
+'''
+
+def test_startup_imports(tmpdir):
+    '''
+    Guards cit's startup cost: importing cit and running it without a command should not import 
+    the http, yaml or xml modules, once the global config has been cached.
+    '''
+    global_config_file = tmpdir.join('citconfig.yaml')
+    global_config_file.write(yaml.dump({'jenkins' : {'url' : JENKINS_URL}}))
+    
+    def run():
+        popen = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, str(global_config_file)],
+            cwd=os.path.dirname(os.path.abspath(cit.__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = popen.communicate()
+        assert popen.returncode == 0, stderr
+        return json.loads(stderr)
+    
+    modules = run()
+    assert 'yaml' in modules
+    assert tmpdir.join('.cit-cache').check(dir=1)
+    
+    modules = run()
+    heavy_modules = ['yaml', 'httplib', 'json', 'xml.etree.ElementTree', 'xml.etree.cElementTree', 
+                     'subprocess', 'urllib']
+    assert [name for name in heavy_modules if name in modules] == []
+    
+    # changing the config file invalidates the cache
+    global_config_file.write(yaml.dump({'jenkins' : {'url' : 'http://other:8080'}}))
+    modules = run()
+    assert 'yaml' in modules
+    
+    
+#===================================================================================================
+# create_cit_files
+#===================================================================================================
+def create_cit_files(tmpdir, source_jobs, global_config=None, **cit_config):
+    '''
+    Creates a fake git repository at tmpdir with a .cit.yaml file configured with the given source
+    jobs (feature jobs named "SOURCE-$name") and other keyword arguments, changing the current 
+    directory to it.
+    
+    :return: the path to the global config file written in tmpdir.
+    '''
+    cwd = str(tmpdir.join('.git', 'src', 'plk'))
+    os.makedirs(cwd)
+    os.chdir(cwd)
+    
+    if global_config is None:
+        global_config = {'jenkins' : {'url' : JENKINS_URL}}
+    global_config_file = str(tmpdir.join('citconfig.yaml'))
+    yaml.dump(global_config, file(global_config_file, 'w'))
+    
+    cit_config['jobs'] = [{'source-job' : job_name, 'feature-branch-job' : job_name + '-$name'} 
+                          for job_name in source_jobs]
+    yaml.dump(cit_config, file(str(tmpdir.join('.cit.yaml')), 'w'))
+    return global_config_file
+    
+    
+#===================================================================================================
+# main    
+#===================================================================================================
+if __name__ == '__main__':    
     pytest.main()
\ No newline at end of file